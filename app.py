@@ -2,12 +2,18 @@
 通知表所見自動生成ツール - メインアプリ
 """
 
+import importlib.util
+import io
 import streamlit as st
 import database
 import config
 import openai_client
 import qr_generator
 import error_handler
+import similarity
+import metrics
+import prompt_templates
+import token_budget
 from typing import List
 
 # ページ設定
@@ -22,10 +28,165 @@ st.set_page_config(
 @st.cache_resource
 def init_db():
     """データベースを初期化（キャッシュ）"""
-    return database.Database()
+    return database.get_database()
 
 db = init_db()
 
+# トークン数を数えるエンコーディングの読み込み（生成の途中でダウンロードしないよう、起動時に別スレッドで行う）
+@st.cache_resource
+def preload_token_encodings():
+    """エンコーディングを読み込み始める（キャッシュ）"""
+    return prompt_templates.preload_encodings(
+        [prompt_templates.DEFAULT_ENCODING_MODEL, config.get_openai_model(), config.get_openai_budget_model()]
+    )
+
+preload_token_encodings()
+
+# 所見の類似度チェック（シグネチャは保存時に計算してデータベースにキャッシュする）
+similarity_index = similarity.SimilarityIndex(db)
+
+# 所見一覧の1ページあたりの件数
+LIST_PAGE_SIZE = 50
+# 所見検索の最大表示件数
+SEARCH_RESULT_LIMIT = 30
+# 類似度チェックで表示する組・文の最大件数
+SIMILAR_PAIR_LIMIT = 30
+REPEATED_SENTENCE_LIMIT = 10
+# 生成の状況で集計する期間（日数）
+METRICS_PERIODS = [7, 30, 90]
+
+# Excel形式のエクスポートは openpyxl がある場合のみ
+XLSX_AVAILABLE = importlib.util.find_spec("openpyxl") is not None
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def cached_query(method_name, data_version, *args, **kwargs):
+    """
+    データベースの読み取り結果をキャッシュ
+    
+    data_version がキーに含まれるため、データが変更されると自動的に再取得される。
+    キャッシュはプロセス全体（すべてのセッション）で共有される。
+    
+    Args:
+        method_name: Databaseの読み取りメソッド名
+        data_version: db.data_version() の値
+        
+    Returns:
+        メソッドの戻り値
+    """
+    return getattr(db, method_name)(*args, **kwargs)
+
+
+def query(method_name, *args, **kwargs):
+    """データが変わっていなければキャッシュから読み取る"""
+    return cached_query(method_name, db.data_version(), *args, **kwargs)
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_generation_metrics(days):
+    """
+    生成の記録を集計（記録は別スレッドで書き込まれるため、1分ごとに読み直す）
+    
+    Args:
+        days: 集計する期間（日数）
+        
+    Returns:
+        (全体の集計, 日ごとの集計, クラスごと・日ごとの料金)
+    """
+    rows = db.get_generation_metrics(metrics.since(days))
+    return metrics.summarize(rows), metrics.daily_summary(rows), metrics.cost_by_class(rows)
+
+
+@st.cache_data(max_entries=32, show_spinner="エクスポートを作成中...")
+def build_export(_db, class_name, file_format, data_version) -> bytes:
+    """
+    エクスポートファイルを作成（データが変わるまでキャッシュ）
+    
+    Args:
+        _db: データベース（キャッシュのキーには含めない）
+        class_name: クラス名（Noneの場合はすべてのクラス）
+        file_format: "CSV" または "Excel"
+        data_version: db.data_version() の値（変わるとキャッシュが無効になる）
+        
+    Returns:
+        ファイルの内容
+    """
+    buffer = io.BytesIO()
+    if file_format == "Excel":
+        _db.export_xlsx(buffer, class_name)
+    else:
+        _db.export_csv(buffer, class_name)
+    return buffer.getvalue()
+
+
+def parse_batch_lines(text):
+    """
+    一括生成の入力（1行に1人）を解析
+    
+    「児童名: キーワード1、キーワード2」の形式。区切りは「:」「：」またはタブ
+    （Excelからの貼り付け）、キーワードの区切りは「、」または「,」。
+    
+    Args:
+        text: 入力テキスト
+        
+    Returns:
+        児童ごとのデータのリスト（'student_name', 'keywords'）
+    """
+    requests = []
+    for line in text.splitlines():
+        line = line.replace("：", ":").replace("\t", ":", 1)
+        if not line.strip():
+            continue
+        student_name, _, keywords_text = line.partition(":")
+        keywords = [kw.strip() for kw in keywords_text.replace("、", ",").split(",") if kw.strip()]
+        requests.append({'student_name': student_name.strip() or "未設定", 'keywords': keywords})
+    return requests
+
+
+def render_export(class_name, file_label, key):
+    """
+    エクスポートボタンを表示
+    
+    ファイルは「準備」ボタンが押されてから作成する（再実行のたびには作成しない）。
+    準備はそのときのデータに対して行い、データが変わったらもう一度押すまで作成しない。
+    
+    Args:
+        class_name: クラス名（Noneの場合はすべてのクラス）
+        file_label: ボタンとファイル名に使う名前
+        key: ウィジェットのキー
+    """
+    requested_key = f"export_requested_{key}"
+    formats = ["CSV", "Excel"] if XLSX_AVAILABLE else ["CSV"]
+    
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        file_format = st.selectbox(
+            "形式",
+            options=formats,
+            key=f"export_format_{key}",
+            label_visibility="collapsed"
+        )
+    with col2:
+        data_version = db.data_version()
+        if st.session_state.get(requested_key) != data_version:
+            if st.button(f"📦 {file_label}のエクスポートを準備", key=f"export_prepare_{key}"):
+                st.session_state[requested_key] = data_version
+                st.rerun()
+        else:
+            extension, mime = EXPORT_FORMATS[file_format]
+            data = build_export(db, class_name, file_format, data_version)
+            st.download_button(
+                label=f"📥 {file_label}を{file_format}でエクスポート",
+                data=data,
+                file_name=f"shoken_{file_label}.{extension}",
+                mime=mime,
+                key=f"export_{key}"
+            )
+
 # セッション状態の初期化
 if 'generated_shoken' not in st.session_state:
     st.session_state.generated_shoken = None
@@ -37,6 +198,12 @@ if 'grade_level' not in st.session_state:
     st.session_state.grade_level = "低学年"
 if 'multiselect_key' not in st.session_state:
     st.session_state.multiselect_key = 0
+if 'engine' not in st.session_state:
+    st.session_state.engine = openai_client.ENGINE_AI
+if 'generated_engine' not in st.session_state:
+    st.session_state.generated_engine = openai_client.ENGINE_AI
+if 'reserve_shoken' not in st.session_state:
+    st.session_state.reserve_shoken = []
 
 # サイドバー
 with st.sidebar:
@@ -177,6 +344,37 @@ with st.sidebar:
             st.info("🔗 アプリのURLを設定すると、QRコードが表示されます")
             st.caption("`.streamlit/secrets.toml` の `APP_URL` にURLを設定してください")
     
+    # 生成結果キャッシュの利用状況（RESPONSE_CACHE を有効にした場合のみ）
+    response_cache = openai_client.get_response_cache()
+    if response_cache:
+        st.divider()
+        st.subheader("🗃️ 生成結果キャッシュ")
+        cache_stats = response_cache.stats()
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("ヒット率", f"{cache_stats['hit_rate']:.0%}")
+        with col2:
+            st.metric("保存件数", cache_stats['entries'])
+        st.caption(f"ヒット {cache_stats['hits']}回 / ミス {cache_stats['misses']}回")
+    
+    # 同じリクエストをまとめた回数（二度押しや、別の先生・セッションが同時に送った同じリクエストの分）
+    flight_stats = openai_client.get_single_flight().stats()
+    if flight_stats['coalesced']:
+        st.caption(f"🔁 同じリクエストを{flight_stats['coalesced']}回まとめて、APIの呼び出しを減らしました")
+    
+    # 文字数調整の状況（このプロセスで生成した分）
+    length_model = "stub" if config.get_generation_backend() == "stub" else config.get_openai_model()
+    length_stats = openai_client.get_length_controller(length_model).stats()
+    if length_stats['generations']:
+        st.divider()
+        st.subheader("📏 文字数の調整")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("±20文字以内", f"{length_stats['within_tolerance_rate']:.0%}")
+        with col2:
+            st.metric("追加の呼び出し", f"{length_stats['extra_calls_per_generation']:.2f}回/件")
+        st.caption(f"生成 {length_stats['generations']}件 / 追加の呼び出し {length_stats['extra_calls']}回")
+    
     st.divider()
     
     # 設定
@@ -198,6 +396,45 @@ with st.sidebar:
         help="生成する所見文の目標文字数"
     )
     st.session_state.character_count = character_count
+    
+    engine_labels = {
+        openai_client.ENGINE_AI: "AIで生成",
+        openai_client.ENGINE_TEMPLATE: "テンプレートで作成（すぐ・無料）",
+    }
+    generation_engine = st.radio(
+        "生成方法",
+        options=list(engine_labels),
+        format_func=engine_labels.get,
+        index=list(engine_labels).index(st.session_state.engine),
+        help="テンプレートはAPIを使わずに定型の文を組み合わせます。下書きをまとめて作る場合に便利です。"
+             "AIで生成できない場合（通信障害・利用上限）も自動でテンプレートに切り替わります。"
+    )
+    st.session_state.engine = generation_engine
+    
+    teacher_name = st.text_input(
+        "先生の名前",
+        placeholder="例: 山田",
+        key="teacher_name",
+        help="AIの利用量（トークン数）を先生ごとに数えるために使います。"
+             "入力しない場合は、名前を入力していない先生どうしで上限を共有します。"
+    )
+    
+    # 今日のAIの利用量（上限を設定した場合のみ）
+    budget = token_budget.get_budget()
+    budget_usage = [
+        item for item in budget.usage(teacher_name)
+        if item['limit'] and item['scope'] != token_budget.SCOPE_CLASS
+    ]
+    if budget_usage:
+        st.subheader("🎫 今日のAIの利用量")
+        for item in budget_usage:
+            used = item['used_tokens'] + item['reserved_tokens']
+            st.progress(
+                min(1.0, used / item['limit']),
+                text=f"{token_budget.SCOPE_LABELS[item['scope']]}: {used:,} / {item['limit']:,} トークン"
+            )
+        if any(budget.is_near(item) for item in budget_usage):
+            st.caption("上限に近づいているため、キャッシュした所見文や安いモデルを使って生成します。")
 
 # メインコンテンツ
 st.title("📝 通知表所見自動生成ツール")
@@ -206,18 +443,22 @@ st.caption("キーワードを入力して、自然な日本語の所見文を
 # 設定の検証
 is_valid, error_msg = config.validate_config()
 if not is_valid:
+    # APIが使えなくても、テンプレートで所見文を作れるようにする
     st.error(f"⚠️ {error_msg}")
-    st.info("💡 `.streamlit/secrets.toml` ファイルに `OPENAI_API_KEY` を設定してください。")
-    st.stop()
+    st.info("💡 `.streamlit/secrets.toml` ファイルに `OPENAI_API_KEY` を設定してください。設定するまではテンプレートで作成します。")
+    generation_engine = openai_client.ENGINE_TEMPLATE
+
+if config.get_generation_backend() == "stub":
+    st.warning("⚠️ 疑似バックエンドで生成しています（負荷試験用）。生成される文章はダミーです。")
 
 # タブ
-tab1, tab2 = st.tabs(["📝 所見を生成", "📋 保存した所見一覧"])
+tab1, tab2, tab3, tab4 = st.tabs(["📝 所見を生成", "📋 保存した所見一覧", "👥 クラス一括生成", "📊 生成の状況"])
 
 with tab1:
     st.header("所見を生成")
     
     # よく使うキーワードを取得
-    popular_keywords = db.get_popular_keywords(limit=15)
+    popular_keywords = query("get_popular_keywords", limit=15)
     popular_keyword_list = [kw['keyword'] for kw in popular_keywords]
     
     # プリセットキーワード
@@ -289,46 +530,35 @@ with tab1:
             st.warning("⚠️ キーワードを1つ以上選択してください")
         else:
             try:
-                # 進捗表示
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                
-                # ステップ1: キーワード解析
-                status_text.text("📝 キーワードを解析中...")
-                progress_bar.progress(20)
-                
-                # ステップ2: 文章生成
-                status_text.text("✍️ 文章を生成中...")
-                progress_bar.progress(50)
-                
-                # OpenAI API呼び出し
-                client = openai_client.OpenAIClient()
-                generated_text = client.generate_shoken(
+                # OpenAI API呼び出し（届いた文字から順に表示する）
+                client = openai_client.get_client(generation_engine)
+                stream = client.generate_shoken_stream(
                     selected_keywords,
                     st.session_state.character_count,
-                    st.session_state.grade_level
+                    st.session_state.grade_level,
+                    candidates=config.get_candidate_count(),
+                    class_name=class_name,
+                    teacher=teacher_name
                 )
+                stream_area = st.empty()
+                with stream_area.container(border=True):
+                    st.caption("✍️ 文章を生成中...")
+                    st.write_stream(stream)
                 
-                # ステップ3: 文字数調整
-                status_text.text("📏 文字数を調整中...")
-                progress_bar.progress(80)
-                
-                # ステップ4: 完成
-                status_text.text("✅ 完成しました！")
-                progress_bar.progress(100)
-                
-                st.session_state.generated_shoken = generated_text
+                # 文字数調整後の所見文を下の結果欄に表示する
+                stream_area.empty()
+                st.session_state.generated_shoken = stream.text
+                st.session_state.generated_engine = stream.engine
+                # 残りの候補は再生成の際に使う
+                st.session_state.reserve_shoken = stream.reserves
                 
                 # キーワード履歴を保存
                 db.add_keyword_history(selected_keywords)
                 
-                # 進捗バーを非表示
-                progress_bar.empty()
-                status_text.empty()
-                
             except Exception as e:
                 error_handler.handle_error(e, show_details=True)
                 st.session_state.generated_shoken = None
+                st.session_state.reserve_shoken = []
     
     # 生成結果の表示
     if st.session_state.generated_shoken:
@@ -338,6 +568,11 @@ with tab1:
         # 文字数表示
         char_count = len(st.session_state.generated_shoken)
         st.caption(f"文字数: {char_count}文字")
+        if st.session_state.generated_engine == openai_client.ENGINE_TEMPLATE:
+            if generation_engine == openai_client.ENGINE_AI:
+                st.info("📐 AIで生成できなかったため、テンプレートで作成しました。必要に応じて手直ししてください。")
+            else:
+                st.caption("📐 テンプレートで作成しました")
         
         # 所見文表示
         st.text_area(
@@ -365,7 +600,7 @@ with tab1:
                     
                     if 'class_name' in params:
                         # 新しいバージョン（class_nameパラメータあり）
-                        db.save_shoken(
+                        shoken_id = db.save_shoken(
                             student_name or "未設定",
                             st.session_state.keywords,
                             st.session_state.generated_shoken,
@@ -374,12 +609,13 @@ with tab1:
                         )
                     else:
                         # 古いバージョン（class_nameパラメータなし）
-                        db.save_shoken(
+                        shoken_id = db.save_shoken(
                             student_name or "未設定",
                             st.session_state.keywords,
                             st.session_state.generated_shoken,
                             char_count
                         )
+                    similarity_index.update([shoken_id])
                     st.success("✅ 保存しました！")
                     st.rerun()
                 except TypeError as e:
@@ -392,15 +628,165 @@ with tab1:
                     st.error("⚠️ 保存に失敗しました。エラー内容を確認してください。")
         
         with col3:
-            if st.button("🔄 再生成", use_container_width=True):
-                st.session_state.generated_shoken = None
+            reserve_count = len(st.session_state.reserve_shoken)
+            if st.button(
+                f"🔄 再生成（候補あと{reserve_count}件）" if reserve_count else "🔄 再生成",
+                use_container_width=True,
+                help="生成済みの別の候補に切り替えます。候補がない場合は、もう一度「所見を生成」を押してください。"
+            ):
+                # 残りの候補があればAPIを呼ばずに切り替える
+                if st.session_state.reserve_shoken:
+                    st.session_state.generated_shoken = st.session_state.reserve_shoken.pop(0)
+                else:
+                    st.session_state.generated_shoken = None
                 st.rerun()
 
 with tab2:
     st.header("保存した所見一覧")
     
     # クラス一覧を取得
-    all_classes = db.get_all_classes()
+    all_classes = query("get_all_classes")
+    
+    # 全文検索
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        search_query = st.text_input(
+            "🔍 所見を検索",
+            placeholder="例: 委員会活動",
+            help="所見文・児童名・キーワードから検索します。空白で区切ると、すべての語を含む所見を検索します。"
+        )
+    with col2:
+        search_class = st.selectbox(
+            "検索するクラス",
+            options=["すべて"] + all_classes,
+            key="search_class"
+        )
+    
+    if search_query.strip():
+        search_results = query(
+            "search_shoken",
+            search_query,
+            class_name=None if search_class == "すべて" else search_class,
+            limit=SEARCH_RESULT_LIMIT
+        )
+        
+        if not search_results:
+            st.info(f"🔍 「{search_query}」を含む所見は見つかりませんでした。")
+        else:
+            st.caption(f"🔍 「{search_query}」の検索結果: {len(search_results)}件（関連度順）")
+            for result in search_results:
+                shoken = result['shoken']
+                display_name = f"📝 {shoken.student_name}"
+                if shoken.class_name:
+                    display_name += f" ({shoken.class_name})"
+                display_name += f" - {shoken.created_at[:10]}"
+                
+                with st.expander(display_name):
+                    st.markdown(result['snippet'])
+                    st.divider()
+                    st.text_area(
+                        "所見文",
+                        value=shoken.content,
+                        height=150,
+                        key=f"search_shoken_{shoken.id}",
+                        label_visibility="collapsed"
+                    )
+        
+        st.divider()
+    
+    # 名簿・所見の一括取り込み
+    with st.expander("📤 名簿・所見をCSVから取り込む"):
+        st.caption("「児童名」列は必須です。「クラス」「キーワード」「所見文」列があれば一緒に取り込みます（エクスポートしたCSVも取り込めます）。")
+        roster_file = st.file_uploader("CSVファイル", type=["csv"], key="roster_file")
+        roster_class = st.text_input(
+            "クラス名（CSVにクラスがない行に使用）",
+            placeholder="例: 3年1組",
+            key="roster_class"
+        )
+        
+        if roster_file is not None:
+            try:
+                roster_records = database.parse_roster_csv(roster_file.getvalue(), roster_class)
+            except (ValueError, UnicodeDecodeError) as e:
+                st.error(f"⚠️ CSVを読み込めませんでした: {e}")
+                roster_records = []
+            
+            if roster_records:
+                # 所見文のない行は名簿として保存し、「クラス一括生成」で使う
+                roster_only = sum(1 for record in roster_records if not record['content'])
+                st.write(
+                    f"**{len(roster_records)}名分**を取り込みます"
+                    f"（所見 {len(roster_records) - roster_only}件・名簿のみ {roster_only}名）"
+                )
+                if st.button("📥 取り込む", key="roster_import"):
+                    try:
+                        similarity_index.update(db.import_roster(roster_records))
+                        st.success(f"✅ {len(roster_records)}名分を取り込みました！")
+                        st.rerun()
+                    except Exception as e:
+                        error_handler.handle_error(e, show_details=True)
+    
+    # 似ている所見のチェック
+    with st.expander("🔍 似ている所見をチェック"):
+        st.caption("ほとんど同じ文章になっている所見の組と、何人もの所見で使われている文を探します。")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            check_class = st.selectbox(
+                "チェックするクラス",
+                options=["すべて"] + all_classes,
+                key="similarity_class"
+            )
+        check_class_filter = None if check_class == "すべて" else check_class
+        with col2:
+            check_term = st.selectbox(
+                "学期",
+                options=["すべての期間"] + similarity_index.terms(check_class_filter),
+                key="similarity_term"
+            )
+        with col3:
+            check_threshold = st.slider(
+                "類似度の基準",
+                min_value=0.3,
+                max_value=0.9,
+                value=similarity.DEFAULT_THRESHOLD,
+                step=0.05,
+                key="similarity_threshold",
+                help="この値以上に似ている所見の組を表示します。小さくするほど多くの組が見つかります。"
+            )
+        
+        if st.button("🔍 チェックする", key="similarity_check"):
+            report = similarity_index.check(
+                class_name=check_class_filter,
+                term=None if check_term == "すべての期間" else check_term,
+                threshold=check_threshold
+            )
+            
+            if not report.checked:
+                st.info("📝 チェックする所見がありません。")
+            elif not report.pairs:
+                st.success(f"✅ {report.checked}件の所見をチェックしました。似ている所見は見つかりませんでした。")
+            else:
+                st.warning(f"⚠️ {report.checked}件の所見のうち、似ている組が{len(report.pairs)}組見つかりました。")
+            
+            for pair in report.pairs[:SIMILAR_PAIR_LIMIT]:
+                with st.container(border=True):
+                    names = [
+                        f"{shoken.student_name}（{shoken.class_name}）" if check_class_filter is None and shoken.class_name
+                        else shoken.student_name
+                        for shoken in (pair.first, pair.second)
+                    ]
+                    st.write(f"**{names[0]}** と **{names[1]}**（類似度 {pair.similarity:.0%}）")
+                    if pair.shared_sentences:
+                        st.write("ほとんど同じ文:")
+                        for sentence in pair.shared_sentences:
+                            st.markdown(f"- {sentence}")
+            if len(report.pairs) > SIMILAR_PAIR_LIMIT:
+                st.caption(f"類似度の高い{SIMILAR_PAIR_LIMIT}組を表示しています。")
+            
+            if report.repeated_sentences:
+                st.write("**何人もの所見で使われている文:**")
+                for sentence, found_in in report.repeated_sentences[:REPEATED_SENTENCE_LIMIT]:
+                    st.markdown(f"- {sentence}（{len(found_in)}人）")
     
     # 表示モードを選択
     display_mode = st.radio(
@@ -415,72 +801,60 @@ with tab2:
         if not all_classes:
             st.info("📝 クラス名が設定された所見がありません。所見を保存する際にクラス名を入力してください。")
         else:
-            # クラスごとの統計情報
-            class_stats = {}
-            all_shoken = db.get_all_shoken()
-            for shoken in all_shoken:
-                class_name = shoken.get('class_name', '') or 'クラス未設定'
-                if class_name not in class_stats:
-                    class_stats[class_name] = []
-                class_stats[class_name].append(shoken)
+            # クラスごとの統計情報（件数などはSQLで集計し、所見本体は読み込まない）
+            class_summaries = query("get_class_summaries")
             
             # クラスごとに表示
-            for class_name in sorted(class_stats.keys()):
-                class_shoken_list = class_stats[class_name]
+            for summary in class_summaries:
+                class_name = summary['class_name'] or 'クラス未設定'
                 
-                with st.expander(f"📚 {class_name} ({len(class_shoken_list)}件)", expanded=True):
+                with st.expander(f"📚 {class_name} ({summary['shoken_count']}件)", expanded=True):
                     # クラスごとの統計
-                    col1, col2 = st.columns(2)
+                    col1, col2, col3, col4 = st.columns(4)
                     with col1:
-                        st.metric("所見数", len(class_shoken_list))
+                        st.metric("所見数", summary['shoken_count'])
                     with col2:
-                        # CSVエクスポート
-                        import io
-                        import csv
-                        csv_buffer = io.StringIO()
-                        writer = csv.writer(csv_buffer)
-                        writer.writerow(["児童名", "クラス", "文字数", "作成日時", "所見文"])
-                        for shoken in class_shoken_list:
-                            writer.writerow([
-                                shoken['student_name'],
-                                shoken.get('class_name', ''),
-                                shoken['character_count'],
-                                shoken['created_at'],
-                                shoken['content']
-                            ])
-                        st.download_button(
-                            label=f"📥 {class_name}をCSVでエクスポート",
-                            data=csv_buffer.getvalue(),
-                            file_name=f"shoken_{class_name}.csv",
-                            mime="text/csv",
-                            key=f"export_{class_name}"
-                        )
+                        st.metric("児童数", summary['student_count'])
+                    with col3:
+                        st.metric("平均文字数", f"{summary['average_character_count']:.0f}")
+                    with col4:
+                        st.metric("最終更新", (summary['last_updated_at'] or '')[:10])
+                    
+                    # エクスポート（所見の一覧を読み込まずに作成できる）
+                    render_export(summary['class_name'], class_name, f"class_{class_name}")
+                    
+                    # 展開状態はスクリプトから取得できないため、
+                    # 所見の読み込みはトグルをオンにしたクラスだけに限定する
+                    if not st.toggle("📂 所見を表示", key=f"open_class_{class_name}"):
+                        continue
+                    
+                    class_shoken_list = query("get_shoken_by_class", summary['class_name'])
                     
                     st.divider()
                     
-                    # クラス内の所見を表示
-                    for shoken in sorted(class_shoken_list, key=lambda x: x['student_name']):
-                        with st.expander(f"📝 {shoken['student_name']} - {shoken['created_at'][:10]}", expanded=False):
-                            st.write(f"**キーワード:** {', '.join(shoken['keywords'])}")
-                            st.write(f"**文字数:** {shoken['character_count']}文字")
-                            st.write(f"**作成日時:** {shoken['created_at']}")
+                    # クラス内の所見を表示（児童名順に取得済み）
+                    for shoken in class_shoken_list:
+                        with st.expander(f"📝 {shoken.student_name} - {shoken.created_at[:10]}", expanded=False):
+                            st.write(f"**キーワード:** {', '.join(shoken.keywords)}")
+                            st.write(f"**文字数:** {shoken.character_count}文字")
+                            st.write(f"**作成日時:** {shoken.created_at}")
                             st.divider()
                             st.text_area(
                                 "所見文",
-                                value=shoken['content'],
+                                value=shoken.content,
                                 height=150,
-                                key=f"shoken_{shoken['id']}",
+                                key=f"shoken_{shoken.id}",
                                 label_visibility="collapsed"
                             )
                             
                             col1, col2 = st.columns(2)
                             with col1:
-                                if st.button("📋 コピー", key=f"copy_{shoken['id']}"):
-                                    st.write("```\n" + shoken['content'] + "\n```")
+                                if st.button("📋 コピー", key=f"copy_{shoken.id}"):
+                                    st.write("```\n" + shoken.content + "\n```")
                                     st.success("✅ コピーしました！")
                             with col2:
-                                if st.button("🗑️ 削除", key=f"delete_{shoken['id']}"):
-                                    db.delete_shoken(shoken['id'])
+                                if st.button("🗑️ 削除", key=f"delete_{shoken.id}"):
+                                    db.delete_shoken(shoken.id)
                                     st.success("✅ 削除しました！")
                                     st.rerun()
     else:
@@ -492,82 +866,267 @@ with tab2:
                 options=["すべて"] + all_classes,
                 help="クラスを選択すると、そのクラスの所見のみ表示されます"
             )
-            
-            if selected_class == "すべて":
-                shoken_list = db.get_all_shoken()
-            else:
-                shoken_list = db.get_shoken_by_class(selected_class)
         else:
             selected_class = "すべて"
-            shoken_list = db.get_all_shoken()
+        
+        # クラス指定時は児童名順、すべての場合は新しい順に1ページずつ取得
+        class_filter = None if selected_class == "すべて" else selected_class
+        list_order = "created" if class_filter is None else "student"
+        
+        # フィルタが変わったら1ページ目に戻す
+        if st.session_state.get('list_filter') != selected_class:
+            st.session_state.list_filter = selected_class
+            st.session_state.list_page_cursors = [None]
+        page_cursors = st.session_state.list_page_cursors
+        
+        shoken_list, next_cursor = query(
+            "get_shoken_page",
+            class_filter,
+            after=page_cursors[-1],
+            limit=LIST_PAGE_SIZE,
+            order=list_order
+        )
+        total_count = query("count_shoken", class_filter)
+        
+        # 削除などで表示中のページが空になった場合は1ページ目に戻す
+        if not shoken_list and len(page_cursors) > 1:
+            st.session_state.list_page_cursors = [None]
+            st.rerun()
         
         if not shoken_list:
             st.info("📝 まだ保存された所見がありません。所見を生成して保存してください。")
         else:
             # 統計情報を表示
             if selected_class != "すべて":
-                st.success(f"📊 {selected_class}: {len(shoken_list)}件の所見")
+                st.success(f"📊 {selected_class}: {total_count}件の所見")
             else:
-                st.caption(f"全{len(shoken_list)}件の所見が保存されています")
+                st.caption(f"全{total_count}件の所見が保存されています")
                 if all_classes:
                     st.caption(f"クラス数: {len(all_classes)}クラス")
             
-            # CSVエクスポート機能
-            if shoken_list:
-                import io
-                import csv
-                
-                csv_buffer = io.StringIO()
-                writer = csv.writer(csv_buffer)
-                writer.writerow(["児童名", "クラス", "文字数", "作成日時", "所見文"])
-                for shoken in shoken_list:
-                    writer.writerow([
-                        shoken['student_name'],
-                        shoken.get('class_name', ''),
-                        shoken['character_count'],
-                        shoken['created_at'],
-                        shoken['content']
-                    ])
-                
-                st.download_button(
-                    label="📥 CSVでエクスポート",
-                    data=csv_buffer.getvalue(),
-                    file_name=f"shoken_{selected_class if selected_class != 'すべて' else 'all'}.csv",
-                    mime="text/csv"
-                )
+            # エクスポート機能（フィルタに該当するすべての所見を出力）
+            render_export(
+                class_filter,
+                selected_class if selected_class != 'すべて' else 'all',
+                f"list_{selected_class}"
+            )
             
             st.divider()
             
             for shoken in shoken_list:
-                # クラス名を表示（後方互換性のため、キーの存在を確認）
-                display_name = f"📝 {shoken['student_name']}"
-                class_name = shoken.get('class_name', '')  # キーが存在しない場合は空文字列
+                # クラス名を表示
+                display_name = f"📝 {shoken.student_name}"
+                class_name = shoken.class_name
                 if class_name:
                     display_name += f" ({class_name})"
-                display_name += f" - {shoken['created_at'][:10]}"
+                display_name += f" - {shoken.created_at[:10]}"
                 
                 with st.expander(display_name):
                     if class_name:
                         st.write(f"**クラス:** {class_name}")
-                    st.write(f"**キーワード:** {', '.join(shoken['keywords'])}")
-                    st.write(f"**文字数:** {shoken['character_count']}文字")
-                    st.write(f"**作成日時:** {shoken['created_at']}")
+                    st.write(f"**キーワード:** {', '.join(shoken.keywords)}")
+                    st.write(f"**文字数:** {shoken.character_count}文字")
+                    st.write(f"**作成日時:** {shoken.created_at}")
                     st.divider()
                     st.text_area(
                         "所見文",
-                        value=shoken['content'],
+                        value=shoken.content,
                         height=150,
-                        key=f"shoken_{shoken['id']}",
+                        key=f"shoken_{shoken.id}",
                         label_visibility="collapsed"
                     )
                     
                     col1, col2 = st.columns(2)
                     with col1:
-                        if st.button("📋 コピー", key=f"copy_{shoken['id']}"):
-                            st.write("```\n" + shoken['content'] + "\n```")
+                        if st.button("📋 コピー", key=f"copy_{shoken.id}"):
+                            st.write("```\n" + shoken.content + "\n```")
                             st.success("✅ コピーしました！")
                     with col2:
-                        if st.button("🗑️ 削除", key=f"delete_{shoken['id']}"):
-                            db.delete_shoken(shoken['id'])
+                        if st.button("🗑️ 削除", key=f"delete_{shoken.id}"):
+                            db.delete_shoken(shoken.id)
                             st.success("✅ 削除しました！")
                             st.rerun()
+            
+            # ページ送り
+            page_number = len(page_cursors)
+            page_count = max(1, -(-total_count // LIST_PAGE_SIZE))
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col1:
+                if st.button("◀ 前へ", disabled=page_number == 1, use_container_width=True):
+                    page_cursors.pop()
+                    st.rerun()
+            with col2:
+                st.caption(f"{page_number} / {page_count} ページ")
+            with col3:
+                if st.button("次へ ▶", disabled=next_cursor is None, use_container_width=True):
+                    page_cursors.append(next_cursor)
+                    st.rerun()
+
+with tab3:
+    st.header("クラス一括生成")
+    st.caption("クラス全員分の所見をまとめて生成します。学年と文字数はサイドバーの設定を使います。")
+    
+    batch_class_name = st.text_input(
+        "クラス名（学年・組）",
+        placeholder="例: 3年1組",
+        key="batch_class_name"
+    )
+    batch_roster = query("get_roster", batch_class_name.strip()) if batch_class_name.strip() else []
+    if batch_roster and st.button(f"📋 名簿から{len(batch_roster)}人の児童名を入れる", key="batch_from_roster"):
+        # text_area より前なので、ウィジェットの値をここで書き換えられる
+        st.session_state["batch_text"] = "\n".join(
+            f"{student['student_name']}: {'、'.join(student['keywords'])}" for student in batch_roster
+        )
+    batch_text = st.text_area(
+        "児童名とキーワード（1行に1人）",
+        placeholder="山田太郎: 積極的、協調性\n佐藤花子: 思いやり、責任感",
+        height=200,
+        help="「児童名: キーワード1、キーワード2」の形式で入力してください。Excelから2列を貼り付けることもできます。",
+        key="batch_text"
+    )
+    batch_requests = parse_batch_lines(batch_text)
+    no_keywords = [request['student_name'] for request in batch_requests if not request['keywords']]
+    
+    if no_keywords:
+        st.warning(f"⚠️ キーワードがない児童がいます: {', '.join(no_keywords)}")
+    
+    if st.button(
+        f"🎯 {len(batch_requests)}人分の所見を一括生成",
+        type="primary",
+        disabled=not batch_requests or bool(no_keywords),
+        use_container_width=True
+    ):
+        progress_bar = st.progress(0)
+        status_text = st.empty()
+        
+        def show_batch_progress(completed, total, result):
+            """1人分終わるごとに進捗を表示"""
+            progress_bar.progress(completed / total)
+            status_text.text(f"✍️ {completed}/{total}人 完了（{result.request['student_name']}）")
+        
+        try:
+            client = openai_client.get_client(generation_engine)
+            st.session_state.batch_results = client.generate_shoken_batch(
+                batch_requests,
+                st.session_state.character_count,
+                st.session_state.grade_level,
+                progress_callback=show_batch_progress,
+                class_name=batch_class_name,
+                teacher=teacher_name
+            )
+            
+            # キーワード履歴を保存（まとめて1回）
+            db.add_keyword_history([kw for request in batch_requests for kw in request['keywords']])
+        except Exception as e:
+            error_handler.handle_error(e, show_details=True)
+        
+        progress_bar.empty()
+        status_text.empty()
+    
+    # 一括生成の結果の表示
+    batch_results = st.session_state.get('batch_results')
+    if batch_results:
+        st.divider()
+        succeeded = [result for result in batch_results if result.ok]
+        failed = [result for result in batch_results if not result.ok]
+        
+        st.success(f"✅ {len(succeeded)}人分の所見を生成しました")
+        templated = [result for result in succeeded if result.engine == openai_client.ENGINE_TEMPLATE]
+        if templated and generation_engine == openai_client.ENGINE_AI:
+            st.info(f"📐 {len(templated)}人分はAIで生成できなかったため、テンプレートで作成しました。")
+        if failed:
+            st.warning(f"⚠️ {len(failed)}人分の生成に失敗しました。もう一度お試しください。")
+            for result in failed:
+                error_msg, _ = error_handler.get_user_friendly_error(result.error)
+                st.caption(f"{result.request['student_name']}: {error_msg}")
+        
+        for result in succeeded:
+            template_mark = "📐" if result.engine == openai_client.ENGINE_TEMPLATE else "📝"
+            with st.expander(f"{template_mark} {result.request['student_name']}（{len(result.text)}文字）"):
+                st.write(f"**キーワード:** {', '.join(result.request['keywords'])}")
+                st.write(result.text)
+        
+        if succeeded and st.button("💾 まとめて保存", use_container_width=True):
+            try:
+                shoken_ids = db.save_shoken_many([
+                    {
+                        'student_name': result.request['student_name'],
+                        'class_name': batch_class_name,
+                        'keywords': result.request['keywords'],
+                        'content': result.text,
+                        'character_count': len(result.text)
+                    }
+                    for result in succeeded
+                ])
+                similarity_index.update(shoken_ids)
+                st.session_state.batch_results = None
+                st.success(f"✅ {len(succeeded)}人分を保存しました！")
+                st.rerun()
+            except Exception as e:
+                error_handler.handle_error(e, show_details=True)
+                st.error("⚠️ 保存に失敗しました。エラー内容を確認してください。")
+
+with tab4:
+    st.header("生成の状況")
+    st.caption("所見文の生成にかかった時間・トークン数・料金の目安です。料金はモデルごとの単価表から計算した目安です。")
+    
+    metrics_days = st.selectbox(
+        "集計する期間",
+        options=METRICS_PERIODS,
+        format_func=lambda days: f"直近{days}日",
+        key="metrics_days"
+    )
+    summary, daily, class_costs = load_generation_metrics(metrics_days)
+    
+    if not summary['count']:
+        st.info("📝 この期間の生成の記録はありません。")
+    else:
+        def format_ms(value):
+            """ミリ秒を秒の表示にする"""
+            return "-" if value is None else f"{value / 1000:.1f}秒"
+        
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("生成回数", f"{summary['count']}回")
+        col2.metric("応答時間（中央値）", format_ms(summary['latency_p50']))
+        col3.metric("応答時間（遅い方から5%）", format_ms(summary['latency_p95']))
+        col4.metric("最初の文字まで（中央値）", format_ms(summary['first_token_p50']))
+        
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric(
+            "1件あたりのトークン数",
+            "-" if summary['tokens_per_shoken'] is None else f"{summary['tokens_per_shoken']:.0f}"
+        )
+        col2.metric("キャッシュ利用率", f"{summary['cache_hits'] / summary['count']:.0%}")
+        col3.metric("再試行・エラー", f"{summary['retries']}回・{summary['errors']}回")
+        col4.metric("料金の目安", f"${summary['cost']:.2f}")
+        
+        st.subheader("日ごとの推移")
+        dates = [day['date'] for day in daily]
+        st.line_chart(
+            {
+                "日付": dates,
+                "応答時間（中央値・秒）": [(day['latency_p50'] or 0) / 1000 for day in daily],
+                "応答時間（遅い方から5%・秒）": [(day['latency_p95'] or 0) / 1000 for day in daily],
+            },
+            x="日付"
+        )
+        st.line_chart(
+            {
+                "日付": dates,
+                "1件あたりのトークン数": [day['tokens_per_shoken'] or 0 for day in daily],
+            },
+            x="日付"
+        )
+        
+        if class_costs:
+            st.subheader("クラスごとの料金の目安（米ドル）")
+            chart_data = {"日付": dates}
+            for cost_class, by_date in sorted(class_costs.items()):
+                chart_data[cost_class] = [by_date.get(date, 0.0) for date in dates]
+            st.bar_chart(chart_data, x="日付")
+        
+        if summary['length_outcomes']:
+            st.subheader("文字数の調整")
+            for outcome, label in metrics.LENGTH_OUTCOME_LABELS.items():
+                if outcome in summary['length_outcomes']:
+                    st.write(f"- {label}: {summary['length_outcomes'][outcome]}回")
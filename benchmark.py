@@ -0,0 +1,758 @@
+"""
+ベンチマークスクリプト
+データベースアクセスなどの性能を計測する
+
+使い方:
+    python benchmark.py
+"""
+
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import candidate_ranker
+import database
+import metrics
+import openai_client
+import prompt_templates
+import rate_limiter
+import similarity
+import template_generator
+import token_budget
+from generation_backends import StubBackend
+
+
+class PerCallDatabase(database.Database):
+    """比較用：呼び出しごとに接続を作成する（従来の方式）"""
+
+    def get_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = DELETE")
+        return conn
+
+
+class NumberedStubBackend(StubBackend):
+    """比較用：呼び出しごとに番号を付けた文章を返す（生成がまとめられると同じ番号の文章になる）"""
+    
+    calls = 0
+    
+    def _respond(self, messages: List[Dict], max_tokens: int, n: int):
+        completion = super()._respond(messages, max_tokens, n)
+        with self._lock:
+            self.calls += 1
+            completion.text = f"（{self.calls}）{completion.text}"
+        return completion
+
+
+def _app_client(backend, **kwargs) -> openai_client.AsyncClientAdapter:
+    """
+    アプリと同じ種類のクライアント（get_client() が返すもの）を、APIの代わりに backend で作成
+    
+    共有イベントループ・非同期クライアントを通るため、APIの呼び出し以外は本番と同じ処理を計測する。
+    """
+    return openai_client.AsyncClientAdapter(openai_client.AsyncOpenAIClient(backend=backend, **kwargs))
+
+
+def _timeit(func: Callable[[], object], repeat: int) -> float:
+    """funcをrepeat回実行し、1回あたりの平均時間（ミリ秒）を返す"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _fill(db: database.Database, rows: int):
+    """ダミーの所見を登録"""
+    for i in range(rows):
+        db.save_shoken(
+            f"児童{i:04d}",
+            ["積極的", "協調性"],
+            "明るく元気に学校生活を送っています。" * 5,
+            90,
+            f"{i % 6 + 1}年{i % 3 + 1}組"
+        )
+
+
+def bench_connections(rows: int = 500, repeat: int = 200) -> Dict[str, Dict[str, float]]:
+    """
+    呼び出しごとの接続と、スレッドごとに使い回す接続（WAL）を比較
+
+    Args:
+        rows: 事前に登録する所見の件数
+        repeat: 計測の繰り返し回数
+
+    Returns:
+        {方式: {操作: 平均ミリ秒}}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for label, cls in (("per-call", PerCallDatabase), ("pooled", database.Database)):
+            db = cls(os.path.join(tmpdir, f"{label}.db"))
+            _fill(db, rows)
+            results[label] = {
+                "get_all_shoken": _timeit(db.get_all_shoken, repeat),
+                "save_shoken": _timeit(
+                    lambda: db.save_shoken("計測", ["集中力"], "計測用の所見です。", 9, "計測"),
+                    repeat
+                ),
+            }
+            db.close()
+    return results
+
+
+def bench_bulk_save(rows: int = 1000) -> Dict[str, float]:
+    """
+    1件ずつの保存（save_shoken）と一括保存（save_shoken_many）を比較
+
+    Args:
+        rows: 保存する所見の件数
+
+    Returns:
+        {方式: 全件の保存にかかったミリ秒}
+    """
+    records = [
+        {
+            'student_name': f"児童{i:04d}",
+            'class_name': f"{i % 6 + 1}年1組",
+            'keywords': ["積極的", "協調性"],
+            'content': "明るく元気に学校生活を送っています。",
+        }
+        for i in range(rows)
+    ]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = database.Database(os.path.join(tmpdir, "bulk.db"))
+        results["save_shoken x1"] = _timeit(
+            lambda: [
+                db.save_shoken(r['student_name'], r['keywords'], r['content'],
+                               len(r['content']), r['class_name'])
+                for r in records
+            ],
+            1
+        )
+        results["save_shoken_many"] = _timeit(lambda: db.save_shoken_many(records), 1)
+        db.close()
+    return results
+
+
+# 検索ベンチマーク用の文章の部品
+_PHRASES = [
+    "委員会活動では高学年としての自覚を持って取り組みました。",
+    "算数のグラフの学習に意欲的に取り組んでいます。",
+    "掃除の時間には隅々まで丁寧に行っています。",
+    "友達に優しく声をかける姿が見られます。",
+    "理科の観察では気づいたことを詳しく記録しています。",
+    "給食当番の仕事に責任感を持って取り組んでいます。",
+    "音読では表現を工夫して読むことができました。",
+    "今後も持ち前の明るさを活かしてほしいと願っています。",
+]
+
+
+def _fill_bulk(db: database.Database, rows: int, seed: int = 0):
+    """ダミーの所見を1トランザクションでまとめて登録"""
+    rng = random.Random(seed)
+    now = "2024-07-01T00:00:00"
+    records = [
+        (
+            f"児童{i:06d}",
+            f"{i % 6 + 1}年{i % 4 + 1}組",
+            json.dumps(rng.sample(["積極的", "協調性", "責任感", "思いやり"], 2), ensure_ascii=False),
+            "".join(rng.sample(_PHRASES, 4)),
+            200,
+            now,
+            now,
+        )
+        for i in range(rows)
+    ]
+    with db.transaction() as cursor:
+        cursor.executemany("""
+            INSERT INTO shoken
+            (student_name, class_name, keywords, content, character_count, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, records)
+
+
+def bench_search(rows: int = 100_000, repeat: int = 20) -> Dict[str, float]:
+    """
+    全文検索（search_shoken）の速度を計測
+
+    Args:
+        rows: 登録する所見の件数
+        repeat: 計測の繰り返し回数
+
+    Returns:
+        {検索語: 平均ミリ秒}
+    """
+    queries = ["委員会活動", "グラフの学習 丁寧", "掃除", "存在しない語句"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = database.Database(os.path.join(tmpdir, "search.db"))
+        _fill_bulk(db, rows)
+        results = {
+            query: _timeit(lambda: db.search_shoken(query, limit=20), repeat)
+            for query in queries
+        }
+        results["委員会活動（クラス指定）"] = _timeit(
+            lambda: db.search_shoken("委員会活動", class_name="6年2組", limit=20), repeat
+        )
+        db.close()
+    return results
+
+
+def bench_similarity(rows: int = 1200) -> Dict[str, float]:
+    """
+    類似度チェック（SimilarityIndex.check）の速度を計測
+
+    Args:
+        rows: 学校全体の所見の件数（12クラスに分かれる）
+
+    Returns:
+        {段階: ミリ秒}
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = database.Database(os.path.join(tmpdir, "similarity.db"))
+        _fill_bulk(db, rows)
+        index = similarity.SimilarityIndex(db)
+        
+        start = time.perf_counter()
+        index.update()
+        signature_ms = (time.perf_counter() - start) * 1000
+        
+        class_name = db.get_all_classes()[0]
+        class_size = db.count_shoken(class_name)
+        results = {
+            f"シグネチャの計算（{rows:,}件、合計）": signature_ms,
+            "保存1件分のシグネチャ更新": _timeit(
+                lambda: index.update(db.save_shoken_many([{'content': "新しい所見です。" * 20}])), 20
+            ),
+            f"クラスのチェック（{class_size}件）": _timeit(lambda: index.check(class_name), 20),
+            f"学校全体のチェック（{db.count_shoken():,}件）": _timeit(lambda: index.check(), 3),
+        }
+        db.close()
+    return results
+
+
+def bench_metrics(rows: int = 10_000) -> Dict[str, float]:
+    """
+    生成の記録（MetricsWriter）の速度を計測
+    
+    生成のたびにかかるのはキューに入れる時間だけで、書き込みは別スレッドで行う。
+    
+    Args:
+        rows: 記録の件数
+        
+    Returns:
+        {段階: ミリ秒}
+    """
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = database.Database(os.path.join(tmpdir, "metrics.db"))
+        writer = metrics.MetricsWriter(db)
+        
+        def generate(i):
+            with writer.track("gpt-4o-mini", f"{i % 12 + 1}年1組") as record:
+                record.add_usage(rng.randint(300, 500), rng.randint(200, 400))
+                record.length_outcome = rng.choice(list(metrics.LENGTH_OUTCOME_LABELS))
+        
+        start = time.perf_counter()
+        for i in range(rows):
+            generate(i)
+        track_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        writer.flush()
+        flush_ms = (time.perf_counter() - start) * 1000
+        
+        since = metrics.since(1)
+        results = {
+            "生成1回分の記録（キューに入れるまで）": track_ms / rows,
+            f"書き込みの完了待ち（{rows:,}件）": flush_ms,
+            f"読み込み（{rows:,}件）": _timeit(lambda: db.get_generation_metrics(since), 5),
+            f"集計（{rows:,}件）": _timeit(
+                lambda: metrics.summarize(db.get_generation_metrics(since)), 5
+            ),
+        }
+        db.close()
+    return results
+
+
+def bench_token_budget(threads: int = 8, requests: int = 50, tokens: int = 1000) -> Dict[str, float]:
+    """
+    トークン予算の予約・精算の速度と、同時に予約した場合に上限を超えないかを計測
+    
+    Args:
+        threads: 同時に予約するスレッド数
+        requests: 1スレッドあたりの予約の回数
+        tokens: 1回に予約するトークン数
+        
+    Returns:
+        {"予約と精算（1回あたりのミリ秒）": ミリ秒, "予約できた回数": 回数,
+         "予約できた合計": トークン数, "上限": トークン数}
+    """
+    limit = threads * requests * tokens // 2
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = database.Database(os.path.join(tmpdir, "budget.db"))
+        budget = token_budget.TokenBudget(db, teacher_limit=10 ** 12, class_limit=10 ** 12)
+        
+        def reserve_and_settle():
+            budget.settle(budget.reserve("先生", "3年1組", tokens), tokens // 2)
+        
+        per_call_ms = _timeit(reserve_and_settle, 200)
+        db.close()
+        
+        # 全体の上限を半分の回数分にして、同時に予約する（精算はしない）
+        db = database.Database(os.path.join(tmpdir, "budget_concurrent.db"))
+        budget = token_budget.TokenBudget(db, daily_limit=limit, wait_seconds=0)
+        reserved = []
+        
+        def worker(index: int):
+            for _ in range(requests):
+                try:
+                    reserved.append(budget.reserve(f"先生{index}", "", tokens))
+                except token_budget.BudgetExceededError:
+                    pass
+        
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        db.close()
+    
+    return {
+        "予約と精算（1回あたりのミリ秒）": per_call_ms,
+        "予約できた回数": len(reserved),
+        "予約できた合計": sum(reservation.tokens for reservation in reserved),
+        "上限": limit,
+    }
+
+
+def bench_single_flight(sessions: int = 20, latency: float = 0.2) -> Dict[str, float]:
+    """
+    同じリクエストを同時に送った場合に、生成が1回にまとまるかを計測
+    
+    疑似バックエンドを使い、sessions 人が同じキーワードで同時に生成する。
+    ストリーミングでは、二度押しを想定して1回目を途中で読むのをやめてから
+    同じリクエストをもう一度送る。一括生成では、同じキーワードの児童が
+    まとめられずに別々の所見文になるかを確認する。
+    
+    Args:
+        sessions: 同時に生成するセッション数（一括生成の児童の数）
+        latency: 疑似バックエンドの応答時間（秒）
+    
+    Returns:
+        {"リクエスト": 回数, "生成": 実際に生成した回数（生成の記録の件数）,
+         "所要秒数": 秒, "二度押しの生成": 二度押しで生成した回数,
+         "一括生成の所見文の種類": 同じキーワードの児童 sessions 人分の所見文の種類}
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = database.Database(os.path.join(tmpdir, "single_flight.db"))
+        writer = metrics.MetricsWriter(db)
+        client = _app_client(
+            StubBackend(latency=latency, stream_interval=0.01, model="stub-single-flight"),
+            metrics_writer=writer, budget=token_budget.TokenBudget(db)
+        )
+        
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            texts = list(executor.map(
+                lambda _: client.generate_shoken(["同時", "人気のキーワード"], 200, "中学年"), range(sessions)
+            ))
+        seconds = time.perf_counter() - start
+        writer.flush()
+        generations = db.get_connection().execute("SELECT COUNT(*) FROM generation_metrics").fetchone()[0]
+        
+        first = iter(client.generate_shoken_stream(["二度押し"], 200, "中学年"))
+        next(first)
+        first.close()
+        second = client.generate_shoken_stream(["二度押し"], 200, "中学年")
+        "".join(second)
+        writer.flush()
+        double_submit = db.get_connection().execute(
+            "SELECT COUNT(*) FROM generation_metrics WHERE streamed = 1"
+        ).fetchone()[0]
+        
+        # キャッシュの候補の数を児童の数にして、キャッシュによる使い回しも起きないようにする
+        batch_client = _app_client(
+            NumberedStubBackend(latency=latency, model="stub-single-flight-batch"),
+            cache=openai_client.ResponseCache(db, variants=sessions),
+            metrics_writer=writer, budget=token_budget.TokenBudget(db)
+        )
+        results = batch_client.generate_shoken_batch(
+            [{'student_name': f"児童{i}", 'keywords': ["積極的", "協調性"]} for i in range(sessions)],
+            200, "中学年", class_name="3年1組"
+        )
+        writer.flush()
+        db.close()
+    
+    if len(set(texts)) != 1:
+        raise AssertionError("同じリクエストの結果が共有されていません")
+    return {"リクエスト": sessions, "生成": generations, "所要秒数": seconds, "二度押しの生成": double_submit,
+            "一括生成の所見文の種類": len({result.text for result in results})}
+
+
+# OpenAIのプロンプトキャッシュが効く先頭部分の最小トークン数
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+
+def _common_prefix(texts: List[str]) -> str:
+    """すべてのテキストに共通する先頭部分"""
+    return os.path.commonprefix(texts)
+
+
+def bench_prompts(repeat: int = 2000) -> Dict[int, Dict[str, float]]:
+    """
+    プロンプトテンプレートのバージョンごとのトークン数と組み立て時間を比較
+    
+    Args:
+        repeat: 組み立て時間の計測の繰り返し回数
+        
+    Returns:
+        {バージョン: {"prompt_tokens": 1回あたりの平均プロンプトトークン数,
+                      "shared_prefix_tokens": 全呼び出しで共通の先頭部分のトークン数,
+                      "grade_prefix_tokens": 同じ学年の呼び出しで共通の先頭部分のトークン数（最小）,
+                      "render_us": 1回あたりの組み立て時間（マイクロ秒）}}
+    """
+    rng = random.Random(0)
+    keyword_pool = ["積極的", "協調性", "責任感", "思いやり", "集中力", "リーダーシップ", "丁寧"]
+    samples = [
+        (grade_level, rng.sample(keyword_pool, rng.randint(1, 4)), rng.choice([100, 150, 200, 300]))
+        for grade_level in ("低学年", "中学年", "高学年")
+        for _ in range(20)
+    ]
+    
+    def serialize(messages: List[Dict]) -> str:
+        return "".join(message["content"] for message in messages)
+    
+    results = {}
+    for version in prompt_templates.TEMPLATES:
+        rendered = [
+            (grade_level, prompt_templates.compile_prompt(grade_level, version).render(keywords, length))
+            for grade_level, keywords, length in samples
+        ]
+        tokens = [prompt_templates.count_message_tokens(messages) for _, messages in rendered]
+        shared_prefix = _common_prefix([serialize(messages) for _, messages in rendered])
+        grade_prefixes = [
+            _common_prefix([serialize(messages) for grade, messages in rendered if grade == grade_level])
+            for grade_level in ("低学年", "中学年", "高学年")
+        ]
+        grade_level, keywords, length = samples[0]
+        results[version] = {
+            "prompt_tokens": sum(tokens) / len(tokens),
+            "shared_prefix_tokens": prompt_templates.count_tokens(shared_prefix),
+            "grade_prefix_tokens": min(prompt_templates.count_tokens(prefix) for prefix in grade_prefixes),
+            "render_us": _timeit(
+                lambda: prompt_templates.compile_prompt(grade_level, version).render(keywords, length),
+                repeat
+            ) * 1000,
+        }
+    return results
+
+
+class _RateLimited(Exception):
+    """比較用：レート制限のエラー（429・Retry-After 付き）"""
+    
+    status_code = 429
+    
+    def __init__(self, retry_after: float):
+        super().__init__("rate limit exceeded")
+        self.response = SimpleNamespace(headers={"retry-after": str(retry_after)})
+
+
+class _QuotaServer:
+    """比較用：1秒あたりのリクエスト数を超えると429を返す疑似API"""
+    
+    def __init__(self, per_second: int, latency: float):
+        self.per_second = per_second
+        self.latency = latency
+        self._accepted: List[float] = []
+        self._lock = threading.Lock()
+    
+    def request(self) -> str:
+        with self._lock:
+            now = time.monotonic()
+            self._accepted = [t for t in self._accepted if now - t < 1.0]
+            if len(self._accepted) >= self.per_second:
+                raise _RateLimited(retry_after=1.0 - (now - self._accepted[0]))
+            self._accepted.append(now)
+        time.sleep(self.latency)
+        return "ok"
+
+
+def bench_rate_limit(requests: int = 120, per_second: int = 40, workers: int = 30,
+                     latency: float = 0.05) -> Dict[str, Dict[str, float]]:
+    """
+    多数の先生が同時に生成した場合の、スケジューラの有無による違いを比較
+    
+    Args:
+        requests: リクエストの総数
+        per_second: 疑似APIの1秒あたりの上限
+        workers: 同時に送るスレッド数（同時に操作する先生の数）
+        latency: 疑似APIの応答時間（秒）
+        
+    Returns:
+        {方式: {"ok": 成功数, "failed": 失敗数, "seconds": 所要秒数, "throughput": 成功数/秒}}
+    """
+    def run(send: Callable[[], str]) -> Dict[str, float]:
+        def one(_):
+            try:
+                return send()
+            except _RateLimited:
+                return None
+        
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(one, range(requests)))
+        seconds = time.perf_counter() - start
+        ok = sum(1 for result in results if result)
+        return {"ok": ok, "failed": requests - ok, "seconds": seconds, "throughput": ok / seconds}
+    
+    direct = _QuotaServer(per_second, latency)
+    scheduled = _QuotaServer(per_second, latency)
+    scheduler = rate_limiter.RateLimitScheduler(per_second * 60, 10 ** 9)
+    return {
+        "スケジューラなし": run(direct.request),
+        "スケジューラあり": run(lambda: scheduler.call(scheduled.request, 1)),
+    }
+
+
+def bench_end_to_end(students: int = 40, latency: float = 0.2, error_rate: float = 0.05,
+                     workers: int = openai_client.DEFAULT_BATCH_WORKERS) -> Dict[str, Dict[str, float]]:
+    """
+    疑似バックエンドを使い、APIを呼ばずに所見1件の生成から保存までの各段階を計測
+    
+    get_client() が返すのと同じクライアント（共有イベントループ上の非同期クライアント）を
+    使うため、APIの呼び出し以外（プロンプトの組み立て・文字数調整・キャッシュ・保存）は
+    本番と同じ処理を通る。
+    
+    Args:
+        students: 生成する児童の数
+        latency: まとめて生成する場合の疑似バックエンドの応答時間（秒）
+        error_rate: まとめて生成する場合の疑似バックエンドのエラーの割合
+        workers: まとめて生成する場合の同時実行数
+        
+    Returns:
+        {"段階": {段階: 1件あたりのミリ秒},
+         "まとめて生成": {"ok": 成功数, "template": うちテンプレートで組み立てた数,
+                         "failed": 失敗数, "seconds": 所要秒数, "throughput": 成功数/秒}}
+    """
+    rng = random.Random(0)
+    keyword_pool = ["積極的", "協調性", "責任感", "思いやり", "集中力", "リーダーシップ", "丁寧"]
+    requests = [
+        {'student_name': f"児童{i:03d}", 'keywords': rng.sample(keyword_pool, 3) + [f"観点{i}"]}
+        for i in range(students)
+    ]
+    
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = database.Database(os.path.join(tmpdir, "e2e.db"))
+        backend = StubBackend()
+        # 生成の記録・トークン予算も一時ファイルのデータベースに書き込む
+        writer = metrics.MetricsWriter(db)
+        budget = token_budget.TokenBudget(db)
+        client = _app_client(
+            backend, cache=openai_client.ResponseCache(db), metrics_writer=writer, budget=budget
+        )
+        
+        keywords = requests[0]['keywords']
+        stages["プロンプト組み立て"] = _timeit(
+            lambda: prompt_templates.compile_prompt("中学年").render(keywords, 200), 1000
+        )
+        messages = prompt_templates.compile_prompt("中学年").render(keywords, 200)
+        stages["疑似バックエンド"] = _timeit(lambda: backend.complete(messages, 400, 0.8), 200)
+        
+        texts = []
+        start = time.perf_counter()
+        for request in requests:
+            texts.append(client.generate_shoken(request['keywords'], 200, "中学年"))
+        total_ms = (time.perf_counter() - start) / students * 1000
+        # クライアント内の処理（文字数調整・キャッシュの参照と保存）にかかった時間
+        stages["生成（API以外）"] = total_ms - stages["疑似バックエンド"]
+        stages["候補の順位付け（3件）"] = _timeit(
+            lambda: candidate_ranker.rank_candidates(texts[:3], 200), 1000
+        )
+        stages["キャッシュから取得"] = _timeit(
+            lambda: client.generate_shoken(keywords, 200, "中学年"), 200
+        )
+        
+        records = [
+            {'student_name': request['student_name'], 'class_name': "3年1組",
+             'keywords': request['keywords'], 'content': text}
+            for request, text in zip(requests, texts)
+        ]
+        stages["保存（1件ずつ）"] = _timeit(
+            lambda: [
+                db.save_shoken(r['student_name'], r['keywords'], r['content'],
+                               len(r['content']), r['class_name'])
+                for r in records
+            ],
+            1
+        ) / students
+        stages["保存（一括）"] = _timeit(lambda: db.save_shoken_many(records), 1) / students
+        
+        batch_client = _app_client(
+            StubBackend(latency=latency, error_rate=error_rate, length_jitter=0.2, seed=1),
+            cache=openai_client.ResponseCache(db),
+            metrics_writer=writer,
+            budget=budget
+        )
+        batch_requests = [
+            {'student_name': request['student_name'], 'keywords': request['keywords'] + ["まとめて"]}
+            for request in requests
+        ]
+        start = time.perf_counter()
+        results = batch_client.generate_shoken_batch(batch_requests, 200, "中学年", max_workers=workers)
+        seconds = time.perf_counter() - start
+        writer.flush()
+        db.close()
+    
+    ok = sum(1 for result in results if result.ok)
+    templated = sum(1 for result in results if result.engine == openai_client.ENGINE_TEMPLATE)
+    stages["テンプレートで組み立て"] = _timeit(
+        lambda: template_generator.generate_shoken(keywords, 200, "中学年"), 1000
+    )
+    return {
+        "段階": stages,
+        "まとめて生成": {"ok": ok, "template": templated, "failed": students - ok,
+                         "seconds": seconds, "throughput": ok / seconds},
+    }
+
+
+def _row_to_dict(row: sqlite3.Row) -> Dict:
+    """比較用：従来の行ごとの辞書への変換"""
+    return {
+        'id': row['id'],
+        'student_name': row['student_name'],
+        'class_name': row['class_name'] if row['class_name'] else "",
+        'keywords': json.loads(row['keywords']) if row['keywords'] else [],
+        'content': row['content'],
+        'character_count': row['character_count'],
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at']
+    }
+
+
+def bench_records(rows: int = 50_000) -> Dict[str, Dict[str, float]]:
+    """
+    行ごとの辞書と ShokenRecord のメモリ使用量・変換速度を比較
+
+    Args:
+        rows: 変換する行数
+
+    Returns:
+        {方式: {"ms": 変換にかかったミリ秒, "MiB": 保持に必要なメモリ}}
+    """
+    converters = {
+        "dict": _row_to_dict,
+        "ShokenRecord": database.ShokenRecord.from_row,
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = database.Database(os.path.join(tmpdir, "records.db"))
+        _fill_bulk(db, rows)
+        fetched = db.get_connection().execute(
+            f"SELECT {database.SHOKEN_COLUMNS} FROM shoken"
+        ).fetchall()
+        
+        for label, convert in converters.items():
+            tracemalloc.start()
+            start = time.perf_counter()
+            converted = [convert(row) for row in fetched]
+            elapsed = (time.perf_counter() - start) * 1000
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[label] = {"ms": elapsed, "MiB": size / 1024 / 1024}
+            del converted
+        db.close()
+    return results
+
+
+def main():
+    # 結果が正しくない計測（上限を超えた予約など）
+    failures = []
+    
+    print("== 接続方式の比較（1回あたりのミリ秒） ==")
+    for label, timings in bench_connections().items():
+        line = ", ".join(f"{name}: {ms:.3f}ms" for name, ms in timings.items())
+        print(f"{label:>10}: {line}")
+    
+    print("== 一括保存（1,000件、合計ミリ秒） ==")
+    for label, ms in bench_bulk_save().items():
+        print(f"{label:>18}: {ms:.3f}ms")
+    
+    print("== 所見データの表現（5万件） ==")
+    for label, result in bench_records().items():
+        print(f"{label:>13}: {result['ms']:.1f}ms, {result['MiB']:.1f}MiB")
+    
+    print("== プロンプトテンプレート ==")
+    if prompt_templates.load_encoding(prompt_templates.DEFAULT_ENCODING_MODEL) is None:
+        print("（tiktoken がないか、エンコーディングを読み込めないため、トークン数は見積もりです）")
+    for version, result in bench_prompts().items():
+        cacheable = "可" if result["grade_prefix_tokens"] >= PROMPT_CACHE_MIN_TOKENS else "不可"
+        print(f"v{version}: プロンプト {result['prompt_tokens']:.0f}トークン/回, "
+              f"共通の先頭部分 {result['shared_prefix_tokens']}トークン"
+              f"（学年ごと {result['grade_prefix_tokens']}トークン, キャッシュ{cacheable}）, "
+              f"組み立て {result['render_us']:.1f}µs")
+    for grade_level in ("低学年", "中学年", "高学年"):
+        report = prompt_templates.token_report(grade_level)
+        print(f"  {grade_level}: " + ", ".join(f"{part} {tokens}" for part, tokens in report.items()))
+    
+    print("== レート制限（120件を30人で同時に送信、上限40件/秒） ==")
+    for label, result in bench_rate_limit().items():
+        print(f"{label}: 成功 {result['ok']}件, 失敗 {result['failed']}件, "
+              f"{result['seconds']:.1f}秒（{result['throughput']:.1f}件/秒）")
+    
+    print("== 生成から保存まで（疑似バックエンド、1件あたりのミリ秒） ==")
+    end_to_end = bench_end_to_end()
+    for stage, ms in end_to_end["段階"].items():
+        print(f"{stage}: {ms:.3f}ms")
+    batch = end_to_end["まとめて生成"]
+    print(f"まとめて生成（応答0.2秒・エラー5%）: 成功 {batch['ok']}件"
+          f"（うちテンプレート {batch['template']}件）, 失敗 {batch['failed']}件, "
+          f"{batch['seconds']:.1f}秒（{batch['throughput']:.1f}件/秒）")
+    
+    print("== 類似度チェック（ミリ秒） ==")
+    for stage, ms in bench_similarity().items():
+        print(f"{stage}: {ms:.1f}ms")
+    
+    print("== 生成の記録（ミリ秒） ==")
+    for stage, ms in bench_metrics().items():
+        print(f"{stage}: {ms:.3f}ms")
+    
+    print("== トークン予算（8スレッドで同時に予約） ==")
+    budget = bench_token_budget()
+    print(f"予約と精算: {budget.pop('予約と精算（1回あたりのミリ秒）'):.3f}ms/回")
+    print(", ".join(f"{label} {value:,}" for label, value in budget.items()))
+    if budget["予約できた合計"] > budget["上限"]:
+        print("NG 上限を超えて予約されました")
+        failures.append("トークン予算")
+    
+    print("== 同じリクエストの同時送信（疑似バックエンド、応答0.2秒） ==")
+    flight = bench_single_flight()
+    print(f"{flight['リクエスト']}件のリクエストで生成 {flight['生成']}回（{flight['所要秒数']:.2f}秒）, "
+          f"二度押しで生成 {flight['二度押しの生成']}回, "
+          f"同じキーワードの{flight['リクエスト']}人の一括生成で {flight['一括生成の所見文の種類']}種類の所見文")
+    if flight["生成"] != 1 or flight["二度押しの生成"] != 1:
+        print("NG 同じリクエストがまとめられていません")
+        failures.append("同じリクエストのまとめ")
+    if flight["一括生成の所見文の種類"] != flight["リクエスト"]:
+        print("NG 一括生成で別の児童の所見文がまとめられました")
+        failures.append("一括生成の所見文")
+    
+    print("== 全文検索（10万件、1回あたりのミリ秒） ==")
+    for query, ms in bench_search().items():
+        print(f"{query}: {ms:.3f}ms")
+    
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+候補順位付けモジュール
+1回の呼び出しで生成した複数の所見文の候補を、APIを使わずに採点して並べる
+"""
+
+from typing import Dict, List
+
+from length_controller import LENGTH_TOLERANCE
+
+
+# 避けるべき表現（プロンプトで避けるよう指示しているもの・否定的な表現）
+AVOIDED_PHRASES = [
+    "称賛します",
+    "賞賛します",
+    "称賛に値",
+    "できませんでした",
+    "残念",
+]
+
+# セクションごとの目印（書き出しは1文目があればよいため含めない）
+SECTION_MARKERS: Dict[str, List[str]] = {
+    "学習面": ["学習", "授業", "教科", "国語", "算数", "理科", "社会", "音読", "発表", "観察", "漢字", "計算"],
+    "生活面": ["友達", "係", "掃除", "清掃", "給食", "あいさつ", "休み時間", "当番", "委員会", "生活"],
+    "今後の期待": ["これからも", "今後も", "期待", "願って", "楽しみ"],
+}
+
+# 採点の重み（点数が小さいほどよい）
+WEIGHT_LENGTH = 1.0
+WEIGHT_AVOIDED = 2.0
+WEIGHT_REPETITION = 4.0
+WEIGHT_MISSING_SECTION = 1.5
+
+# 繰り返しを数える文字 n-gram の長さ（「〜ています。」のような短い文末は数えない長さ）
+REPETITION_NGRAM = 8
+
+
+def _repetition(text: str) -> float:
+    """同じ言い回しの繰り返しの割合（0〜1）"""
+    ngrams = [text[i:i + REPETITION_NGRAM] for i in range(len(text) - REPETITION_NGRAM + 1)]
+    if not ngrams:
+        return 0.0
+    return (len(ngrams) - len(set(ngrams))) / len(ngrams)
+
+
+def score_candidate(text: str, target_length: int) -> Dict[str, float]:
+    """
+    候補を採点
+    
+    Args:
+        text: 候補の所見文
+        target_length: 目標文字数
+        
+    Returns:
+        {'length': 目標文字数からのずれ（許容範囲の何倍か）, 'avoided': 避けるべき表現の数,
+         'repetition': 繰り返しの割合, 'missing_sections': 見当たらないセクションの数,
+         'total': 重み付きの合計（小さいほどよい）}
+    """
+    length = abs(len(text) - target_length) / LENGTH_TOLERANCE
+    avoided = sum(text.count(phrase) for phrase in AVOIDED_PHRASES)
+    repetition = _repetition(text)
+    missing_sections = sum(
+        1 for markers in SECTION_MARKERS.values()
+        if not any(marker in text for marker in markers)
+    )
+    return {
+        'length': length,
+        'avoided': avoided,
+        'repetition': repetition,
+        'missing_sections': missing_sections,
+        'total': (
+            WEIGHT_LENGTH * length
+            + WEIGHT_AVOIDED * avoided
+            + WEIGHT_REPETITION * repetition
+            + WEIGHT_MISSING_SECTION * missing_sections
+        ),
+    }
+
+
+def rank_candidates(texts: List[str], target_length: int) -> List[str]:
+    """
+    候補をよい順に並べる（空の候補と重複は除く）
+    
+    Args:
+        texts: 候補の所見文のリスト
+        target_length: 目標文字数
+        
+    Returns:
+        よい順に並べた所見文のリスト
+    """
+    unique = list(dict.fromkeys(text for text in texts if text))
+    return sorted(unique, key=lambda text: score_candidate(text, target_length)['total'])
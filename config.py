@@ -87,6 +87,203 @@ def get_openai_model() -> str:
     return model
 
 
+def get_openai_budget_model() -> str:
+    """
+    トークン予算が残り少ない場合に使う、安いOpenAIモデル名を取得
+    
+    Returns:
+        モデル名（デフォルト: gpt-4o-mini。空文字列ならモデルは切り替えない）
+    """
+    try:
+        if hasattr(st, 'secrets') and 'OPENAI_BUDGET_MODEL' in st.secrets:
+            return str(st.secrets['OPENAI_BUDGET_MODEL']).strip()
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    return os.getenv('OPENAI_BUDGET_MODEL', 'gpt-4o-mini').strip()
+
+
+def get_daily_token_budget() -> int:
+    """
+    アプリ全体の1日あたりのトークン数の上限を取得
+    
+    Returns:
+        上限（0は上限なし。デフォルト: 0）
+    """
+    try:
+        if hasattr(st, 'secrets') and 'TOKEN_BUDGET_DAILY' in st.secrets:
+            return max(0, int(st.secrets['TOKEN_BUDGET_DAILY']))
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    try:
+        return max(0, int(os.getenv('TOKEN_BUDGET_DAILY', '0')))
+    except:
+        return 0
+
+
+def get_teacher_token_budget() -> int:
+    """
+    先生1人の1日あたりのトークン数の上限を取得
+    
+    Returns:
+        上限（0は上限なし。デフォルト: 0）
+    """
+    try:
+        if hasattr(st, 'secrets') and 'TOKEN_BUDGET_PER_TEACHER' in st.secrets:
+            return max(0, int(st.secrets['TOKEN_BUDGET_PER_TEACHER']))
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    try:
+        return max(0, int(os.getenv('TOKEN_BUDGET_PER_TEACHER', '0')))
+    except:
+        return 0
+
+
+def get_class_token_budget() -> int:
+    """
+    1クラスの1日あたりのトークン数の上限を取得
+    
+    Returns:
+        上限（0は上限なし。デフォルト: 0）
+    """
+    try:
+        if hasattr(st, 'secrets') and 'TOKEN_BUDGET_PER_CLASS' in st.secrets:
+            return max(0, int(st.secrets['TOKEN_BUDGET_PER_CLASS']))
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    try:
+        return max(0, int(os.getenv('TOKEN_BUDGET_PER_CLASS', '0')))
+    except:
+        return 0
+
+
+def get_openai_rpm_limit() -> int:
+    """
+    OpenAI APIの1分あたりのリクエスト数の上限を取得
+    
+    Returns:
+        上限（0は上限なし。負の値は0として扱う。デフォルト: 500）
+    """
+    try:
+        if hasattr(st, 'secrets') and 'OPENAI_RPM_LIMIT' in st.secrets:
+            return max(0, int(st.secrets['OPENAI_RPM_LIMIT']))
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    try:
+        return max(0, int(os.getenv('OPENAI_RPM_LIMIT', '500')))
+    except:
+        return 500
+
+
+def get_openai_tpm_limit() -> int:
+    """
+    OpenAI APIの1分あたりのトークン数の上限を取得
+    
+    Returns:
+        上限（0は上限なし。負の値は0として扱う。デフォルト: 200000）
+    """
+    try:
+        if hasattr(st, 'secrets') and 'OPENAI_TPM_LIMIT' in st.secrets:
+            return max(0, int(st.secrets['OPENAI_TPM_LIMIT']))
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    try:
+        return max(0, int(os.getenv('OPENAI_TPM_LIMIT', '200000')))
+    except:
+        return 200000
+
+
+def get_candidate_count() -> int:
+    """
+    1回の呼び出しで生成する所見文の候補の数を取得
+    
+    1つ目の候補をストリーミングで表示し、残りはよい順に並べて再生成の際に使う。
+    
+    Returns:
+        候補の数（1〜5、デフォルト: 3）
+    """
+    count = 3
+    try:
+        if hasattr(st, 'secrets') and 'SHOKEN_CANDIDATES' in st.secrets:
+            count = int(st.secrets['SHOKEN_CANDIDATES'])
+        else:
+            # 環境変数から取得を試みる
+            count = int(os.getenv('SHOKEN_CANDIDATES', '3'))
+    except:
+        pass
+    return max(1, min(5, count))
+
+
+def get_response_cache_enabled() -> bool:
+    """
+    生成結果キャッシュを使うかどうかを取得
+    
+    Returns:
+        RESPONSE_CACHE が "1"・"true"・"yes"・"on" のいずれかならTrue（デフォルト: False）
+    """
+    value = None
+    try:
+        if hasattr(st, 'secrets') and 'RESPONSE_CACHE' in st.secrets:
+            value = str(st.secrets['RESPONSE_CACHE'])
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    if value is None:
+        value = os.getenv('RESPONSE_CACHE', '')
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_template_fallback_enabled() -> bool:
+    """
+    APIが使えない場合にテンプレートで所見文を組み立てるかどうかを取得
+    
+    Returns:
+        TEMPLATE_FALLBACK が "0"・"false"・"no"・"off" のいずれかならFalse（デフォルト: True）
+    """
+    value = None
+    try:
+        if hasattr(st, 'secrets') and 'TEMPLATE_FALLBACK' in st.secrets:
+            value = str(st.secrets['TEMPLATE_FALLBACK'])
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    if value is None:
+        value = os.getenv('TEMPLATE_FALLBACK', '')
+    return value.strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_generation_backend() -> str:
+    """
+    所見文の生成に使うバックエンドを取得
+    
+    Returns:
+        "openai"（デフォルト）または "stub"（APIを呼ばない疑似バックエンド。負荷試験用）
+    """
+    try:
+        if hasattr(st, 'secrets') and 'GENERATION_BACKEND' in st.secrets:
+            backend = str(st.secrets['GENERATION_BACKEND'])
+            return "stub" if backend.strip().lower() == "stub" else "openai"
+    except:
+        pass
+    
+    # 環境変数から取得を試みる
+    backend = os.getenv('GENERATION_BACKEND', 'openai')
+    return "stub" if backend.strip().lower() == "stub" else "openai"
+
+
 def validate_config() -> tuple[bool, Optional[str]]:
     """
     設定の妥当性を検証
@@ -94,6 +291,10 @@ def validate_config() -> tuple[bool, Optional[str]]:
     Returns:
         (有効かどうか, エラーメッセージ)
     """
+    # 疑似バックエンドではAPIキーは不要
+    if get_generation_backend() == "stub":
+        return True, None
+    
     api_key = get_openai_api_key()
     if not api_key:
         return False, "OpenAI APIキーが設定されていません。設定を確認してください。"
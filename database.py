@@ -4,12 +4,235 @@ SQLiteを使用して所見データとキーワード履歴を管理
 """
 
 import sqlite3
+import csv
+import io
 import json
+import re
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterator, Iterable, Tuple, BinaryIO
 import os
 
 
+# 接続ごとに設定するPRAGMA
+# WALモードにより、所見の保存中も一覧タブの読み込みがブロックされない
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 8192
+
+# エクスポートの列見出し
+EXPORT_HEADER = ["児童名", "クラス", "文字数", "作成日時", "所見文"]
+
+# trigramトークナイザで索引検索できる最小の文字数
+FTS_MIN_TERM_LENGTH = 3
+
+# 抜粋で一致箇所を囲む印（本文に現れない制御文字。Markdown にするときに ** に置き換える）
+_SNIPPET_START = "\x02"
+_SNIPPET_END = "\x03"
+
+# 抜粋を Markdown として表示するときにエスケープする記号
+_MARKDOWN_SPECIAL = re.compile(r"([\\`*_{}\[\]()#+\-.!|<>~$:])")
+
+# 所見の取得時に読み込むカラム
+SHOKEN_COLUMNS = """
+    id, student_name, class_name, keywords, content, character_count,
+    created_at, updated_at
+"""
+
+# 生成メトリクスのカラム（idを除く）
+GENERATION_METRICS_COLUMNS = (
+    "created_at", "model", "class_name", "candidates", "streamed", "cache_hit",
+    "api_calls", "prompt_tokens", "completion_tokens", "retries", "latency_ms",
+    "first_token_ms", "length_outcome", "extra_calls", "error",
+)
+
+# 所見一覧の並び順（キーセットページネーションのキーとなるカラムと方向）
+# "created": 作成日時の新しい順（idx_shoken_created_at を使用）
+# "student": 児童名順・同じ児童は新しい順（クラス指定時に idx_shoken_class_student を使用）
+SHOKEN_ORDERS = {
+    "created": (("created_at", "DESC"), ("id", "DESC")),
+    "student": (("student_name", "ASC"), ("created_at", "DESC"), ("id", "ASC")),
+}
+
+
+class ShokenRecord:
+    """
+    所見データ（1行分）
+    
+    行データの変換・キーワードのデコード・日時の変換・等価判定を
+    このクラスに集約する。__slots__ により1件あたりのメモリを抑え、
+    keywords は参照されたときに初めてJSONをデコードする。
+    """
+    
+    __slots__ = (
+        'id', 'student_name', 'class_name', 'content', 'character_count',
+        'created_at', 'updated_at', '_keywords_json', '_keywords'
+    )
+    
+    def __init__(self, id: int, student_name: str, class_name: str, keywords_json: Optional[str],
+                 content: str, character_count: int, created_at: str, updated_at: str):
+        self.id = id
+        self.student_name = student_name
+        self.class_name = class_name or ""
+        self.content = content
+        self.character_count = character_count
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self._keywords_json = keywords_json
+        self._keywords: Optional[List[str]] = None
+    
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "ShokenRecord":
+        """SHOKEN_COLUMNS を含む行から作成"""
+        return cls(
+            row['id'], row['student_name'], row['class_name'], row['keywords'],
+            row['content'], row['character_count'], row['created_at'], row['updated_at']
+        )
+    
+    @property
+    def keywords(self) -> List[str]:
+        """キーワードのリスト"""
+        if self._keywords is None:
+            self._keywords = json.loads(self._keywords_json) if self._keywords_json else []
+        return self._keywords
+    
+    @property
+    def created_datetime(self) -> Optional[datetime]:
+        """作成日時（datetime）"""
+        return datetime.fromisoformat(self.created_at) if self.created_at else None
+    
+    @property
+    def updated_datetime(self) -> Optional[datetime]:
+        """更新日時（datetime）"""
+        return datetime.fromisoformat(self.updated_at) if self.updated_at else None
+    
+    def to_dict(self) -> Dict:
+        """辞書に変換"""
+        return {
+            'id': self.id,
+            'student_name': self.student_name,
+            'class_name': self.class_name,
+            'keywords': self.keywords,
+            'content': self.content,
+            'character_count': self.character_count,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+    
+    def _key(self) -> tuple:
+        return (
+            self.id, self.student_name, self.class_name, tuple(self.keywords),
+            self.content, self.character_count, self.created_at, self.updated_at
+        )
+    
+    def __eq__(self, other):
+        if not isinstance(other, ShokenRecord):
+            return NotImplemented
+        return self._key() == other._key()
+    
+    def __hash__(self):
+        return hash(self._key())
+    
+    def __repr__(self):
+        return (f"ShokenRecord(id={self.id!r}, student_name={self.student_name!r}, "
+                f"class_name={self.class_name!r}, created_at={self.created_at!r})")
+
+
+def _keyset_condition(order: Tuple[Tuple[str, str], ...], after: tuple) -> Tuple[str, list]:
+    """
+    キーセットページネーションの条件式を作成
+    
+    Args:
+        order: 並び順（カラム名, "ASC"/"DESC"）のタプル
+        after: 前ページ最後の行の並び順キー
+        
+    Returns:
+        (WHERE句の条件式, パラメータ)
+    """
+    # 先頭カラムの範囲条件でインデックスの走査範囲を絞り、
+    # 残りのカラムで同じ値の行の続きを判定する
+    first_column, first_direction = order[0]
+    conditions = [f"{first_column} {'<=' if first_direction == 'DESC' else '>='} ?"]
+    params = [after[0]]
+    
+    alternatives = []
+    for i, (column, direction) in enumerate(order):
+        terms = [f"{prev_column} = ?" for prev_column, _ in order[:i]]
+        terms.append(f"{column} {'<' if direction == 'DESC' else '>'} ?")
+        alternatives.append("(" + " AND ".join(terms) + ")")
+        params.extend(after[:i + 1])
+    conditions.append("(" + " OR ".join(alternatives) + ")")
+    
+    return " AND ".join(conditions), params
+
+
+def _escape_like(text: str) -> str:
+    """LIKE のワイルドカードをエスケープ"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _make_snippet(content: str, terms: List[str], width: int = 24) -> str:
+    """最初に一致した語の前後を抜き出し、一致箇所を印で囲んだ抜粋を作成"""
+    positions = [(content.find(term), term) for term in terms if term in content]
+    if not positions:
+        return content[:width * 2] + ("…" if len(content) > width * 2 else "")
+    
+    start, term = min(positions)
+    begin = max(0, start - width)
+    end = min(len(content), start + len(term) + width)
+    snippet = content[begin:end]
+    for term in terms:
+        snippet = snippet.replace(term, _SNIPPET_START + term + _SNIPPET_END)
+    return ("…" if begin > 0 else "") + snippet + ("…" if end < len(content) else "")
+
+
+def _snippet_markdown(snippet: str) -> str:
+    """抜粋の Markdown の記号をエスケープし、印で囲んだ一致箇所だけを太字にする"""
+    escaped = _MARKDOWN_SPECIAL.sub(r"\\\1", snippet)
+    return escaped.replace(_SNIPPET_START, "**").replace(_SNIPPET_END, "**")
+
+
+def parse_roster_csv(data: bytes, class_name: str = "") -> List[Dict]:
+    """
+    名簿・所見のCSVを所見データのリストに変換
+    
+    Args:
+        data: CSVファイルの内容（UTF-8（BOM付き可）またはShift_JIS）
+        class_name: 「クラス」列が空の行に使うクラス名
+        
+    Returns:
+        所見データのリスト（児童名が空の行は除く）
+        
+    Raises:
+        ValueError: 「児童名」列がない場合
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        # Excelで保存した日本語CSVはShift_JIS（cp932）のことが多い
+        text = data.decode("cp932")
+    
+    reader = csv.DictReader(io.StringIO(text, newline=""))
+    if not reader.fieldnames or "児童名" not in reader.fieldnames:
+        raise ValueError("CSVに「児童名」列がありません")
+    
+    records = []
+    for row in reader:
+        student_name = (row.get("児童名") or "").strip()
+        if not student_name:
+            continue
+        keywords_text = (row.get("キーワード") or "").replace("、", ",").replace(";", ",")
+        content = row.get("所見文") or ""
+        records.append({
+            'student_name': student_name,
+            'class_name': (row.get("クラス") or "").strip() or class_name,
+            'keywords': [kw.strip() for kw in keywords_text.split(",") if kw.strip()],
+            'content': content,
+            'character_count': len(content)
+        })
+    return records
+
+
 class Database:
     """データベース管理クラス"""
     
@@ -21,61 +244,153 @@ class Database:
             db_path: データベースファイルのパス
         """
         self.db_path = db_path
+        # 接続はスレッドごとに1本を保持して使い回す
+        # （Streamlitはセッションごとに別スレッドでスクリプトを実行するため）
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._fts_available: Optional[bool] = None
         self.init_database()
     
-    def get_connection(self):
-        """データベース接続を取得"""
-        conn = sqlite3.connect(self.db_path)
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        データベース接続を取得
+        
+        呼び出し元のスレッド専用の接続を返す。初回のみ接続を作成し、
+        以降は同じ接続を再利用する（呼び出し側で close しないこと）。
+        
+        Returns:
+            SQLite接続
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def _connect(self) -> sqlite3.Connection:
+        """新しい接続を作成してPRAGMAを設定"""
+        # 接続は作成したスレッドだけが使う。close() を他スレッドから呼べるように
+        # check_same_thread は無効にしておく
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            isolation_level=None  # トランザクションは transaction() で明示的に管理
+        )
         conn.row_factory = sqlite3.Row  # 辞書形式で結果を取得
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store = MEMORY")
         return conn
     
-    def init_database(self):
-        """データベースとテーブルを初期化"""
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        """
+        書き込みトランザクションを開始
+        
+        BEGIN IMMEDIATE で書き込みロックを先に取得し、ブロックを抜けたら
+        コミットする（例外時はロールバック）。入れ子で呼ばれた場合は
+        外側のトランザクションにまとめる。
+        
+        Yields:
+            カーソル
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
+        if conn.in_transaction:
+            yield cursor
+            return
         
-        # 所見テーブル
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS shoken (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                student_name TEXT,
-                class_name TEXT,
-                keywords TEXT,
-                content TEXT,
-                character_count INTEGER,
-                created_at TEXT,
-                updated_at TEXT
-            )
-        """)
-        
-        # 既存のテーブルにclass_nameカラムを追加（マイグレーション）
+        cursor.execute("BEGIN IMMEDIATE")
         try:
-            cursor.execute("ALTER TABLE shoken ADD COLUMN class_name TEXT")
-        except sqlite3.OperationalError:
-            # カラムが既に存在する場合はエラーを無視
-            pass
+            yield cursor
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+    
+    def data_version(self) -> int:
+        """
+        データのバージョンを取得
         
-        # キーワード履歴テーブル
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS keyword_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                keyword TEXT,
-                usage_count INTEGER DEFAULT 1,
-                last_used_at TEXT,
-                created_at TEXT
-            )
-        """)
+        所見・キーワード履歴・名簿が変更されるたびに（トリガーにより同じトランザクション内で）
+        1ずつ増える。読み取り結果のキャッシュのキーに使う。
         
-        # 設定テーブル
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        """)
+        PRAGMA data_version（他の接続による変更で変わる）と、この接続の
+        total_changes（自分の変更で増える）がどちらも前回と同じなら、
+        カウンタを読まずに前回の値を返す。
+        
+        Returns:
+            データのバージョン
+        """
+        conn = self.get_connection()
+        stamp = (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+        cached = getattr(self._local, 'data_version', None)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        
+        version = conn.execute("SELECT version FROM data_version").fetchone()[0]
+        self._local.data_version = (stamp, version)
+        return version
+    
+    def close(self):
+        """すべてのスレッドの接続を閉じる"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+    
+    def init_database(self):
+        """データベースを初期化し、未適用のマイグレーションを順に適用"""
+        with self.transaction() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TEXT
+                )
+            """)
+        
+        current_version = self.get_schema_version()
+        for version, description, migrate in MIGRATIONS:
+            if version <= current_version:
+                continue
+            # マイグレーションごとに1トランザクションで適用する
+            with self.transaction() as cursor:
+                # 別プロセスが先に適用していないか、書き込みロック取得後に再確認
+                if self.get_schema_version() >= version:
+                    continue
+                migrate(cursor)
+                cursor.execute("""
+                    INSERT INTO schema_version (version, description, applied_at)
+                    VALUES (?, ?, ?)
+                """, (version, description, datetime.now().isoformat()))
         
-        conn.commit()
-        conn.close()
+        # FTS5（trigram）に対応していない SQLite では v5 で全文検索のテーブルを作れず
+        # 部分一致検索で代用するため、起動のたびに作成を試みる（SQLite を更新すれば
+        # 既存の所見も索引に登録して全文検索を使う）
+        if not self._has_fts():
+            with self.transaction() as cursor:
+                _migrate_full_text_search(cursor)
+            self._fts_available = None
+    
+    def get_schema_version(self) -> int:
+        """
+        適用済みのスキーマバージョンを取得
+        
+        Returns:
+            スキーマバージョン（未適用の場合は0）
+        """
+        conn = self.get_connection()
+        row = conn.execute("SELECT MAX(version) AS version FROM schema_version").fetchone()
+        return row['version'] or 0
     
     # 所見関連メソッド
     
@@ -94,60 +409,175 @@ class Database:
         Returns:
             保存された所見のID
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         now = datetime.now().isoformat()
         keywords_json = json.dumps(keywords, ensure_ascii=False)
         
-        cursor.execute("""
-            INSERT INTO shoken 
-            (student_name, class_name, keywords, content, character_count, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (student_name, class_name, keywords_json, content, character_count, now, now))
-        
-        shoken_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute("""
+                INSERT INTO shoken 
+                (student_name, class_name, keywords, content, character_count, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (student_name, class_name or "", keywords_json, content, character_count, now, now))
+            
+            shoken_id = cursor.lastrowid
         
         return shoken_id
     
-    def get_all_shoken(self) -> List[Dict]:
+    def save_shoken_many(self, records: Iterable[Dict]) -> List[int]:
         """
-        すべての所見を取得
+        複数の所見を1トランザクションでまとめて保存
         
+        Args:
+            records: 所見データのリスト（student_name, keywords, content,
+                character_count, class_name。character_count を省略した場合は
+                content の文字数）
+            
         Returns:
-            所見のリスト
+            保存された所見のIDのリスト（recordsと同じ順）
+        """
+        now = datetime.now().isoformat()
+        rows = [
+            (
+                record.get('student_name') or "未設定",
+                record.get('class_name') or "",
+                json.dumps(record.get('keywords') or [], ensure_ascii=False),
+                record.get('content') or "",
+                record.get('character_count', len(record.get('content') or "")),
+                now,
+                now
+            )
+            for record in records
+        ]
+        if not rows:
+            return []
+        
+        with self.transaction() as cursor:
+            # 書き込みロック中は他の書き込みが入らないため、
+            # 直前の最大IDより大きいIDが今回保存した所見になる
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM shoken")
+            last_id = cursor.fetchone()[0]
+            
+            cursor.executemany("""
+                INSERT INTO shoken 
+                (student_name, class_name, keywords, content, character_count, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            
+            cursor.execute("SELECT id FROM shoken WHERE id > ? ORDER BY id", (last_id,))
+            shoken_ids = [row[0] for row in cursor.fetchall()]
+        
+        return shoken_ids
+    
+    def get_shoken_page(self, class_name: Optional[str] = None, after: Optional[tuple] = None,
+                        limit: int = 50, order: str = "created") -> Tuple[List[ShokenRecord], Optional[tuple]]:
+        """
+        所見を1ページ分取得（キーセットページネーション）
+        
+        Args:
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            after: 前ページの続きを示すカーソル（Noneの場合は先頭から）
+            limit: 取得件数
+            order: 並び順（"created" または "student"）
+            
+        Returns:
+            (所見のリスト, 次ページのカーソル（最終ページの場合はNone）)
         """
+        order_columns = SHOKEN_ORDERS[order]
+        conditions = []
+        params = []
+        
+        if class_name is not None:
+            conditions.append("class_name = ?")
+            params.append(class_name)
+        if after is not None:
+            condition, condition_params = _keyset_condition(order_columns, after)
+            conditions.append(condition)
+            params.extend(condition_params)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order_by = ", ".join(f"{column} {direction}" for column, direction in order_columns)
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT id, student_name, class_name, keywords, content, character_count, 
-                   created_at, updated_at
+        # 次ページの有無を判定するため1件多く取得
+        cursor.execute(f"""
+            SELECT {SHOKEN_COLUMNS}
             FROM shoken
-            ORDER BY created_at DESC
-        """)
+            {where}
+            ORDER BY {order_by}
+            LIMIT ?
+        """, (*params, limit + 1))
         
         rows = cursor.fetchall()
-        conn.close()
         
-        result = []
-        for row in rows:
-            result.append({
-                'id': row['id'],
-                'student_name': row['student_name'],
-                'class_name': row['class_name'] if row['class_name'] else "",
-                'keywords': json.loads(row['keywords']) if row['keywords'] else [],
-                'content': row['content'],
-                'character_count': row['character_count'],
-                'created_at': row['created_at'],
-                'updated_at': row['updated_at']
-            })
+        result = [ShokenRecord.from_row(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = tuple(last[column] for column, _ in order_columns)
         
-        return result
+        return result, next_cursor
+    
+    def iter_shoken(self, class_name: Optional[str] = None, after: Optional[tuple] = None,
+                    limit: Optional[int] = None, order: str = "created",
+                    batch_size: int = 200) -> Iterator[ShokenRecord]:
+        """
+        所見を順に取得
+        
+        batch_size件ずつページを取得するため、全件をまとめて読み込まない。
+        
+        Args:
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            after: 開始位置のカーソル（Noneの場合は先頭から）
+            limit: 最大件数（Noneの場合はすべて）
+            order: 並び順（"created" または "student"）
+            batch_size: 1回に取得する件数
+            
+        Yields:
+            所見データ
+        """
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page_size = batch_size if remaining is None else min(batch_size, remaining)
+            page, after = self.get_shoken_page(class_name, after, page_size, order)
+            yield from page
+            
+            if remaining is not None:
+                remaining -= len(page)
+            if after is None:
+                break
+    
+    def count_shoken(self, class_name: Optional[str] = None) -> int:
+        """
+        所見の件数を取得
+        
+        Args:
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            
+        Returns:
+            件数
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        if class_name is None:
+            cursor.execute("SELECT COUNT(*) FROM shoken")
+        else:
+            cursor.execute("SELECT COUNT(*) FROM shoken WHERE class_name = ?", (class_name,))
+        
+        return cursor.fetchone()[0]
+    
+    def get_all_shoken(self) -> List[ShokenRecord]:
+        """
+        すべての所見を取得
+        
+        Returns:
+            所見のリスト
+        """
+        return list(self.iter_shoken())
     
-    def get_shoken_by_class(self, class_name: str) -> List[Dict]:
+    def get_shoken_by_class(self, class_name: str) -> List[ShokenRecord]:
         """
         指定クラスの所見を取得
         
@@ -157,58 +587,153 @@ class Database:
         Returns:
             所見のリスト
         """
+        return list(self.iter_shoken(class_name, order="student"))
+    
+    def get_all_classes(self) -> List[str]:
+        """
+        すべてのクラス名を取得
+        
+        Returns:
+            クラス名のリスト（重複なし）
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
-            SELECT id, student_name, class_name, keywords, content, character_count, 
-                   created_at, updated_at
+            SELECT DISTINCT class_name
             FROM shoken
-            WHERE class_name = ?
-            ORDER BY student_name, created_at DESC
-        """, (class_name,))
+            WHERE class_name IS NOT NULL AND class_name != ''
+            ORDER BY class_name
+        """)
+        
+        rows = cursor.fetchall()
+        
+        return [row['class_name'] for row in rows]
+    
+    def get_class_summaries(self) -> List[Dict]:
+        """
+        クラスごとの集計を取得
+        
+        所見本体を読み込まずに、件数・最終更新日時・平均文字数・児童数を
+        1回のGROUP BYで集計する。
+        
+        Returns:
+            クラスごとの集計のリスト（クラス名順、クラス未設定は class_name が空文字列）
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT class_name,
+                   COUNT(*) AS shoken_count,
+                   MAX(updated_at) AS last_updated_at,
+                   AVG(character_count) AS average_character_count,
+                   COUNT(DISTINCT student_name) AS student_count
+            FROM shoken
+            GROUP BY class_name
+            ORDER BY class_name
+        """)
         
         rows = cursor.fetchall()
-        conn.close()
         
         result = []
         for row in rows:
             result.append({
-                'id': row['id'],
-                'student_name': row['student_name'],
-                'class_name': row['class_name'] if row['class_name'] else "",
-                'keywords': json.loads(row['keywords']) if row['keywords'] else [],
-                'content': row['content'],
-                'character_count': row['character_count'],
-                'created_at': row['created_at'],
-                'updated_at': row['updated_at']
+                'class_name': row['class_name'] or "",
+                'shoken_count': row['shoken_count'],
+                'last_updated_at': row['last_updated_at'],
+                'average_character_count': row['average_character_count'] or 0,
+                'student_count': row['student_count']
             })
         
         return result
     
-    def get_all_classes(self) -> List[str]:
+    def search_shoken(self, query: str, class_name: Optional[str] = None,
+                      limit: int = 20) -> List[Dict]:
         """
-        すべてのクラス名を取得
+        所見を全文検索
+        
+        所見文・児童名・キーワードを対象に、空白区切りのすべての語を含む所見を
+        関連度順に返す。3文字以上の語はFTS5（trigram）の索引で検索し、
+        索引を使えない2文字以下の語は部分一致で絞り込む。
         
+        Args:
+            query: 検索語（空白区切りで複数指定可能）
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            limit: 取得件数
+            
         Returns:
-            クラス名のリスト（重複なし）
+            検索結果のリスト（'shoken': ShokenRecord, 'snippet': 該当箇所の抜粋。
+            一致箇所だけを太字にした Markdown で、本文の記号はエスケープ済み）
         """
+        terms = [term for term in query.replace("　", " ").split(" ") if term]
+        if not terms:
+            return []
+        
+        indexed_terms = [term for term in terms if len(term) >= FTS_MIN_TERM_LENGTH]
+        short_terms = [term for term in terms if len(term) < FTS_MIN_TERM_LENGTH]
+        if not self._has_fts():
+            indexed_terms, short_terms = [], terms
+        
+        conditions = []
+        params = []
+        for term in short_terms:
+            conditions.append(
+                "(s.content LIKE ? ESCAPE '\\' OR s.student_name LIKE ? ESCAPE '\\' "
+                "OR s.keywords LIKE ? ESCAPE '\\')"
+            )
+            pattern = "%" + _escape_like(term) + "%"
+            params.extend([pattern, pattern, pattern])
+        if class_name is not None:
+            conditions.append("s.class_name = ?")
+            params.append(class_name)
+        
+        columns = ", ".join(f"s.{column.strip()}" for column in SHOKEN_COLUMNS.split(","))
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT DISTINCT class_name
-            FROM shoken
-            WHERE class_name IS NOT NULL AND class_name != ''
-            ORDER BY class_name
-        """)
+        if indexed_terms:
+            # 各語をフレーズとして AND 検索（" はエスケープ）
+            match = " AND ".join('"' + term.replace('"', '""') + '"' for term in indexed_terms)
+            where = " AND ".join(["shoken_fts MATCH ?"] + conditions)
+            cursor.execute(f"""
+                SELECT {columns},
+                       snippet(shoken_fts, 0, ?, ?, '…', 24) AS snippet
+                FROM shoken_fts
+                JOIN shoken AS s ON s.id = shoken_fts.rowid
+                WHERE {where}
+                ORDER BY bm25(shoken_fts, 1.0, 2.0, 2.0)
+                LIMIT ?
+            """, (_SNIPPET_START, _SNIPPET_END, match, *params, limit))
+        else:
+            # 索引を使えない短い語のみの場合は新しい順に部分一致で検索
+            cursor.execute(f"""
+                SELECT {columns}, NULL AS snippet
+                FROM shoken AS s
+                WHERE {" AND ".join(conditions)}
+                ORDER BY s.created_at DESC, s.id DESC
+                LIMIT ?
+            """, (*params, limit))
         
         rows = cursor.fetchall()
-        conn.close()
         
-        return [row['class_name'] for row in rows]
+        result = []
+        for row in rows:
+            snippet = row['snippet'] or _make_snippet(row['content'] or "", terms)
+            result.append({'shoken': ShokenRecord.from_row(row), 'snippet': _snippet_markdown(snippet)})
+        
+        return result
     
-    def get_shoken(self, shoken_id: int) -> Optional[Dict]:
+    def _has_fts(self) -> bool:
+        """全文検索用のFTS5テーブルが利用可能か確認"""
+        if self._fts_available is None:
+            row = self.get_connection().execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shoken_fts'"
+            ).fetchone()
+            self._fts_available = row is not None
+        return self._fts_available
+    
+    def get_shoken(self, shoken_id: int) -> Optional[ShokenRecord]:
         """
         指定IDの所見を取得
         
@@ -221,27 +746,16 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT id, student_name, class_name, keywords, content, character_count, 
-                   created_at, updated_at
+        cursor.execute(f"""
+            SELECT {SHOKEN_COLUMNS}
             FROM shoken
             WHERE id = ?
         """, (shoken_id,))
         
         row = cursor.fetchone()
-        conn.close()
         
         if row:
-            return {
-                'id': row['id'],
-                'student_name': row['student_name'],
-                'class_name': row['class_name'] if row['class_name'] else "",
-                'keywords': json.loads(row['keywords']) if row['keywords'] else [],
-                'content': row['content'],
-                'character_count': row['character_count'],
-                'created_at': row['created_at'],
-                'updated_at': row['updated_at']
-            }
+            return ShokenRecord.from_row(row)
         return None
     
     def update_shoken(self, shoken_id: int, student_name: str, 
@@ -257,21 +771,46 @@ class Database:
             character_count: 文字数
             class_name: クラス名
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         now = datetime.now().isoformat()
         keywords_json = json.dumps(keywords, ensure_ascii=False)
         
-        cursor.execute("""
-            UPDATE shoken
-            SET student_name = ?, class_name = ?, keywords = ?, content = ?, 
-                character_count = ?, updated_at = ?
-            WHERE id = ?
-        """, (student_name, class_name, keywords_json, content, character_count, now, shoken_id))
+        with self.transaction() as cursor:
+            cursor.execute("""
+                UPDATE shoken
+                SET student_name = ?, class_name = ?, keywords = ?, content = ?, 
+                    character_count = ?, updated_at = ?
+                WHERE id = ?
+            """, (student_name, class_name or "", keywords_json, content, character_count, now, shoken_id))
+    
+    def update_shoken_many(self, records: Iterable[Dict]):
+        """
+        複数の所見を1トランザクションでまとめて更新
+        
+        Args:
+            records: 所見データのリスト（id, student_name, keywords, content,
+                character_count, class_name）
+        """
+        now = datetime.now().isoformat()
+        rows = [
+            (
+                record['student_name'],
+                record.get('class_name') or "",
+                json.dumps(record.get('keywords') or [], ensure_ascii=False),
+                record['content'],
+                record.get('character_count', len(record['content'])),
+                now,
+                record['id']
+            )
+            for record in records
+        ]
         
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.executemany("""
+                UPDATE shoken
+                SET student_name = ?, class_name = ?, keywords = ?, content = ?, 
+                    character_count = ?, updated_at = ?
+                WHERE id = ?
+            """, rows)
     
     def delete_shoken(self, shoken_id: int):
         """
@@ -280,13 +819,196 @@ class Database:
         Args:
             shoken_id: 所見ID
         """
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM shoken WHERE id = ?", (shoken_id,))
+    
+    # エクスポート関連メソッド
+    
+    def iter_export_rows(self, class_name: Optional[str] = None,
+                         chunk_size: int = 500) -> Iterator[tuple]:
+        """
+        エクスポート用の行を順に取得
+        
+        カーソルからchunk_size件ずつ読み込むため、全件をメモリに載せない。
+        
+        Args:
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            chunk_size: 1回に読み込む件数
+            
+        Yields:
+            (児童名, クラス, 文字数, 作成日時, 所見文)
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute("DELETE FROM shoken WHERE id = ?", (shoken_id,))
+        # 一覧画面と同じ並び順（クラス指定時は児童名順、すべての場合は新しい順）
+        if class_name is None:
+            cursor.execute("""
+                SELECT student_name, class_name, character_count, created_at, content
+                FROM shoken
+                ORDER BY created_at DESC, id DESC
+            """)
+        else:
+            cursor.execute("""
+                SELECT student_name, class_name, character_count, created_at, content
+                FROM shoken
+                WHERE class_name = ?
+                ORDER BY student_name, created_at DESC, id
+            """, (class_name,))
+        
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
+        finally:
+            cursor.close()
+    
+    def export_csv(self, fileobj: BinaryIO, class_name: Optional[str] = None) -> int:
+        """
+        所見をCSV（BOM付きUTF-8、Excelで文字化けしない形式）で書き出す
+        
+        Args:
+            fileobj: 書き込み先（バイナリモード）
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            
+        Returns:
+            書き出した所見の件数
+        """
+        text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_HEADER)
+        
+        count = 0
+        for row in self.iter_export_rows(class_name):
+            writer.writerow(row)
+            count += 1
+        
+        # fileobj を閉じないように切り離す
+        text.flush()
+        text.detach()
+        return count
+    
+    def export_xlsx(self, fileobj: BinaryIO, class_name: Optional[str] = None) -> int:
+        """
+        所見をExcel（XLSX）形式で書き出す
+        
+        openpyxl の書き込み専用モードを使い、行を順に書き出す。
+        
+        Args:
+            fileobj: 書き込み先（バイナリモード）
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            
+        Returns:
+            書き出した所見の件数
+        """
+        from openpyxl import Workbook
+        
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(title=(class_name or "所見")[:31])
+        sheet.append(EXPORT_HEADER)
+        
+        count = 0
+        for row in self.iter_export_rows(class_name):
+            sheet.append(row)
+            count += 1
+        
+        workbook.save(fileobj)
+        return count
+    
+    def import_csv(self, fileobj: BinaryIO, class_name: str = "") -> List[int]:
+        """
+        名簿・所見のCSVを取り込む
+        
+        「児童名」列は必須。「クラス」「キーワード」「所見文」列は任意で、
+        export_csv で書き出したCSVもそのまま取り込める。
+        
+        Args:
+            fileobj: CSVファイル（バイナリモード、UTF-8またはShift_JIS）
+            class_name: 「クラス」列が空の行に使うクラス名
+            
+        Returns:
+            保存された所見のIDのリスト（所見文が空の行は名簿に保存する）
+        """
+        return self.import_roster(parse_roster_csv(fileobj.read(), class_name))
+    
+    # 名簿関連メソッド
+    
+    def import_roster(self, records: Iterable[Dict]) -> List[int]:
+        """
+        名簿・所見のデータを1トランザクションでまとめて取り込む
+        
+        所見文のある行は所見として保存し、所見文が空の行は名簿（roster）に保存する
+        （空の所見を作ると一覧・エクスポート・検索・類似度チェックに空の行が混ざるため）。
+        
+        Args:
+            records: parse_roster_csv で変換した所見データのリスト
+            
+        Returns:
+            保存された所見のIDのリスト
+        """
+        records = list(records)
+        with self.transaction():
+            shoken_ids = self.save_shoken_many(record for record in records if record.get('content'))
+            self.save_roster_many(record for record in records if not record.get('content'))
+        return shoken_ids
+    
+    def save_roster_many(self, records: Iterable[Dict]) -> int:
+        """
+        名簿の児童をまとめて保存（同じクラス・児童名の行はキーワードを上書き）
+        
+        Args:
+            records: 児童のデータのリスト（student_name, class_name, keywords）
+            
+        Returns:
+            保存した児童の人数
+        """
+        now = datetime.now().isoformat()
+        rows = [
+            (
+                record.get('class_name') or "",
+                record['student_name'],
+                json.dumps(record.get('keywords') or [], ensure_ascii=False),
+                now
+            )
+            for record in records
+        ]
+        if not rows:
+            return 0
         
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.executemany("""
+                INSERT INTO roster (class_name, student_name, keywords, created_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (class_name, student_name)
+                DO UPDATE SET keywords = excluded.keywords
+            """, rows)
+        return len(rows)
+    
+    def get_roster(self, class_name: str) -> List[Dict]:
+        """
+        クラスの名簿を取得
+        
+        Args:
+            class_name: クラス名
+            
+        Returns:
+            児童のデータのリスト（'student_name', 'keywords'、取り込んだ順）
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT student_name, keywords FROM roster
+            WHERE class_name = ?
+            ORDER BY created_at, rowid
+        """, (class_name or "",))
+        return [
+            {'student_name': row['student_name'], 'keywords': json.loads(row['keywords'])}
+            for row in cursor.fetchall()
+        ]
     
     # キーワード履歴関連メソッド
     
@@ -297,35 +1019,16 @@ class Database:
         Args:
             keywords: キーワードリスト
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         now = datetime.now().isoformat()
         
-        for keyword in keywords:
-            # 既存のキーワードを確認
-            cursor.execute("""
-                SELECT id, usage_count FROM keyword_history WHERE keyword = ?
-            """, (keyword,))
-            
-            row = cursor.fetchone()
-            
-            if row:
-                # 既存の場合は使用回数を増やす
-                cursor.execute("""
-                    UPDATE keyword_history
-                    SET usage_count = usage_count + 1, last_used_at = ?
-                    WHERE keyword = ?
-                """, (now, keyword))
-            else:
-                # 新規の場合は追加
-                cursor.execute("""
-                    INSERT INTO keyword_history (keyword, usage_count, last_used_at, created_at)
-                    VALUES (?, ?, ?, ?)
-                """, (keyword, 1, now, now))
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            # 新規なら追加、既存なら使用回数を増やす（1回のexecutemanyで処理）
+            cursor.executemany("""
+                INSERT INTO keyword_history (keyword, usage_count, last_used_at, created_at)
+                VALUES (?, 1, ?, ?)
+                ON CONFLICT(keyword) DO UPDATE
+                SET usage_count = usage_count + 1, last_used_at = excluded.last_used_at
+            """, [(keyword, now, now) for keyword in keywords])
     
     def get_popular_keywords(self, limit: int = 10) -> List[Dict]:
         """
@@ -348,7 +1051,6 @@ class Database:
         """, (limit,))
         
         rows = cursor.fetchall()
-        conn.close()
         
         result = []
         for row in rows:
@@ -360,6 +1062,65 @@ class Database:
         
         return result
     
+    def get_shoken_by_keyword(self, keyword: str) -> List[ShokenRecord]:
+        """
+        指定キーワードを含む所見を取得
+        
+        Args:
+            keyword: キーワード
+            
+        Returns:
+            所見のリスト（作成日時の新しい順）
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT s.id, s.student_name, s.class_name, s.keywords, s.content, 
+                   s.character_count, s.created_at, s.updated_at
+            FROM keywords AS k
+            JOIN shoken_keywords AS sk ON sk.keyword_id = k.id
+            JOIN shoken AS s ON s.id = sk.shoken_id
+            WHERE k.keyword = ?
+            ORDER BY s.created_at DESC
+        """, (keyword,))
+        
+        rows = cursor.fetchall()
+        
+        return [ShokenRecord.from_row(row) for row in rows]
+    
+    def get_keyword_counts(self, limit: Optional[int] = None) -> List[Dict]:
+        """
+        キーワードごとの所見数を取得
+        
+        Args:
+            limit: 取得件数（Noneの場合はすべて）
+            
+        Returns:
+            キーワードと所見数のリスト（所見数の多い順）
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT k.keyword, counts.shoken_count
+            FROM (
+                SELECT keyword_id, COUNT(*) AS shoken_count
+                FROM shoken_keywords
+                GROUP BY keyword_id
+            ) AS counts
+            JOIN keywords AS k ON k.id = counts.keyword_id
+            ORDER BY counts.shoken_count DESC, k.keyword
+            LIMIT ?
+        """, (limit if limit is not None else -1,))
+        
+        rows = cursor.fetchall()
+        
+        return [
+            {'keyword': row['keyword'], 'shoken_count': row['shoken_count']}
+            for row in rows
+        ]
+    
     # 設定関連メソッド
     
     def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
@@ -378,7 +1139,6 @@ class Database:
         
         cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
         row = cursor.fetchone()
-        conn.close()
         
         if row:
             return row['value']
@@ -392,13 +1152,848 @@ class Database:
             key: 設定キー
             value: 設定値
         """
+        with self.transaction() as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO settings (key, value)
+                VALUES (?, ?)
+            """, (key, value))
+    
+    # 生成結果キャッシュ関連メソッド
+    
+    def take_cached_response(self, cache_key: str, min_variants: int,
+                             created_after: str) -> Optional[str]:
+        """
+        キャッシュ済みの生成結果を1件取り出す
+        
+        有効期限内の候補が min_variants 件以上ある場合のみ、最も長く使われて
+        いない候補を返し、最終使用日時を更新する（候補を順番に使い回す）。
+        
+        Args:
+            cache_key: キャッシュキー
+            min_variants: 取り出しに必要な候補の件数
+            created_after: この日時（ISO形式）より前に作成された候補は使わない
+            
+        Returns:
+            生成結果（候補が足りない場合はNone）
+        """
+        sql = """
+            SELECT id, content FROM response_cache
+            WHERE cache_key = ? AND created_at >= ?
+            ORDER BY last_used_at ASC, id ASC
+        """
+        
+        # キャッシュにない場合は書き込みロックを取らずに返す（他の読み取りを待たせない）
         conn = self.get_connection()
-        cursor = conn.cursor()
+        rows = conn.execute(sql, (cache_key, created_after)).fetchall()
+        if not rows or len(rows) < min_variants:
+            return None
         
-        cursor.execute("""
-            INSERT OR REPLACE INTO settings (key, value)
-            VALUES (?, ?)
-        """, (key, value))
+        with self.transaction() as cursor:
+            # 書き込みロックを取るまでに他のセッションが候補を使ったり消したりしていることがあるため読み直す
+            cursor.execute(sql, (cache_key, created_after))
+            rows = cursor.fetchall()
+            if not rows or len(rows) < min_variants:
+                return None
+            
+            cursor.execute("""
+                UPDATE response_cache
+                SET last_used_at = ?, use_count = use_count + 1
+                WHERE id = ?
+            """, (datetime.now().isoformat(), rows[0]['id']))
+            return rows[0]['content']
+    
+    def add_cached_response(self, cache_key: str, content: str, max_variants: int,
+                            max_entries: int, created_after: str):
+        """
+        生成結果をキャッシュに追加
+        
+        同じキーの候補が max_variants 件を超えた分と、全体で max_entries 件を
+        超えた分を、最終使用日時の古い順に削除する。期限切れの候補も削除する。
+        
+        Args:
+            cache_key: キャッシュキー
+            content: 生成結果
+            max_variants: 1つのキーに保持する候補の最大件数
+            max_entries: キャッシュ全体の最大件数
+            created_after: この日時（ISO形式）より前に作成された候補は削除する
+        """
+        now = datetime.now().isoformat()
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM response_cache WHERE created_at < ?", (created_after,))
+            cursor.execute("""
+                INSERT INTO response_cache (cache_key, content, created_at, last_used_at)
+                VALUES (?, ?, ?, ?)
+            """, (cache_key, content, now, now))
+            cursor.execute("""
+                DELETE FROM response_cache WHERE id IN (
+                    SELECT id FROM response_cache WHERE cache_key = ?
+                    ORDER BY last_used_at DESC, id DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (cache_key, max_variants))
+            cursor.execute("""
+                DELETE FROM response_cache WHERE id IN (
+                    SELECT id FROM response_cache
+                    ORDER BY last_used_at DESC, id DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,))
+    
+    def count_cached_responses(self) -> int:
+        """
+        キャッシュ済みの生成結果の件数を取得
+        
+        Returns:
+            件数
+        """
+        conn = self.get_connection()
+        return conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+    
+    def clear_response_cache(self):
+        """キャッシュ済みの生成結果をすべて削除"""
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM response_cache")
+    
+    # 類似度チェック関連メソッド
+    
+    def get_unsigned_shoken(self, scheme: str,
+                            shoken_ids: Optional[Iterable[int]] = None) -> List[ShokenRecord]:
+        """
+        MinHashシグネチャが未作成（または作り方が古い）の所見を取得
+        
+        シグネチャは所見文の更新・削除時にトリガーで削除されるため、
+        ここで返る所見だけを計算し直せばよい。
+        
+        Args:
+            scheme: 現在のシグネチャの作り方を表す文字列
+            shoken_ids: 対象の所見ID（Noneの場合はすべての所見）
+            
+        Returns:
+            所見のリスト
+        """
+        conditions = ["(sig.shoken_id IS NULL OR sig.scheme != ?)"]
+        params: List = [scheme]
+        if shoken_ids is not None:
+            shoken_ids = list(shoken_ids)
+            if not shoken_ids:
+                return []
+            conditions.append(f"s.id IN ({', '.join('?' * len(shoken_ids))})")
+            params.extend(shoken_ids)
+        
+        columns = ", ".join(f"s.{column.strip()}" for column in SHOKEN_COLUMNS.split(","))
+        conn = self.get_connection()
+        rows = conn.execute(f"""
+            SELECT {columns}
+            FROM shoken AS s
+            LEFT JOIN shoken_signatures AS sig ON sig.shoken_id = s.id
+            WHERE {' AND '.join(conditions)}
+        """, params).fetchall()
+        return [ShokenRecord.from_row(row) for row in rows]
+    
+    def save_signatures(self, scheme: str, signatures: Iterable[Tuple[int, str, bytes]]):
+        """
+        MinHashシグネチャを保存（既存のものは置き換える）
+        
+        Args:
+            scheme: シグネチャの作り方を表す文字列
+            signatures: (所見ID, 計算したときの更新日時, シグネチャ) のリスト
+        """
+        rows = [
+            (scheme, signature, shoken_id, updated_at)
+            for shoken_id, updated_at, signature in signatures
+        ]
+        if not rows:
+            return
+        with self.transaction() as cursor:
+            # 計算中に更新・削除された所見のシグネチャは保存しない
+            cursor.executemany("""
+                INSERT OR REPLACE INTO shoken_signatures (shoken_id, scheme, signature)
+                SELECT id, ?, ? FROM shoken WHERE id = ? AND updated_at = ?
+            """, rows)
+    
+    def get_created_months(self, class_name: Optional[str] = None) -> List[str]:
+        """
+        所見が作成された年月の一覧を取得
+        
+        Args:
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            
+        Returns:
+            "YYYY-MM" 形式の年月のリスト（新しい順）
+        """
+        conn = self.get_connection()
+        if class_name is None:
+            rows = conn.execute("""
+                SELECT DISTINCT substr(created_at, 1, 7) AS month FROM shoken
+                ORDER BY month DESC
+            """).fetchall()
+        else:
+            rows = conn.execute("""
+                SELECT DISTINCT substr(created_at, 1, 7) AS month FROM shoken
+                WHERE class_name = ?
+                ORDER BY month DESC
+            """, (class_name,)).fetchall()
+        return [row['month'] for row in rows if row['month']]
+    
+    def get_shoken_signatures(self, scheme: str, class_name: Optional[str] = None
+                              ) -> List[Tuple[ShokenRecord, bytes]]:
+        """
+        所見とMinHashシグネチャを取得（シグネチャが最新でない所見は含めない）
+        
+        Args:
+            scheme: 現在のシグネチャの作り方を表す文字列
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            
+        Returns:
+            (所見, シグネチャ) のリスト（児童名順）
+        """
+        conditions = ["sig.scheme = ?"]
+        params: List = [scheme]
+        if class_name is not None:
+            conditions.append("s.class_name = ?")
+            params.append(class_name)
+        
+        columns = ", ".join(f"s.{column.strip()}" for column in SHOKEN_COLUMNS.split(","))
+        conn = self.get_connection()
+        rows = conn.execute(f"""
+            SELECT {columns},
+                   sig.signature
+            FROM shoken AS s
+            JOIN shoken_signatures AS sig ON sig.shoken_id = s.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY s.student_name ASC, s.created_at DESC, s.id ASC
+        """, params).fetchall()
+        return [(ShokenRecord.from_row(row), row['signature']) for row in rows]
+    
+    # 生成メトリクス関連メソッド
+    
+    def save_generation_metrics(self, rows: Iterable[Dict]):
+        """
+        生成の記録をまとめて保存
+        
+        Args:
+            rows: 記録のリスト（GenerationMetrics.to_row の戻り値）
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        with self.transaction() as cursor:
+            cursor.executemany(f"""
+                INSERT INTO generation_metrics ({', '.join(GENERATION_METRICS_COLUMNS)})
+                VALUES ({', '.join(':' + column for column in GENERATION_METRICS_COLUMNS)})
+            """, rows)
+    
+    def get_generation_metrics(self, created_after: str) -> List[Dict]:
+        """
+        生成の記録を取得
+        
+        Args:
+            created_after: この日時（ISO形式）以降の記録を取得する
+            
+        Returns:
+            記録のリスト（作成日時順）
+        """
+        conn = self.get_connection()
+        rows = conn.execute(f"""
+            SELECT {', '.join(GENERATION_METRICS_COLUMNS)}
+            FROM generation_metrics
+            WHERE created_at >= ?
+            ORDER BY created_at
+        """, (created_after,)).fetchall()
+        return [dict(row) for row in rows]
+    
+    # トークン予算関連メソッド
+    
+    def reserve_tokens(self, day: str, limits: List[Tuple[str, str, int]], tokens: int,
+                       expires_before: str) -> Tuple[Optional[int], List[Dict]]:
+        """
+        トークン数を予約（すべての上限に収まる場合のみ、1トランザクションでまとめて予約する）
+        
+        予約の前に、精算されないまま期限の過ぎた予約（予約後にプロセスが終了した場合など）を
+        予約した分を使ったものとして精算する。
         
-        conn.commit()
-        conn.close()
+        Args:
+            day: 日付（ISO形式）
+            limits: (範囲, 名前, 1日の上限) のリスト（上限が0なら上限なしで数えるだけ）
+            tokens: 予約するトークン数
+            expires_before: これより前に作成された予約は期限切れ（ISO形式）
+            
+        Returns:
+            (予約ID（予約できなかった場合はNone）, 範囲ごとの利用量のリスト（予約できた場合は
+            予約後の値）)。利用量は {'scope', 'name', 'limit', 'used_tokens', 'reserved_tokens'}
+        """
+        with self.transaction() as cursor:
+            expired = cursor.execute("""
+                SELECT id, day, keys, tokens FROM token_reservations WHERE created_at < ?
+            """, (expires_before,)).fetchall()
+            for row in expired:
+                _release_token_reservation(cursor, row, row['tokens'])
+            
+            cursor.executemany("""
+                INSERT OR IGNORE INTO token_usage (day, scope, name) VALUES (?, ?, ?)
+            """, [(day, scope, name) for scope, name, _ in limits])
+            usage = []
+            for scope, name, limit in limits:
+                row = cursor.execute("""
+                    SELECT used_tokens, reserved_tokens FROM token_usage
+                    WHERE day = ? AND scope = ? AND name = ?
+                """, (day, scope, name)).fetchone()
+                usage.append({'scope': scope, 'name': name, 'limit': limit, **dict(row)})
+            
+            if any(item['limit'] and item['used_tokens'] + item['reserved_tokens'] + tokens > item['limit']
+                   for item in usage):
+                return None, usage
+            
+            cursor.executemany("""
+                UPDATE token_usage
+                SET reserved_tokens = reserved_tokens + ?, requests = requests + 1
+                WHERE day = ? AND scope = ? AND name = ?
+            """, [(tokens, day, scope, name) for scope, name, _ in limits])
+            cursor.execute("""
+                INSERT INTO token_reservations (day, keys, tokens, created_at) VALUES (?, ?, ?, ?)
+            """, (day, json.dumps([[scope, name] for scope, name, _ in limits], ensure_ascii=False),
+                  tokens, datetime.now().isoformat()))
+            for item in usage:
+                item['reserved_tokens'] += tokens
+            return cursor.lastrowid, usage
+    
+    def settle_tokens(self, reservation_id: int, used_tokens: Optional[int]):
+        """
+        予約したトークン数を精算（予約を取り消し、実際に使った分を利用量に加える）
+        
+        期限切れとして精算済みの予約の場合は何もしない。
+        
+        Args:
+            reservation_id: reserve_tokens が返した予約ID
+            used_tokens: 実際に使ったトークン数（Noneの場合は予約した分を使ったものとする）
+        """
+        with self.transaction() as cursor:
+            row = cursor.execute("""
+                SELECT id, day, keys, tokens FROM token_reservations WHERE id = ?
+            """, (reservation_id,)).fetchone()
+            if row is not None:
+                _release_token_reservation(cursor, row, row['tokens'] if used_tokens is None else used_tokens)
+    
+    def add_token_usage(self, day: str, keys: List[Tuple[str, str]], used_tokens: int):
+        """
+        予約せずにトークン数の利用量を加える
+        
+        Args:
+            day: 日付（ISO形式）
+            keys: (範囲, 名前) のリスト
+            used_tokens: 加えるトークン数
+        """
+        with self.transaction() as cursor:
+            cursor.executemany("""
+                INSERT OR IGNORE INTO token_usage (day, scope, name) VALUES (?, ?, ?)
+            """, [(day, scope, name) for scope, name in keys])
+            cursor.executemany("""
+                UPDATE token_usage
+                SET used_tokens = used_tokens + ?, requests = requests + 1
+                WHERE day = ? AND scope = ? AND name = ?
+            """, [(used_tokens, day, scope, name) for scope, name in keys])
+    
+    def count_token_reservations(self) -> int:
+        """
+        精算されていない予約の件数を取得
+        
+        Returns:
+            件数
+        """
+        conn = self.get_connection()
+        return conn.execute("SELECT COUNT(*) FROM token_reservations").fetchone()[0]
+    
+    def get_token_usage(self, day: str, keys: List[Tuple[str, str]]) -> List[Dict]:
+        """
+        トークン数の利用量を取得
+        
+        Args:
+            day: 日付（ISO形式）
+            keys: (範囲, 名前) のリスト
+            
+        Returns:
+            keys と同じ順の利用量のリスト
+            （{'scope', 'name', 'used_tokens', 'reserved_tokens', 'requests'}。記録がなければ0）
+        """
+        conn = self.get_connection()
+        usage = []
+        for scope, name in keys:
+            row = conn.execute("""
+                SELECT used_tokens, reserved_tokens, requests FROM token_usage
+                WHERE day = ? AND scope = ? AND name = ?
+            """, (day, scope, name)).fetchone()
+            usage.append({
+                'scope': scope,
+                'name': name,
+                **(dict(row) if row else {'used_tokens': 0, 'reserved_tokens': 0, 'requests': 0}),
+            })
+        return usage
+
+
+def _release_token_reservation(cursor: sqlite3.Cursor, reservation: sqlite3.Row, used_tokens: int):
+    """予約を取り消し、使ったトークン数を利用量に加える"""
+    cursor.executemany("""
+        UPDATE token_usage
+        SET reserved_tokens = MAX(0, reserved_tokens - ?), used_tokens = used_tokens + ?
+        WHERE day = ? AND scope = ? AND name = ?
+    """, [(reservation['tokens'], used_tokens, reservation['day'], scope, name)
+          for scope, name in json.loads(reservation['keys'])])
+    cursor.execute("DELETE FROM token_reservations WHERE id = ?", (reservation['id'],))
+
+
+_database: Optional[Database] = None
+_database_lock = threading.Lock()
+
+
+def get_database() -> Database:
+    """
+    プロセス全体で共有する既定のファイルの Database を取得
+    
+    アプリ・生成結果キャッシュ・生成の記録・トークン予算が同じ接続を使い、
+    マイグレーションの確認もプロセスで1回だけ行う。
+    
+    Returns:
+        共有のデータベース
+    """
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = Database()
+        return _database
+
+
+# マイグレーション
+# 既存の tuutihyou.db もそのままアップグレードできるよう、
+# 各マイグレーションは適用済みの状態を考慮して記述する
+
+def _column_exists(cursor: sqlite3.Cursor, table: str, column: str) -> bool:
+    """テーブルにカラムが存在するか確認"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+
+def _migrate_base_tables(cursor: sqlite3.Cursor):
+    """v1: 基本テーブルを作成"""
+    # 所見テーブル
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS shoken (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_name TEXT,
+            class_name TEXT,
+            keywords TEXT,
+            content TEXT,
+            character_count INTEGER,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    """)
+    
+    # class_nameカラムがない古いテーブルにカラムを追加
+    if not _column_exists(cursor, "shoken", "class_name"):
+        cursor.execute("ALTER TABLE shoken ADD COLUMN class_name TEXT")
+    
+    # キーワード履歴テーブル
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS keyword_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            keyword TEXT,
+            usage_count INTEGER DEFAULT 1,
+            last_used_at TEXT,
+            created_at TEXT
+        )
+    """)
+    
+    # 設定テーブル
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+
+def _migrate_indexes(cursor: sqlite3.Cursor):
+    """v2: 所見とキーワード履歴の検索用インデックスを作成"""
+    # UNIQUEインデックスを張る前に、重複したキーワードを1行にまとめる
+    cursor.execute("""
+        UPDATE keyword_history
+        SET usage_count = (
+                SELECT SUM(usage_count) FROM keyword_history AS dup
+                WHERE dup.keyword = keyword_history.keyword
+            ),
+            last_used_at = (
+                SELECT MAX(last_used_at) FROM keyword_history AS dup
+                WHERE dup.keyword = keyword_history.keyword
+            )
+        WHERE keyword IN (
+            SELECT keyword FROM keyword_history GROUP BY keyword HAVING COUNT(*) > 1
+        )
+    """)
+    cursor.execute("""
+        DELETE FROM keyword_history
+        WHERE id NOT IN (SELECT MIN(id) FROM keyword_history GROUP BY keyword)
+    """)
+    
+    # get_shoken_by_class: class_name で絞り込み、student_name, created_at DESC で並べる
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_shoken_class_student
+        ON shoken (class_name, student_name, created_at DESC)
+    """)
+    # get_all_shoken: created_at で並べる
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_shoken_created_at
+        ON shoken (created_at)
+    """)
+    # add_keyword_history: keyword で検索
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_keyword_history_keyword
+        ON keyword_history (keyword)
+    """)
+    # get_popular_keywords: usage_count, last_used_at で並べる
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_keyword_history_usage
+        ON keyword_history (usage_count DESC, last_used_at DESC)
+    """)
+
+
+# 所見のキーワード（JSON配列）を shoken_keywords に展開するSQL
+# 不正なJSONや空文字はスキップする
+_SHOKEN_KEYWORD_VALUES = """
+    SELECT DISTINCT value FROM json_each(
+        CASE WHEN json_valid({keywords}) THEN {keywords} ELSE '[]' END
+    )
+    WHERE type = 'text' AND value != ''
+"""
+
+
+def _insert_shoken_keywords_sql(shoken_id: str, keywords: str) -> str:
+    """所見のキーワードを keywords / shoken_keywords に登録するSQLを作成"""
+    values = _SHOKEN_KEYWORD_VALUES.format(keywords=keywords)
+    return f"""
+        INSERT OR IGNORE INTO keywords (keyword) {values};
+        INSERT OR IGNORE INTO shoken_keywords (shoken_id, keyword_id)
+        SELECT {shoken_id}, k.id FROM ({values}) AS kw
+        JOIN keywords AS k ON k.keyword = kw.value;
+    """
+
+
+def _migrate_shoken_keywords(cursor: sqlite3.Cursor):
+    """v3: キーワードを正規化した shoken_keywords テーブルを作成"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS keywords (
+            id INTEGER PRIMARY KEY,
+            keyword TEXT NOT NULL UNIQUE
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS shoken_keywords (
+            shoken_id INTEGER NOT NULL,
+            keyword_id INTEGER NOT NULL,
+            PRIMARY KEY (shoken_id, keyword_id)
+        ) WITHOUT ROWID
+    """)
+    # 「キーワードXを使った所見」「キーワードごとの件数」用
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_shoken_keywords_keyword
+        ON shoken_keywords (keyword_id, shoken_id)
+    """)
+    
+    # save_shoken / update_shoken / delete_shoken に追従させるトリガー
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS shoken_keywords_after_insert
+        AFTER INSERT ON shoken
+        BEGIN
+            {_insert_shoken_keywords_sql("NEW.id", "NEW.keywords")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS shoken_keywords_after_update
+        AFTER UPDATE OF keywords ON shoken
+        BEGIN
+            DELETE FROM shoken_keywords WHERE shoken_id = OLD.id;
+            {_insert_shoken_keywords_sql("NEW.id", "NEW.keywords")}
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS shoken_keywords_after_delete
+        AFTER DELETE ON shoken
+        BEGIN
+            DELETE FROM shoken_keywords WHERE shoken_id = OLD.id;
+        END
+    """)
+    
+    # 既存の所見のJSONから埋める
+    cursor.execute("""
+        INSERT OR IGNORE INTO keywords (keyword)
+        SELECT DISTINCT kw.value FROM shoken AS s, json_each(
+            CASE WHEN json_valid(s.keywords) THEN s.keywords ELSE '[]' END
+        ) AS kw
+        WHERE kw.type = 'text' AND kw.value != ''
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO shoken_keywords (shoken_id, keyword_id)
+        SELECT s.id, k.id FROM shoken AS s, json_each(
+            CASE WHEN json_valid(s.keywords) THEN s.keywords ELSE '[]' END
+        ) AS kw
+        JOIN keywords AS k ON k.keyword = kw.value
+        WHERE kw.type = 'text'
+    """)
+
+
+def _migrate_empty_class_names(cursor: sqlite3.Cursor):
+    """v4: class_name が NULL の所見を空文字列（クラス未設定）に揃える"""
+    # クラス未設定の所見が NULL と空文字列の2グループに分かれないようにする
+    cursor.execute("UPDATE shoken SET class_name = '' WHERE class_name IS NULL")
+
+
+def _migrate_full_text_search(cursor: sqlite3.Cursor):
+    """v5: 所見文・児童名・キーワードの全文検索用FTS5テーブルを作成"""
+    # 日本語は分かち書きされないため trigram トークナイザを使う
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS shoken_fts USING fts5(
+                content, student_name, keywords,
+                content = 'shoken', content_rowid = 'id',
+                tokenize = 'trigram'
+            )
+        """)
+    except sqlite3.OperationalError:
+        # FTS5（trigram）に対応していないSQLiteでは部分一致検索で代用する
+        return
+    
+    # save_shoken / update_shoken / delete_shoken に追従させるトリガー
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS shoken_fts_after_insert
+        AFTER INSERT ON shoken
+        BEGIN
+            INSERT INTO shoken_fts (rowid, content, student_name, keywords)
+            VALUES (NEW.id, NEW.content, NEW.student_name, NEW.keywords);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS shoken_fts_after_update
+        AFTER UPDATE OF content, student_name, keywords ON shoken
+        BEGIN
+            INSERT INTO shoken_fts (shoken_fts, rowid, content, student_name, keywords)
+            VALUES ('delete', OLD.id, OLD.content, OLD.student_name, OLD.keywords);
+            INSERT INTO shoken_fts (rowid, content, student_name, keywords)
+            VALUES (NEW.id, NEW.content, NEW.student_name, NEW.keywords);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS shoken_fts_after_delete
+        AFTER DELETE ON shoken
+        BEGIN
+            INSERT INTO shoken_fts (shoken_fts, rowid, content, student_name, keywords)
+            VALUES ('delete', OLD.id, OLD.content, OLD.student_name, OLD.keywords);
+        END
+    """)
+    
+    # 既存の所見を索引に登録
+    cursor.execute("INSERT INTO shoken_fts (shoken_fts) VALUES ('rebuild')")
+
+
+def _migrate_data_version(cursor: sqlite3.Cursor):
+    """v6: 変更のたびに増えるデータバージョンのカウンタを作成"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)")
+    
+    # 所見とキーワード履歴の変更と同じトランザクションでカウンタを増やす
+    for table, events in (("shoken", ("INSERT", "UPDATE", "DELETE")),
+                          ("keyword_history", ("INSERT", "UPDATE", "DELETE"))):
+        for event in events:
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS data_version_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_version SET version = version + 1 WHERE id = 1;
+                END
+            """)
+
+
+def _migrate_response_cache(cursor: sqlite3.Cursor):
+    """v7: OpenAI APIの生成結果キャッシュ"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS response_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cache_key TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            last_used_at TEXT NOT NULL,
+            use_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # キーごとの候補の取り出し・LRUでの削除・期限切れの削除に使う
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_response_cache_key
+        ON response_cache(cache_key, last_used_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_response_cache_last_used
+        ON response_cache(last_used_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_response_cache_created_at
+        ON response_cache(created_at)
+    """)
+
+
+def _migrate_shoken_signatures(cursor: sqlite3.Cursor):
+    """v8: 類似度チェック用のMinHashシグネチャ"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS shoken_signatures (
+            shoken_id INTEGER PRIMARY KEY,
+            scheme TEXT NOT NULL,
+            signature BLOB NOT NULL
+        )
+    """)
+    
+    # 所見文が変わったり削除されたりしたシグネチャは消しておき、次のチェック時に計算し直す
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS shoken_signatures_after_update
+        AFTER UPDATE OF content ON shoken
+        WHEN OLD.content IS NOT NEW.content
+        BEGIN
+            DELETE FROM shoken_signatures WHERE shoken_id = OLD.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS shoken_signatures_after_delete
+        AFTER DELETE ON shoken
+        BEGIN
+            DELETE FROM shoken_signatures WHERE shoken_id = OLD.id;
+        END
+    """)
+
+
+def _migrate_generation_metrics(cursor: sqlite3.Cursor):
+    """v9: 所見文の生成1回ごとの記録"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS generation_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            model TEXT NOT NULL,
+            class_name TEXT NOT NULL DEFAULT '',
+            candidates INTEGER NOT NULL DEFAULT 1,
+            streamed INTEGER NOT NULL DEFAULT 0,
+            cache_hit INTEGER NOT NULL DEFAULT 0,
+            api_calls INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            retries INTEGER NOT NULL DEFAULT 0,
+            latency_ms REAL,
+            first_token_ms REAL,
+            length_outcome TEXT,
+            extra_calls INTEGER NOT NULL DEFAULT 0,
+            error TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_generation_metrics_created_at
+        ON generation_metrics(created_at)
+    """)
+
+
+def _migrate_token_usage(cursor: sqlite3.Cursor):
+    """v10: 1日ごとのトークン数の利用量（アプリ全体・先生ごと・クラスごと）"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS token_usage (
+            day TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            name TEXT NOT NULL,
+            used_tokens INTEGER NOT NULL DEFAULT 0,
+            reserved_tokens INTEGER NOT NULL DEFAULT 0,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, scope, name)
+        ) WITHOUT ROWID
+    """)
+
+
+def _migrate_token_reservations(cursor: sqlite3.Cursor):
+    """v11: 精算されていないトークンの予約（期限切れの予約を精算するため）"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS token_reservations (
+            id INTEGER PRIMARY KEY,
+            day TEXT NOT NULL,
+            keys TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_token_reservations_created_at
+        ON token_reservations(created_at)
+    """)
+
+
+def _migrate_roster(cursor: sqlite3.Cursor):
+    """v12: 所見文のない名簿（取り込み済みの空の所見は、児童ごとにキーワードをまとめて名簿に移す）"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS roster (
+            class_name TEXT NOT NULL DEFAULT '',
+            student_name TEXT NOT NULL,
+            keywords TEXT NOT NULL DEFAULT '[]',
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (class_name, student_name)
+        )
+    """)
+    
+    # 同じクラス・児童名の空の所見が複数ある場合は、キーワードをまとめてから移す
+    # （1行だけ移して残りを削除すると、その行のキーワードが失われる）
+    students: Dict[Tuple[str, str], Tuple[List[str], str]] = {}
+    cursor.execute("""
+        SELECT class_name, student_name, keywords, created_at
+        FROM shoken WHERE content = ''
+        ORDER BY id
+    """)
+    for class_name, student_name, keywords_json, created_at in cursor.fetchall():
+        try:
+            keywords = json.loads(keywords_json) if keywords_json else []
+        except ValueError:
+            keywords = []
+        merged, _ = students.setdefault((class_name or "", student_name), ([], created_at))
+        merged.extend(keyword for keyword in keywords if keyword not in merged)
+    
+    cursor.executemany("""
+        INSERT OR IGNORE INTO roster (class_name, student_name, keywords, created_at)
+        VALUES (?, ?, ?, ?)
+    """, [
+        (class_name, student_name, json.dumps(keywords, ensure_ascii=False), created_at)
+        for (class_name, student_name), (keywords, created_at) in students.items()
+    ])
+    cursor.execute("DELETE FROM shoken WHERE content = ''")
+
+
+def _migrate_roster_data_version(cursor: sqlite3.Cursor):
+    """v13: 名簿の変更でもデータバージョンのカウンタを増やす（名簿の読み取りをキャッシュするため）"""
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS data_version_roster_{event.lower()}
+            AFTER {event} ON roster
+            BEGIN
+                UPDATE data_version SET version = version + 1 WHERE id = 1;
+            END
+        """)
+
+
+# (バージョン, 説明, 適用関数) のリスト。新しいマイグレーションは末尾に追加する
+MIGRATIONS = [
+    (1, "基本テーブル", _migrate_base_tables),
+    (2, "所見・キーワード履歴のインデックス", _migrate_indexes),
+    (3, "キーワードの正規化（shoken_keywords）", _migrate_shoken_keywords),
+    (4, "クラス未設定の class_name を空文字列に統一", _migrate_empty_class_names),
+    (5, "所見の全文検索（FTS5）", _migrate_full_text_search),
+    (6, "データバージョンのカウンタ", _migrate_data_version),
+    (7, "生成結果キャッシュ", _migrate_response_cache),
+    (8, "類似度チェック用のシグネチャ", _migrate_shoken_signatures),
+    (9, "生成メトリクス", _migrate_generation_metrics),
+    (10, "トークン予算の利用量", _migrate_token_usage),
+    (11, "トークンの予約", _migrate_token_reservations),
+    (12, "名簿", _migrate_roster),
+    (13, "名簿のデータバージョン", _migrate_roster_data_version),
+]
@@ -5,6 +5,7 @@
 
 from typing import Optional
 import openai
+from token_budget import BudgetExceededError
 
 
 def get_user_friendly_error(error: Exception) -> tuple[str, str]:
@@ -20,6 +21,14 @@ def get_user_friendly_error(error: Exception) -> tuple[str, str]:
     error_type = type(error).__name__
     error_message = str(error)
     
+    # トークン予算を超えたため送信しなかった場合
+    if isinstance(error, BudgetExceededError):
+        return (
+            "⚠️ **今日のAIの利用量の上限に達しました**",
+            "💡 解決方法: 「テンプレートで作成」を選ぶか、明日もう一度お試しください。"
+            "上限を変更する場合は開発者に連絡してください。"
+        )
+    
     # OpenAI API関連のエラー
     if isinstance(error, openai.AuthenticationError):
         return (
@@ -0,0 +1,474 @@
+"""
+生成バックエンドモジュール
+所見文の生成に使うバックエンド（API呼び出し部分）のインターフェースと、
+オフラインで使える疑似バックエンド・記録／再生バックエンドを提供
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Generator, List, Optional, Protocol
+
+import prompt_templates
+
+
+@dataclass
+class Completion:
+    """
+    バックエンドの応答1回分
+    
+    n > 1 で呼び出した場合、text は1つ目の候補で、残りの候補は alternatives に
+    入る。トークン数は呼び出し全体の値（alternatives の分を含む）。
+    """
+    
+    text: str
+    finish_reason: Optional[str] = "stop"
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    alternatives: List["Completion"] = field(default_factory=list)
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Completion":
+        """asdict で辞書にしたものから復元"""
+        data = dict(data)
+        data["alternatives"] = [cls.from_dict(item) for item in data.get("alternatives", [])]
+        return cls(**data)
+    
+    @property
+    def texts(self) -> List[str]:
+        """すべての候補のテキスト"""
+        return [self.text] + [alternative.text for alternative in self.alternatives]
+    
+    @property
+    def total_tokens(self) -> Optional[int]:
+        """合計トークン数（不明な場合はNone）"""
+        if self.prompt_tokens is None or self.completion_tokens is None:
+            return None
+        return self.prompt_tokens + self.completion_tokens
+
+
+class GenerationBackend(Protocol):
+    """
+    生成バックエンドのインターフェース
+    
+    メッセージを受け取って応答を返す部分だけを担当する。プロンプトの構築・
+    文字数調整・キャッシュは OpenAIClient・AsyncOpenAIClient が行う。n は1回の呼び出しで
+    生成する候補の数。
+    """
+    
+    model: str
+    
+    def complete(self, messages: List[Dict], max_tokens: int, temperature: float,
+                 n: int = 1) -> Completion:
+        """応答をまとめて取得"""
+        ...
+    
+    def stream(self, messages: List[Dict], max_tokens: int, temperature: float,
+               n: int = 1) -> Generator[str, None, Completion]:
+        """1つ目の候補を届いた順に返し、最後に応答全体を戻り値とする"""
+        ...
+
+
+class AsyncGenerationBackend(Protocol):
+    """
+    生成バックエンドの非同期のインターフェース（AsyncOpenAIClient が使う）
+    
+    GenerationBackend と同じ応答を、イベントループを止めずに返す。
+    """
+    
+    model: str
+    
+    async def complete_async(self, messages: List[Dict], max_tokens: int, temperature: float,
+                             n: int = 1) -> Completion:
+        """応答をまとめて取得"""
+        ...
+    
+    async def stream_async(self, messages: List[Dict], max_tokens: int, temperature: float,
+                           n: int = 1, on_delta: Optional[Callable[[str], None]] = None) -> Completion:
+        """1つ目の候補に届いた文字列を順に on_delta に渡し、応答全体を返す"""
+        ...
+
+
+def _chunks(text: str, size: int) -> Generator[str, None, None]:
+    """テキストを size 文字ずつに分ける"""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def _request_key(messages: List[Dict], temperature: float, n: int = 1) -> str:
+    """
+    リクエストを識別するキー
+    
+    max_tokens は学習した1文字あたりのトークン数によって実行ごとに変わるため含めない。
+    """
+    payload = json.dumps([messages, temperature, n], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class StubBackendError(Exception):
+    """疑似バックエンドが発生させるエラー（一時的なサーバーエラーとして扱われる）"""
+    
+    status_code = 503
+
+
+# 疑似バックエンドが所見文の代わりに返す文
+_STUB_SENTENCES = [
+    "明るく元気に学校生活を送っています。",
+    "授業では自分の考えを進んで発表する姿が見られます。",
+    "算数のグラフの学習に意欲的に取り組んでいます。",
+    "友達に優しく声をかけ、困っている人を助ける姿が印象的です。",
+    "掃除の時間には隅々まで丁寧に取り組んでいます。",
+    "係活動では責任感を持って仕事をやり遂げました。",
+    "今後も持ち前の明るさを活かして、さらに成長してほしいと願っています。",
+]
+
+# プロンプトから目標文字数を読み取る（書き足し・要約の指示を優先する）
+_TARGET_PATTERNS = [re.compile(r"全体で(\d+)文字"), re.compile(r"約(\d+)文字（")]
+
+
+class StubBackend:
+    """
+    オフラインの疑似バックエンド（負荷試験・ベンチマーク用）
+    
+    APIを呼ばずに、同じリクエストには同じ文章を返す。応答時間・エラーの
+    発生率・文字数を設定できる。1文字を1トークンとして数える。
+    """
+    
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0,
+                 output_length: Optional[int] = None, length_jitter: float = 0.0,
+                 stream_interval: float = 0.0, chunk_size: int = 10,
+                 seed: int = 0, model: str = "stub"):
+        """
+        Args:
+            latency: 応答（ストリーミングでは最初の文字）までの秒数
+            error_rate: エラーを発生させる割合（0〜1）
+            output_length: 返す文字数（Noneならプロンプトの目標文字数）
+            length_jitter: 文字数のばらつき（0.1なら±10%）
+            stream_interval: ストリーミングで次の文字列を返すまでの秒数
+            chunk_size: ストリーミングで1回に返す文字数
+            seed: 乱数の種（同じ種なら同じ順にエラーが発生する）
+            model: モデル名として報告する名前
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.output_length = output_length
+        self.length_jitter = length_jitter
+        self.stream_interval = stream_interval
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.model = model
+        self._errors = random.Random(seed)
+        self._lock = threading.Lock()
+    
+    def _target_length(self, messages: List[Dict]) -> int:
+        """返す文字数を決める"""
+        if self.output_length is not None:
+            return self.output_length
+        content = messages[-1]["content"]
+        for pattern in _TARGET_PATTERNS:
+            match = pattern.search(content)
+            if match:
+                return int(match.group(1))
+        return 200
+    
+    def _respond(self, messages: List[Dict], max_tokens: int, n: int) -> Completion:
+        """リクエストに対する応答を作成（エラーを発生させる場合もある）"""
+        with self._lock:
+            failed = self._errors.random() < self.error_rate
+        if failed:
+            raise StubBackendError("stub backend error")
+        
+        choices = [self._choice(messages, max_tokens, index) for index in range(n)]
+        completion = choices[0]
+        completion.alternatives = choices[1:]
+        # オフラインで動かすため、tiktoken のエンコーディングは読み込まずに見積もる
+        completion.prompt_tokens = prompt_templates.count_message_tokens(messages, estimate=True)
+        completion.completion_tokens = sum(len(choice.text) for choice in choices)
+        return completion
+    
+    def _choice(self, messages: List[Dict], max_tokens: int, index: int) -> Completion:
+        """候補を1つ作成（同じリクエストの同じ番号なら同じ文章）"""
+        rng = random.Random(self.seed ^ zlib.crc32(_request_key(messages, 0, index).encode("ascii")))
+        length = self._target_length(messages)
+        if self.length_jitter:
+            length = round(length * (1 + rng.uniform(-self.length_jitter, self.length_jitter)))
+        
+        text = ""
+        while len(text) < length:
+            text += rng.choice(_STUB_SENTENCES)
+        # 目標の文字数に近い文の区切りで止める
+        cut = text.rfind("。", 0, length + 1)
+        if cut > 0 and length - cut < 20:
+            text = text[:cut + 1]
+        
+        finish_reason = "stop"
+        if len(text) > max_tokens:
+            text, finish_reason = text[:max_tokens], "length"
+        return Completion(text=text, finish_reason=finish_reason)
+    
+    def complete(self, messages: List[Dict], max_tokens: int, temperature: float,
+                 n: int = 1) -> Completion:
+        """
+        応答をまとめて取得
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度（疑似バックエンドでは使わない）
+            n: 生成する候補の数
+            
+        Returns:
+            応答
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        return self._respond(messages, max_tokens, n)
+    
+    def stream(self, messages: List[Dict], max_tokens: int, temperature: float,
+               n: int = 1) -> Generator[str, None, Completion]:
+        """
+        1つ目の候補を届いた順に返す
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度（疑似バックエンドでは使わない）
+            n: 生成する候補の数
+            
+        Yields:
+            応答の文字列
+            
+        Returns:
+            応答全体
+        """
+        completion = self.complete(messages, max_tokens, temperature, n)
+        for chunk in _chunks(completion.text, self.chunk_size):
+            if self.stream_interval:
+                time.sleep(self.stream_interval)
+            yield chunk
+        return completion
+    
+    async def complete_async(self, messages: List[Dict], max_tokens: int, temperature: float,
+                             n: int = 1) -> Completion:
+        """
+        complete の非同期版（応答を待つ間もイベントループは止めない）
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度（疑似バックエンドでは使わない）
+            n: 生成する候補の数
+            
+        Returns:
+            応答
+        """
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(messages, max_tokens, n)
+    
+    async def stream_async(self, messages: List[Dict], max_tokens: int, temperature: float,
+                           n: int = 1, on_delta: Optional[Callable[[str], None]] = None) -> Completion:
+        """
+        stream の非同期版
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度（疑似バックエンドでは使わない）
+            n: 生成する候補の数
+            on_delta: 1つ目の候補の文字列が届くたびに呼ばれる関数
+            
+        Returns:
+            応答全体
+        """
+        completion = await self.complete_async(messages, max_tokens, temperature, n)
+        for chunk in _chunks(completion.text, self.chunk_size):
+            if self.stream_interval:
+                await asyncio.sleep(self.stream_interval)
+            if on_delta:
+                on_delta(chunk)
+        return completion
+
+
+class ReplayMissError(LookupError):
+    """記録にないリクエストを再生しようとした"""
+
+
+class RecordReplayBackend:
+    """
+    記録／再生バックエンド
+    
+    backend を指定した場合は、そのバックエンドの応答をファイルに記録する。
+    指定しない場合は、記録済みの応答をファイルから返す（記録にない
+    リクエストは ReplayMissError）。非同期版のメソッドは、backend が
+    AsyncGenerationBackend でなければ同期版のメソッドを別スレッドで呼び出す。
+    """
+    
+    def __init__(self, path: str, backend: Optional[GenerationBackend] = None,
+                 chunk_size: int = 10):
+        """
+        Args:
+            path: 記録ファイル（JSON）のパス
+            backend: 記録するバックエンド（Noneなら再生のみ）
+            chunk_size: 再生時のストリーミングで1回に返す文字数
+        """
+        self.path = path
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        
+        recorded = {"model": backend.model if backend else "replay", "responses": {}}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                recorded = json.load(f)
+        self.model = backend.model if backend else recorded["model"]
+        self._responses: Dict[str, Dict] = recorded["responses"]
+    
+    def _save(self):
+        """記録をファイルに書き出す（書き込み途中のファイルが残らないよう置き換える）"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"model": self.model, "responses": self._responses}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+    
+    def _record(self, key: str, completion: Completion):
+        """応答を記録"""
+        with self._lock:
+            self._responses[key] = asdict(completion)
+            self._save()
+    
+    def _replay(self, key: str) -> Completion:
+        """記録済みの応答を取得"""
+        with self._lock:
+            recorded = self._responses.get(key)
+        if recorded is None:
+            raise ReplayMissError(f"記録にないリクエストです: {key[:12]}")
+        return Completion.from_dict(recorded)
+    
+    def __len__(self) -> int:
+        return len(self._responses)
+    
+    def complete(self, messages: List[Dict], max_tokens: int, temperature: float,
+                 n: int = 1) -> Completion:
+        """
+        応答をまとめて取得
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度
+            n: 生成する候補の数
+            
+        Returns:
+            応答
+        """
+        key = _request_key(messages, temperature, n)
+        if self.backend is None:
+            return self._replay(key)
+        
+        completion = self.backend.complete(messages, max_tokens, temperature, n)
+        self._record(key, completion)
+        return completion
+    
+    def stream(self, messages: List[Dict], max_tokens: int, temperature: float,
+               n: int = 1) -> Generator[str, None, Completion]:
+        """
+        1つ目の候補を届いた順に返す
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度
+            n: 生成する候補の数
+            
+        Yields:
+            応答の文字列
+            
+        Returns:
+            応答全体
+        """
+        key = _request_key(messages, temperature, n)
+        if self.backend is None:
+            completion = self._replay(key)
+            yield from _chunks(completion.text, self.chunk_size)
+            return completion
+        
+        completion = yield from self.backend.stream(messages, max_tokens, temperature, n)
+        self._record(key, completion)
+        return completion
+    
+    async def complete_async(self, messages: List[Dict], max_tokens: int, temperature: float,
+                             n: int = 1) -> Completion:
+        """
+        complete の非同期版（ファイルへの記録は別スレッドで行う）
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度
+            n: 生成する候補の数
+            
+        Returns:
+            応答
+        """
+        key = _request_key(messages, temperature, n)
+        if self.backend is None:
+            return self._replay(key)
+        
+        if hasattr(self.backend, "complete_async"):
+            completion = await self.backend.complete_async(messages, max_tokens, temperature, n)
+        else:
+            completion = await asyncio.to_thread(self.backend.complete, messages, max_tokens, temperature, n)
+        await asyncio.to_thread(self._record, key, completion)
+        return completion
+    
+    async def stream_async(self, messages: List[Dict], max_tokens: int, temperature: float,
+                           n: int = 1, on_delta: Optional[Callable[[str], None]] = None) -> Completion:
+        """
+        stream の非同期版
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度
+            n: 生成する候補の数
+            on_delta: 1つ目の候補の文字列が届くたびに呼ばれる関数
+            
+        Returns:
+            応答全体
+        """
+        key = _request_key(messages, temperature, n)
+        if self.backend is None:
+            completion = self._replay(key)
+            if on_delta:
+                for chunk in _chunks(completion.text, self.chunk_size):
+                    on_delta(chunk)
+            return completion
+        
+        if hasattr(self.backend, "stream_async"):
+            completion = await self.backend.stream_async(messages, max_tokens, temperature, n, on_delta)
+        else:
+            completion = await asyncio.to_thread(
+                self._drain_stream, asyncio.get_running_loop(), messages, max_tokens, temperature, n, on_delta
+            )
+        await asyncio.to_thread(self._record, key, completion)
+        return completion
+    
+    def _drain_stream(self, loop: asyncio.AbstractEventLoop, messages: List[Dict], max_tokens: int,
+                      temperature: float, n: int, on_delta: Optional[Callable[[str], None]]) -> Completion:
+        """同期版のバックエンドのストリーミングを読み切り、届いた文字列は loop で on_delta に渡す"""
+        deltas = self.backend.stream(messages, max_tokens, temperature, n)
+        while True:
+            try:
+                delta = next(deltas)
+            except StopIteration as stop:
+                return stop.value
+            if on_delta:
+                loop.call_soon_threadsafe(on_delta, delta)
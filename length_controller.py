@@ -0,0 +1,244 @@
+"""
+文字数制御モジュール
+目標文字数に合わせて max_tokens を決め、生成結果の文字数を整える
+"""
+
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+# 目標文字数からの許容範囲（±文字数）
+LENGTH_TOLERANCE = 20
+
+# 1文字あたりのトークン数の初期値（日本語は1文字1トークン前後）
+DEFAULT_TOKENS_PER_CHAR = 1.2
+# 1文字あたりのトークン数の指数移動平均の重み
+TOKENS_PER_CHAR_ALPHA = 0.2
+
+# max_tokens の余裕（上限に達して文が途中で切れないようにする）
+MAX_TOKENS_HEADROOM = 1.3
+MIN_MAX_TOKENS = 64
+MAX_MAX_TOKENS = 2000
+
+# 文字数を直すために追加で呼び出す最大回数
+MAX_FIX_CALLS = 2
+
+# 文末の記号
+_SENTENCE_ENDINGS = "。！？!?"
+# 括弧（中の文末の記号では文を区切らない。例:「自分でできた！」という気持ち）
+_OPENING_BRACKETS = "「『（("
+_CLOSING_BRACKETS = "」』）)"
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    テキストを文末（括弧の外の句点など）で1文ずつに分ける
+    
+    Args:
+        text: テキスト
+        
+    Returns:
+        文のリスト（文末で終わっていない末尾の部分は含めない）
+    """
+    sentences = []
+    start = 0
+    depth = 0
+    for i, char in enumerate(text):
+        if char in _OPENING_BRACKETS:
+            depth += 1
+        elif char in _CLOSING_BRACKETS:
+            depth = max(0, depth - 1)
+        elif char in _SENTENCE_ENDINGS and depth == 0:
+            sentences.append(text[start:i + 1])
+            start = i + 1
+    return sentences
+
+
+class LengthController:
+    """
+    生成する所見文の文字数を目標に合わせる
+    
+    過去の応答から1文字あたりのトークン数を学習して max_tokens を決める。
+    短すぎる場合は書き足しを、長すぎる場合は文の区切りでの切り詰めか
+    要約を行う。文字数を直すために追加でかかった呼び出し回数を記録する。
+    """
+    
+    def __init__(self, tolerance: int = LENGTH_TOLERANCE,
+                 tokens_per_char: float = DEFAULT_TOKENS_PER_CHAR,
+                 max_fix_calls: int = MAX_FIX_CALLS):
+        """
+        Args:
+            tolerance: 目標文字数からの許容範囲（±文字数）
+            tokens_per_char: 1文字あたりのトークン数の初期値
+            max_fix_calls: 文字数を直すために追加で呼び出す最大回数
+        """
+        self.tolerance = tolerance
+        self.tokens_per_char = tokens_per_char
+        self.max_fix_calls = max_fix_calls
+        self.generations = 0
+        self.extra_calls = 0
+        self.within_tolerance = 0
+        self._lock = threading.Lock()
+    
+    def max_tokens_for(self, target_length: int) -> int:
+        """
+        目標文字数に対する max_tokens を計算
+        
+        Args:
+            target_length: 目標文字数
+            
+        Returns:
+            max_tokens
+        """
+        tokens = (target_length + self.tolerance) * self.tokens_per_char * MAX_TOKENS_HEADROOM
+        return max(MIN_MAX_TOKENS, min(MAX_MAX_TOKENS, math.ceil(tokens)))
+    
+    def observe(self, text: str, completion_tokens: Optional[int]):
+        """
+        応答の文字数とトークン数から、1文字あたりのトークン数を更新
+        
+        Args:
+            text: 生成されたテキスト
+            completion_tokens: 生成に使われたトークン数（不明な場合はNone）
+        """
+        if not completion_tokens or not text:
+            return
+        ratio = completion_tokens / len(text)
+        with self._lock:
+            self.tokens_per_char += TOKENS_PER_CHAR_ALPHA * (ratio - self.tokens_per_char)
+    
+    def is_within(self, text: str, target_length: int) -> bool:
+        """文字数が許容範囲内か"""
+        return abs(len(text) - target_length) <= self.tolerance
+    
+    def drop_incomplete_sentence(self, text: str) -> str:
+        """
+        末尾の途中で切れた文を取り除く（max_tokens に達した場合に使う）
+        
+        Args:
+            text: 生成されたテキスト
+            
+        Returns:
+            文末で終わるテキスト（完結した文がない場合は元のテキスト）
+        """
+        complete = "".join(split_sentences(text))
+        return complete or text
+    
+    def trim(self, text: str, target_length: int) -> str:
+        """
+        長すぎるテキストを文の区切りで切り詰める
+        
+        Args:
+            text: 元のテキスト
+            target_length: 目標文字数
+            
+        Returns:
+            上限（目標文字数＋許容範囲）以内のテキスト
+        """
+        limit = target_length + self.tolerance
+        if len(text) <= limit:
+            return text
+        
+        result = ""
+        for sentence in split_sentences(text):
+            if len(result) + len(sentence) > limit:
+                break
+            result += sentence
+        if result:
+            return result
+        
+        # 1文目から上限を超える場合は、括弧の外の読点の位置で文を閉じる
+        head = text[:limit - 1]
+        comma = -1
+        depth = 0
+        for i, char in enumerate(head):
+            if char in _OPENING_BRACKETS:
+                depth += 1
+            elif char in _CLOSING_BRACKETS:
+                depth = max(0, depth - 1)
+            elif char == "、" and depth == 0:
+                comma = i
+        if comma > 0:
+            head = head[:comma]
+        return head + "。"
+    
+    def fix_request(self, messages: List[Dict], text: str,
+                    target_length: int) -> Optional[Tuple[List[Dict], int]]:
+        """
+        文字数を直すための追加の呼び出しを作成
+        
+        Args:
+            messages: 元のリクエストのメッセージ
+            text: 生成されたテキスト
+            target_length: 目標文字数
+            
+        Returns:
+            (メッセージ, max_tokens)。追加の呼び出しが不要な場合はNone
+            （長すぎても切り詰めで範囲内に収まる場合は不要）
+        """
+        current_length = len(text)
+        if self.is_within(text, target_length):
+            return None
+        
+        if current_length < target_length - self.tolerance:
+            instruction = (
+                f"この所見文は{current_length}文字で、目標より約{target_length - current_length}文字短いです。"
+                f"構成と内容はそのままに、学習面・生活面の具体的な様子を書き足して、"
+                f"全体で{target_length}文字程度（±{self.tolerance}文字）にしてください。"
+                "所見文のみを出力してください。"
+            )
+        else:
+            if self.is_within(self.trim(text, target_length), target_length):
+                return None
+            instruction = (
+                f"この所見文は{current_length}文字で、目標より約{current_length - target_length}文字長いです。"
+                f"4つのセクションの構成は保ったまま、全体で{target_length}文字程度（±{self.tolerance}文字）に"
+                "まとめ直してください。所見文のみを出力してください。"
+            )
+        
+        fix_messages = messages + [
+            {"role": "assistant", "content": text},
+            {"role": "user", "content": instruction},
+        ]
+        return fix_messages, self.max_tokens_for(target_length)
+    
+    def finish(self, text: str, target_length: int, extra_calls: int) -> str:
+        """
+        最終的な文字数を整え、結果を記録
+        
+        Args:
+            text: 生成されたテキスト
+            target_length: 目標文字数
+            extra_calls: 文字数を直すために追加で呼び出した回数
+            
+        Returns:
+            整えたテキスト
+        """
+        text = self.trim(text, target_length)
+        with self._lock:
+            self.generations += 1
+            self.extra_calls += extra_calls
+            if self.is_within(text, target_length):
+                self.within_tolerance += 1
+        return text
+    
+    def stats(self) -> Dict:
+        """
+        文字数制御の状況を取得
+            
+        Returns:
+            {'generations': 生成回数, 'extra_calls': 追加の呼び出し回数,
+             'extra_calls_per_generation': 1回あたりの追加の呼び出し回数,
+             'within_tolerance_rate': 許容範囲内に収まった割合,
+             'tokens_per_char': 1文字あたりのトークン数}
+        """
+        with self._lock:
+            generations = self.generations
+            return {
+                'generations': generations,
+                'extra_calls': self.extra_calls,
+                'extra_calls_per_generation': self.extra_calls / generations if generations else 0.0,
+                'within_tolerance_rate': self.within_tolerance / generations if generations else 0.0,
+                'tokens_per_char': self.tokens_per_char,
+            }
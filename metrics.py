@@ -0,0 +1,370 @@
+"""
+生成メトリクスモジュール
+所見文の生成1回ごとのトークン数・応答時間・再試行回数などを記録し、集計する
+
+記録はキューに入れておき、バックグラウンドのスレッドがまとめてSQLiteに
+書き込む（生成の処理はデータベースへの書き込みを待たない）。
+"""
+
+import contextvars
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import database
+
+
+# 1Mトークンあたりの料金（米ドル。入力, 出力）。表にないモデルの料金は集計しない
+MODEL_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+# 文字数調整の結果
+LENGTH_WITHIN = "within"    # 調整せずに範囲内
+LENGTH_TRIMMED = "trimmed"  # 文の区切りで切り詰めて範囲内
+LENGTH_FIXED = "fixed"      # 追加の呼び出しで書き足し・要約して範囲内
+LENGTH_MISSED = "missed"    # 範囲内に収まらなかった
+LENGTH_OUTCOME_LABELS = {
+    LENGTH_WITHIN: "調整なし",
+    LENGTH_TRIMMED: "切り詰め",
+    LENGTH_FIXED: "書き足し・要約",
+    LENGTH_MISSED: "範囲外",
+}
+
+# 書き込みスレッドの設定
+# キューが一杯の場合は記録を捨てる（生成の処理を待たせない）
+WRITER_QUEUE_SIZE = 10000
+WRITER_BATCH_SIZE = 500
+
+
+@dataclass
+class GenerationMetrics:
+    """所見文の生成1回分の記録（文字数調整の追加の呼び出しを含む）"""
+    
+    model: str
+    class_name: str = ""
+    candidates: int = 1
+    streamed: bool = False
+    cache_hit: bool = False
+    api_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    latency_ms: Optional[float] = None
+    first_token_ms: Optional[float] = None
+    length_outcome: Optional[str] = None
+    extra_calls: int = 0
+    error: Optional[str] = None
+    # 使用量が返されなかった呼び出しがあったか（トークン予算の精算に使う。保存はしない）
+    usage_unknown: bool = False
+    created_at: str = field(default_factory=lambda: datetime.now().isoformat())
+    started: float = field(default_factory=time.perf_counter, repr=False)
+    
+    def add_usage(self, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+        """APIの呼び出し1回分のトークン数を加える（不明な場合は0として数え、usage_unknown にする）"""
+        self.api_calls += 1
+        if prompt_tokens is None or completion_tokens is None:
+            self.usage_unknown = True
+        self.prompt_tokens += prompt_tokens or 0
+        self.completion_tokens += completion_tokens or 0
+    
+    @property
+    def total_tokens(self) -> int:
+        """これまでに使った合計トークン数"""
+        return self.prompt_tokens + self.completion_tokens
+    
+    def count_retry(self):
+        """再試行を1回数える"""
+        self.retries += 1
+    
+    def mark_first_token(self):
+        """最初の文字が届いた時刻を記録（2回目以降は無視）"""
+        if self.first_token_ms is None:
+            self.first_token_ms = (time.perf_counter() - self.started) * 1000
+    
+    def to_row(self) -> Dict:
+        """データベースに保存する行に変換"""
+        return {
+            'created_at': self.created_at,
+            'model': self.model,
+            'class_name': self.class_name or "",
+            'candidates': self.candidates,
+            'streamed': int(self.streamed),
+            'cache_hit': int(self.cache_hit),
+            'api_calls': self.api_calls,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'retries': self.retries,
+            'latency_ms': self.latency_ms,
+            'first_token_ms': self.first_token_ms,
+            'length_outcome': self.length_outcome,
+            'extra_calls': self.extra_calls,
+            'error': self.error,
+        }
+
+
+# 実行中の生成の記録（スレッド・asyncioのタスクごとに別の値を持つ）
+_current: contextvars.ContextVar[Optional[GenerationMetrics]] = contextvars.ContextVar(
+    "generation_metrics", default=None
+)
+
+
+def current() -> Optional[GenerationMetrics]:
+    """
+    実行中の生成の記録を取得
+    
+    Returns:
+        記録（MetricsWriter.track の外で呼ばれた場合はNone）
+    """
+    return _current.get()
+
+
+class MetricsWriter:
+    """
+    生成の記録をバックグラウンドのスレッドでデータベースに書き込む
+    
+    submit() はキューに入れるだけで、書き込みを待たない。書き込みスレッドは
+    キューにたまった分を1トランザクションでまとめて書き込む。
+    """
+    
+    def __init__(self, db: Optional[database.Database] = None,
+                 queue_size: int = WRITER_QUEUE_SIZE, batch_size: int = WRITER_BATCH_SIZE):
+        """
+        Args:
+            db: 保存先のデータベース（省略時は共有のもの）
+            queue_size: キューに入れておける記録の最大件数
+            batch_size: 1回にまとめて書き込む最大件数
+        """
+        self.db = db or database.get_database()
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self._thread.start()
+    
+    @contextmanager
+    def track(self, model: str, class_name: str = "", candidates: int = 1,
+              streamed: bool = False) -> Iterator[GenerationMetrics]:
+        """
+        生成1回分を記録する（ブロックを抜けると応答時間を記録してキューに入れる）
+        
+        ブロックの中では current() でこの記録を取得できる。例外が発生した
+        場合は、その種類を error に記録してそのまま送出する。
+        
+        Args:
+            model: モデル名
+            class_name: クラス名
+            candidates: 1回の呼び出しで生成する候補の数
+            streamed: ストリーミングで生成するか
+            
+        Yields:
+            記録
+        """
+        record = GenerationMetrics(
+            model=model, class_name=class_name, candidates=candidates, streamed=streamed
+        )
+        token = _current.set(record)
+        try:
+            yield record
+        except BaseException as e:
+            record.error = type(e).__name__
+            raise
+        finally:
+            try:
+                _current.reset(token)
+            except ValueError:
+                # ストリームのジェネレータが別のコンテキストで閉じられた場合
+                pass
+            record.latency_ms = (time.perf_counter() - record.started) * 1000
+            self.submit(record)
+    
+    def submit(self, record: GenerationMetrics):
+        """
+        記録をキューに入れる（キューが一杯の場合は捨てる）
+        
+        Args:
+            record: 記録
+        """
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        キューに入っている記録の書き込みが終わるまで待つ
+        
+        Args:
+            timeout: 待つ秒数（Noneなら終わるまで待つ）
+            
+        Returns:
+            書き込みが終わったか
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+    
+    def _run(self):
+        """キューから記録を取り出して書き込む（書き込みスレッド）"""
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            records = [item for item in items if isinstance(item, GenerationMetrics)]
+            if records:
+                try:
+                    self.db.save_generation_metrics([record.to_row() for record in records])
+                    self.written += len(records)
+                except Exception:
+                    # 記録の失敗で生成を止めない
+                    self.failed += len(records)
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+
+_writer: Optional[MetricsWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> MetricsWriter:
+    """
+    プロセス全体で共有する MetricsWriter を取得
+    
+    Returns:
+        書き込みスレッド
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = MetricsWriter()
+        return _writer
+
+
+# 集計
+
+def cost_usd(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    """
+    トークン数から料金の目安を計算
+    
+    Args:
+        model: モデル名
+        prompt_tokens: 入力トークン数
+        completion_tokens: 出力トークン数
+        
+    Returns:
+        米ドル（料金表にないモデルの場合はNone）
+    """
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    """パーセンタイル（値がない場合はNone）"""
+    return float(np.percentile(values, q)) if values else None
+
+
+def summarize(rows: List[Dict]) -> Dict:
+    """
+    記録を集計
+    
+    応答時間・トークン数は、キャッシュから返したものとエラーになったものを除いて集計する。
+    
+    Args:
+        rows: 記録のリスト（Database.get_generation_metrics の戻り値）
+        
+    Returns:
+        {'count': 生成回数, 'cache_hits': キャッシュから返した回数, 'errors': エラーの回数,
+         'retries': 再試行の回数, 'latency_p50' / 'latency_p95': 応答時間（ミリ秒）,
+         'first_token_p50' / 'first_token_p95': 最初の文字までの時間（ミリ秒）,
+         'tokens_per_shoken': 1件あたりのトークン数, 'cost': 料金の目安（米ドル）,
+         'length_outcomes': {文字数調整の結果: 回数}}
+    """
+    generated = [row for row in rows if not row['cache_hit'] and not row['error'] and row['api_calls']]
+    latencies = [row['latency_ms'] for row in generated if row['latency_ms'] is not None]
+    first_tokens = [row['first_token_ms'] for row in generated if row['first_token_ms'] is not None]
+    
+    length_outcomes: Dict[str, int] = {}
+    for row in generated:
+        if row['length_outcome']:
+            length_outcomes[row['length_outcome']] = length_outcomes.get(row['length_outcome'], 0) + 1
+    
+    return {
+        'count': len(rows),
+        'cache_hits': sum(1 for row in rows if row['cache_hit']),
+        'errors': sum(1 for row in rows if row['error']),
+        'retries': sum(row['retries'] for row in rows),
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p95': _percentile(latencies, 95),
+        'first_token_p50': _percentile(first_tokens, 50),
+        'first_token_p95': _percentile(first_tokens, 95),
+        'tokens_per_shoken': (
+            sum(row['prompt_tokens'] + row['completion_tokens'] for row in generated) / len(generated)
+            if generated else None
+        ),
+        'cost': sum(
+            cost_usd(row['model'], row['prompt_tokens'], row['completion_tokens']) or 0.0
+            for row in rows
+        ),
+        'length_outcomes': length_outcomes,
+    }
+
+
+def daily_summary(rows: List[Dict]) -> List[Dict]:
+    """
+    日ごとに集計
+    
+    Args:
+        rows: 記録のリスト
+        
+    Returns:
+        日付順のリスト（'date' と summarize の戻り値の各項目）
+    """
+    by_date: Dict[str, List[Dict]] = {}
+    for row in rows:
+        by_date.setdefault(row['created_at'][:10], []).append(row)
+    return [dict(summarize(day_rows), date=date) for date, day_rows in sorted(by_date.items())]
+
+
+def cost_by_class(rows: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """
+    クラスごと・日ごとの料金の目安
+    
+    Args:
+        rows: 記録のリスト
+        
+    Returns:
+        {クラス名: {日付: 米ドル}}（クラス名がない記録は「クラス未設定」）
+    """
+    costs: Dict[str, Dict[str, float]] = {}
+    for row in rows:
+        cost = cost_usd(row['model'], row['prompt_tokens'], row['completion_tokens'])
+        if cost is None:
+            continue
+        by_date = costs.setdefault(row['class_name'] or "クラス未設定", {})
+        by_date[row['created_at'][:10]] = by_date.get(row['created_at'][:10], 0.0) + cost
+    return costs
+
+
+def since(days: int) -> str:
+    """直近 days 日の始まりの日時（ISO形式）"""
+    return (datetime.now() - timedelta(days=days)).isoformat()
@@ -3,26 +3,1153 @@ OpenAI API連携モジュール
 所見文の生成を行う
 """
 
-from typing import List, Optional
+import asyncio
+import contextvars
+import functools
+import hashlib
+import importlib.util
+import json
+import queue
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Callable, Coroutine, Dict, Generator, List, Optional, Tuple, TypeVar, Union
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+import candidate_ranker
 import config
+import database
 import error_handler
+import metrics
+import prompt_templates
+import rate_limiter
+import template_generator
+import token_budget
+from generation_backends import AsyncGenerationBackend, Completion, GenerationBackend, StubBackend
+from length_controller import LengthController
 
 
-class OpenAIClient:
-    """OpenAI APIクライアント"""
+T = TypeVar("T")
+
+# 一括生成の同時実行数の既定値
+DEFAULT_BATCH_WORKERS = 4
+
+# 生成時のパラメータ（max_tokens は目標文字数から LengthController が決める）
+TEMPERATURE = 0.8
+
+# h2 がインストールされている場合のみ HTTP/2 を使う
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# HTTP接続プールの設定（プロセス内の全セッションで共有する）
+# 接続を保持して使い回し、クリックごとのTLSハンドシェイクをなくす
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+HTTP_KEEPALIVE_EXPIRY = 120.0
+
+# 生成結果キャッシュの既定値
+# 1つのキーにつき CACHE_VARIANTS 件の候補がそろうまではAPIで生成し、
+# そろった後は候補を順番に使い回す
+CACHE_VARIANTS = 3
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+CACHE_MAX_ENTRIES = 5000
+
+# 同じリクエストの生成を1回にまとめる（SingleFlight）
+# 生成が終わった後もこの秒数は結果を共有する（二度押しによる再実行が、生成の
+# 終わった直後に届いた場合にももう一度生成しないようにする）
+SINGLE_FLIGHT_LINGER_SECONDS = 2.0
+
+# 共有の非同期クライアントは、この秒数ごとにAPIキーとモデルの設定を読み直す
+# （secrets の読み込みをリクエストのたびに行わない）
+ASYNC_CLIENT_SETTINGS_TTL_SECONDS = 60.0
+
+# 生成方法（AIで生成するか、テンプレートで組み立てるか）
+ENGINE_AI = "ai"
+ENGINE_TEMPLATE = "template"
+
+
+@dataclass
+class BatchResult:
+    """一括生成の1人分の結果"""
+    
+    index: int
+    request: Dict
+    text: Optional[str] = None
+    error: Optional[Exception] = None
+    engine: str = ENGINE_AI
+    
+    @property
+    def ok(self) -> bool:
+        """生成に成功したか"""
+        return self.error is None
+
+
+class ShokenStream:
+    """
+    ストリーミング生成の結果
+    
+    反復すると、生成された文字列（1つ目の候補）を届いた順に返す。反復が終わると
+    text に文字数調整後の所見文（表示した1つ目の候補）が入り、reserves に
+    残りの候補がよい順に入る。エラーは反復中に送出される。
+    APIが使えずテンプレートで組み立てた場合は、その所見文をまとめて返し、
+    engine が ENGINE_TEMPLATE になる。
+    """
+    
+    def __init__(self, deltas: Generator[str, None, List[str]],
+                 fallback: Optional[Callable[[Exception], Optional[str]]] = None,
+                 engine: str = ENGINE_AI):
+        """
+        Args:
+            deltas: 文字列を順に返し、最後に候補の所見文のリスト（よい順）を戻り値とするジェネレータ
+            fallback: エラーの場合に代わりの所見文を返す関数（代わりがない場合はNone）
+            engine: 生成方法
+        """
+        self._deltas = deltas
+        self._fallback = fallback
+        self.text: Optional[str] = None
+        self.reserves: List[str] = []
+        self.engine = engine
+    
+    def __iter__(self):
+        try:
+            candidates = yield from self._deltas
+            self.text, self.reserves = candidates[0], candidates[1:]
+        except Exception as e:
+            text = self._fallback(e) if self._fallback else None
+            if text is None:
+                raise
+            self.text, self.engine = text, ENGINE_TEMPLATE
+            yield text
+
+
+class _ShokenClientBase:
+    """
+    所見生成クライアントの共通処理
+    
+    プロンプトの構築・キャッシュ・トークン予算・文字数調整・候補の順位付け・
+    生成の記録はここで行う。同期版（OpenAIClient）と非同期版（AsyncOpenAIClient）は
+    I/O の方法（_run_blocking・_reserve_tokens・_backend_complete・_backend_stream・
+    _with_model）だけを実装する。生成の手順はコルーチンとして書き、同期版では
+    I/O をその場で実行し、呼び出し元のスレッドで _run_inline により実行する。
+    """
+    
+    def __init__(self, model: str, backend, cache: Optional["ResponseCache"],
+                 metrics_writer: Optional[metrics.MetricsWriter],
+                 budget: Optional[token_budget.TokenBudget]):
+        """
+        共通の設定を初期化
+        
+        Args:
+            model: モデル名
+            backend: 生成に使うバックエンド（Noneなら自分自身が OpenAI API を呼び出す）
+            cache: 生成結果キャッシュ（省略時は設定で有効な場合のみ共有のものを使う）
+            metrics_writer: 生成の記録の書き込み先（省略時は共有のもの）
+            budget: トークン予算（省略時は共有のもの）
+        """
+        self.model = model
+        self.backend = backend if backend is not None else self
+        self.cache = cache or get_response_cache()
+        self.metrics = metrics_writer or metrics.get_writer()
+        self.budget = budget or token_budget.get_budget()
+        self.length_controller = get_length_controller(self.model)
+        self.scheduler = rate_limiter.get_scheduler()
+        self._cheaper_clients: Dict[str, "_ShokenClientBase"] = {}
+    
+    # I/O（同期版・非同期版で実装する）
+    
+    async def _run_blocking(self, func: Callable[..., T], *args) -> T:
+        """データベースを読み書きする関数を呼び出す"""
+        raise NotImplementedError
+    
+    async def _reserve_tokens(self, teacher: str, class_name: str, tokens: int) -> token_budget.Reservation:
+        """トークン予算を予約する"""
+        raise NotImplementedError
+    
+    async def _backend_complete(self, messages: List[Dict], max_tokens: int, n: int) -> Completion:
+        """バックエンドを1回呼び出して応答を取得"""
+        raise NotImplementedError
+    
+    async def _backend_stream(self, messages: List[Dict], max_tokens: int, n: int,
+                              on_delta: Callable[[str], None]) -> Completion:
+        """バックエンドをストリーミングで呼び出し、1つ目の候補に届いた文字列を on_delta に渡す"""
+        raise NotImplementedError
+    
+    def _with_model(self, model: str) -> "_ShokenClientBase":
+        """接続プール・キャッシュ・記録先・予算を共有し、モデルだけを変えたクライアントを作成"""
+        raise NotImplementedError
+    
+    # 生成の手順（同期版・非同期版で共通）
+    
+    def _build_messages(self, keywords: List[str], target_length: int, grade_level: str) -> List[Dict]:
+        """
+        APIに送るメッセージを構築（学年ごとに組み立て済みのテンプレートを使う）
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年
+            
+        Returns:
+            メッセージのリスト
+        """
+        return prompt_templates.compile_prompt(grade_level).render(keywords, target_length)
+    
+    def _get_cached(self, cache_key: str, teacher: str, class_name: str) -> Optional[str]:
+        """
+        キャッシュから取得（トークン予算が残り少ない場合は、候補がそろっていなくても使う）
+        
+        Args:
+            cache_key: キャッシュキー
+            teacher: 先生の名前
+            class_name: クラス名
+            
+        Returns:
+            生成結果（ない場合はNone）
+        """
+        return self.cache.get(cache_key, 1 if self.budget.is_near_limit(teacher, class_name) else None)
+    
+    async def _generate_once(self, keywords: List[str], target_length: int, grade_level: str,
+                             class_name: str = "", teacher: str = "") -> str:
+        """
+        所見文を1回生成（同じリクエストをまとめない）
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            生成された所見文
+        """
+        with self.metrics.track(self.model, class_name) as record:
+            cache_key = None
+            if self.cache:
+                cache_key = self.cache.make_key(keywords, target_length, grade_level, self.model)
+                cached_text = await self._run_blocking(self._get_cached, cache_key, teacher, class_name)
+                if cached_text is not None:
+                    record.cache_hit = True
+                    return cached_text
+            
+            messages = self._build_messages(keywords, target_length, grade_level)
+            max_tokens = self.length_controller.max_tokens_for(target_length)
+            reserved_tokens = self._estimate_tokens(messages, max_tokens)
+            async with self._reserve(record, teacher, class_name, reserved_tokens) as client:
+                generated_text = (await client._complete(messages, max_tokens))[0]
+                
+                # 文字数調整
+                adjusted_text = await client._fit_length(messages, generated_text, target_length)
+            
+            # 安いモデルで生成したものはキャッシュしない
+            if cache_key and client is self:
+                await self._run_blocking(self.cache.put, cache_key, adjusted_text)
+            
+            return adjusted_text
+    
+    async def _generate_stream_once(self, keywords: List[str], target_length: int,
+                                    grade_level: str, on_delta: Callable[[str], None],
+                                    candidates: int = 1, class_name: str = "",
+                                    teacher: str = "") -> List[str]:
+        """
+        所見文をストリーミングで1回生成（同じリクエストをまとめない）
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年
+            on_delta: 1つ目の候補に文字列が届くたびに呼ばれる関数（キャッシュにある場合は
+                その所見文で1回だけ呼ばれる）
+            candidates: 1回の呼び出しで生成する候補の数
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            候補の所見文のリスト（表示した1つ目の候補と、残りの候補をよい順に並べたもの。
+            文字数調整は1つ目の候補にだけ行う）
+        """
+        with self.metrics.track(self.model, class_name, candidates, streamed=True) as record:
+            def forward(delta: str):
+                record.mark_first_token()
+                on_delta(delta)
+            
+            cache_key = None
+            if self.cache:
+                cache_key = self.cache.make_key(keywords, target_length, grade_level, self.model)
+                cached_text = await self._run_blocking(self._get_cached, cache_key, teacher, class_name)
+                if cached_text is not None:
+                    record.cache_hit = True
+                    forward(cached_text)
+                    return [cached_text]
+            
+            messages = self._build_messages(keywords, target_length, grade_level)
+            max_tokens = self.length_controller.max_tokens_for(target_length)
+            reserved_tokens = self._estimate_tokens(messages, max_tokens * candidates)
+            async with self._reserve(record, teacher, class_name, reserved_tokens) as client:
+                completion = await client._backend_stream(messages, max_tokens, candidates, forward)
+                
+                # 表示した1つ目の候補は入れ替えずに文字数だけ整え、順位付けは
+                # 再生成で使う残りの候補にだけ行う（ストリームの終了後に行う）
+                texts = client._accept_completion(completion)
+                reserves = client._rank_reserves(texts[1:], texts[0], target_length)
+                adjusted_text = await client._fit_length(messages, texts[0], target_length)
+            
+            if cache_key and client is self:
+                await self._run_blocking(self.cache.put, cache_key, adjusted_text)
+            
+            return [adjusted_text] + reserves
+    
+    @asynccontextmanager
+    async def _reserve(self, record: metrics.GenerationMetrics, teacher: str, class_name: str,
+                       tokens: int) -> AsyncIterator["_ShokenClientBase"]:
+        """
+        トークン予算を予約し、ブロックを抜けたら実際に使ったトークン数で精算する
+        
+        エラーになった場合やストリームが途中で切れた場合、使用量が返されなかった
+        場合は、APIで課金されたかどうかわからないため、予約した分（それより多く
+        使ったことがわかっていればその分）を使ったものとして精算する。
+        
+        Args:
+            record: 生成の記録（使ったトークン数を数えている）
+            teacher: 先生の名前
+            class_name: クラス名
+            tokens: 見積もりのトークン数
+            
+        Yields:
+            生成に使うクライアント（上限に近づいている場合は安いモデルのクライアント）
+            
+        Raises:
+            token_budget.BudgetExceededError: 上限を超える場合（APIには送らない）
+        """
+        reservation = await self._reserve_tokens(teacher, class_name, tokens)
+        completed = False
+        try:
+            client = self._cheaper_client() if reservation.degraded else self
+            record.model = client.model
+            yield client
+            completed = True
+        finally:
+            used_tokens = record.total_tokens
+            if not completed or record.usage_unknown:
+                used_tokens = max(reservation.tokens, used_tokens)
+            await self._run_blocking(self.budget.settle, reservation, used_tokens)
+            # 同じリクエストの生成に加わった別の先生・クラスの予算にも計上するため
+            record_flight_usage(used_tokens)
+    
+    def _charge_shared(self, teacher: str, class_name: str, owner: Tuple[str, str], used_tokens: int):
+        """
+        別の先生・クラスが始めた生成の結果を使った分を、自分の先生・クラスの予算に計上
+        
+        Args:
+            teacher: 先生の名前
+            class_name: クラス名
+            owner: 生成を始めた (先生の名前, クラス名)
+            used_tokens: 生成で使ったトークン数
+        """
+        self.budget.charge_shared(teacher, class_name, owner[0], owner[1], used_tokens)
+    
+    def _cheaper_client(self) -> "_ShokenClientBase":
+        """
+        トークン予算が残り少ない場合に使う、安いモデルのクライアント
+        
+        Returns:
+            接続プール・記録先を共有するクライアント（安いモデルが設定されていない
+            場合や、OpenAI API 以外のバックエンドの場合は自分自身）
+        """
+        model = config.get_openai_budget_model()
+        if self.backend is not self or not model or model == self.model:
+            return self
+        if model not in self._cheaper_clients:
+            self._cheaper_clients[model] = self._with_model(model)
+        return self._cheaper_clients[model]
+    
+    async def _complete(self, messages: List[Dict], max_tokens: int, n: int = 1) -> List[str]:
+        """
+        バックエンドを1回呼び出して応答のテキストを取得
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            n: 生成する候補の数
+            
+        Returns:
+            候補のテキストのリスト
+        """
+        return self._accept_completion(await self._backend_complete(messages, max_tokens, n))
+    
+    async def _fit_length(self, messages: List[Dict], text: str, target_length: int) -> str:
+        """
+        文字数が目標から外れている場合は追加で呼び出して書き足し・要約し、
+        最終的な所見文を返す
+        
+        Args:
+            messages: 元のリクエストのメッセージ
+            text: 生成されたテキスト
+            target_length: 目標文字数
+            
+        Returns:
+            文字数を整えた所見文
+        """
+        controller = self.length_controller
+        extra_calls = 0
+        while extra_calls < controller.max_fix_calls:
+            fix = controller.fix_request(messages, text, target_length)
+            if fix is None:
+                break
+            fix_messages, max_tokens = fix
+            text = (await self._complete(fix_messages, max_tokens))[0]
+            extra_calls += 1
+        return self._finish_length(text, target_length, extra_calls)
+    
+    def _accept_completion(self, completion: Completion) -> List[str]:
+        """
+        応答のテキストを受け取り、1文字あたりのトークン数を学習する
+        
+        Args:
+            completion: 応答（finish_reason が "length" なら max_tokens に達して途中で切れている）
+            
+        Returns:
+            途中で切れた文を取り除いた候補のテキストのリスト（1つ目が completion.text）
+        """
+        choices = [completion] + completion.alternatives
+        texts = [choice.text.strip() for choice in choices]
+        self.length_controller.observe("".join(texts), completion.completion_tokens)
+        record = metrics.current()
+        if record:
+            record.add_usage(completion.prompt_tokens, completion.completion_tokens)
+        return [
+            self.length_controller.drop_incomplete_sentence(text) if choice.finish_reason == "length" else text
+            for choice, text in zip(choices, texts)
+        ]
+    
+    def _rank_reserves(self, texts: List[str], shown_text: str, target_length: int) -> List[str]:
+        """
+        再生成で使う残りの候補を順位付けし、文の区切りで切り詰める
+        
+        Args:
+            texts: 残りの候補のテキストのリスト
+            shown_text: 表示した候補（同じ候補は除く）
+            target_length: 目標文字数
+            
+        Returns:
+            残りの候補のリスト（よい順）
+        """
+        ranked = candidate_ranker.rank_candidates(texts, target_length)
+        return [self.length_controller.trim(text, target_length) for text in ranked if text != shown_text]
+    
+    def _finish_length(self, text: str, target_length: int, extra_calls: int) -> str:
+        """
+        最終的な文字数を整え、文字数調整の結果を記録
+        
+        Args:
+            text: 生成されたテキスト（追加の呼び出しで直した後のもの）
+            target_length: 目標文字数
+            extra_calls: 文字数を直すために追加で呼び出した回数
+            
+        Returns:
+            整えたテキスト
+        """
+        finished = self.length_controller.finish(text, target_length, extra_calls)
+        record = metrics.current()
+        if record:
+            record.extra_calls = extra_calls
+            if not self.length_controller.is_within(finished, target_length):
+                record.length_outcome = metrics.LENGTH_MISSED
+            elif extra_calls:
+                record.length_outcome = metrics.LENGTH_FIXED
+            elif finished != text:
+                record.length_outcome = metrics.LENGTH_TRIMMED
+            else:
+                record.length_outcome = metrics.LENGTH_WITHIN
+        return finished
+    
+    def _estimate_tokens(self, messages: List[Dict], max_tokens: int) -> int:
+        """リクエストが使うトークン数の見積もり（プロンプト＋最大生成トークン数）"""
+        return prompt_templates.count_message_tokens(messages, self.model) + max_tokens
+
+
+def _completion_from_response(response) -> Completion:
+    """OpenAI APIの応答（ストリーミングでない場合）を Completion に変換"""
+    choices = [
+        Completion(text=choice.message.content or "", finish_reason=choice.finish_reason)
+        for choice in response.choices
+    ]
+    usage = response.usage
+    completion = choices[0]
+    completion.alternatives = choices[1:]
+    completion.prompt_tokens = usage.prompt_tokens if usage else None
+    completion.completion_tokens = usage.completion_tokens if usage else None
+    return completion
+
+
+class _StreamCollector:
+    """ストリーミングの応答のチャンクを候補ごとに集める"""
+    
+    def __init__(self, n: int):
+        self.parts: List[List[str]] = [[] for _ in range(n)]
+        self.finish_reasons: List[Optional[str]] = [None] * n
+        self.usage = None
+    
+    def add(self, chunk) -> Optional[str]:
+        """
+        チャンクを追加
+        
+        Args:
+            chunk: ストリーミングの応答のチャンク
+            
+        Returns:
+            1つ目の候補に届いた文字列（届いていない場合はNone）
+        """
+        if chunk.usage:
+            self.usage = chunk.usage
+        first_delta = None
+        for choice in chunk.choices:
+            self.finish_reasons[choice.index] = choice.finish_reason or self.finish_reasons[choice.index]
+            delta = choice.delta.content
+            if delta:
+                self.parts[choice.index].append(delta)
+                if choice.index == 0:
+                    first_delta = delta
+        return first_delta
+    
+    def completion(self) -> Completion:
+        """集めたチャンクから応答全体を作成"""
+        choices = [
+            Completion(text="".join(parts), finish_reason=finish_reason)
+            for parts, finish_reason in zip(self.parts, self.finish_reasons)
+        ]
+        completion = choices[0]
+        completion.alternatives = choices[1:]
+        completion.prompt_tokens = self.usage.prompt_tokens if self.usage else None
+        completion.completion_tokens = self.usage.completion_tokens if self.usage else None
+        return completion
+
+
+def _retry_counter() -> Optional[Callable[[], None]]:
+    """実行中の生成の記録に再試行の回数を数える関数（記録していない場合はNone）"""
+    record = metrics.current()
+    return record.count_retry if record else None
+
+
+def is_outage(error: Exception) -> bool:
+    """
+    APIが使えない状態によるエラーか（テンプレートで代わりに組み立てる対象）
+    
+    Args:
+        error: 発生したエラー
+        
+    Returns:
+        接続できない・タイムアウト・レート制限・サーバーエラー（再試行しても
+        失敗した場合）、利用上限に達した場合、またはトークン予算を超えた場合はTrue
+    """
+    if isinstance(error, token_budget.BudgetExceededError):
+        return True
+    return rate_limiter.is_retryable(error) or "insufficient_quota" in str(error).lower()
+
+
+def _fallback_text(error: Exception, keywords: List[str], target_length: int,
+                   grade_level: str) -> Optional[str]:
+    """
+    APIが使えない場合に、テンプレートで組み立てた所見文を返す
+    
+    Args:
+        error: 発生したエラー
+        keywords: キーワードリスト
+        target_length: 目標文字数
+        grade_level: 学年
+        
+    Returns:
+        所見文（設定で無効の場合やAPIの障害以外のエラーの場合はNone）
+    """
+    if not config.get_template_fallback_enabled() or not is_outage(error):
+        return None
+    return template_generator.generate_shoken(keywords, target_length, grade_level)
+
+
+def _fill_fallback(result: BatchResult, error: Exception, target_length: int, grade_level: str):
+    """一括生成で失敗した1人分を、テンプレートで組み立てた所見文かエラーで埋める"""
+    text = _fallback_text(error, result.request['keywords'], target_length, grade_level)
+    if text is None:
+        result.error = error
+    else:
+        result.text, result.engine = text, ENGINE_TEMPLATE
+
+
+def _http_limits():
+    """接続プールの上限とキープアライブの設定を作成"""
+    import httpx
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def prompt_template_hash() -> str:
+    """
+    プロンプトのテンプレートのハッシュを取得
+    
+    テンプレートや生成時のパラメータを変更するとハッシュが変わり、
+    以前の生成結果はキャッシュから使われなくなる。
+    
+    Returns:
+        ハッシュ（16進数16文字）
+    """
+    payload = json.dumps([prompt_templates.get_template().hash, TEMPERATURE], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class ResponseCache:
+    """
+    生成結果のキャッシュ（SQLiteの response_cache テーブルに保存）
+    
+    同じキーワード・文字数・学年・モデルの組み合わせでは、CACHE_VARIANTS 件の
+    候補がそろうまではAPIで生成し、そろった後は最も長く使われていない候補から
+    順番に返す。有効期限切れの候補と、件数の上限を超えた分（最終使用日時の
+    古い順）は削除する。
+    """
+    
+    def __init__(self, db: Optional[database.Database] = None, variants: int = CACHE_VARIANTS,
+                 ttl_seconds: int = CACHE_TTL_SECONDS, max_entries: int = CACHE_MAX_ENTRIES):
+        """
+        キャッシュを初期化
+        
+        Args:
+            db: 保存先のデータベース（省略時は共有のもの）
+            variants: 1つのキーで使い回す候補の数
+            ttl_seconds: 候補の有効期限（秒）
+            max_entries: キャッシュ全体の最大件数
+        """
+        self.db = db or database.get_database()
+        self.variants = max(1, variants)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(keywords: List[str], target_length: int, grade_level: str, model: str) -> str:
+        """
+        キャッシュキーを作成
+        
+        キーワードは表記を正規化（NFKC・前後の空白を除去）し、重複を除いて並べ替える。
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年
+            model: モデル名
+            
+        Returns:
+            キャッシュキー
+        """
+        normalized = sorted({unicodedata.normalize("NFKC", kw).strip() for kw in keywords} - {""})
+        payload = json.dumps(
+            [normalized, target_length, grade_level, model, prompt_template_hash()],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _expires_before(self) -> str:
+        """これより前に作成された候補は期限切れ"""
+        return (datetime.now() - timedelta(seconds=self.ttl_seconds)).isoformat()
+    
+    def get(self, key: str, min_variants: Optional[int] = None) -> Optional[str]:
+        """
+        キャッシュから生成結果を取得
+        
+        Args:
+            key: キャッシュキー
+            min_variants: 取り出しに必要な候補の件数（省略時は variants。
+                トークン予算が残り少ない場合は1にして、ある候補を使う）
+            
+        Returns:
+            生成結果（候補がそろっていない場合はNone）
+        """
+        text = self.db.take_cached_response(key, min_variants or self.variants, self._expires_before())
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return text
+    
+    def put(self, key: str, text: str):
+        """
+        生成結果をキャッシュに追加
+        
+        Args:
+            key: キャッシュキー
+            text: 生成結果
+        """
+        self.db.add_cached_response(key, text, self.variants, self.max_entries, self._expires_before())
+    
+    def stats(self) -> Dict:
+        """
+        キャッシュの利用状況を取得
+        
+        Returns:
+            {'hits': ヒット数, 'misses': ミス数, 'hit_rate': ヒット率, 'entries': 保存件数}
+        """
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+            'entries': self.db.count_cached_responses(),
+        }
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    プロセス全体で共有する生成結果キャッシュを取得
+    
+    Returns:
+        キャッシュ（設定で無効の場合はNone）
+    """
+    global _response_cache
+    if not config.get_response_cache_enabled():
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
+
+_length_controllers: Dict[str, LengthController] = {}
+_length_controllers_lock = threading.Lock()
+
+
+def get_length_controller(model: str) -> LengthController:
+    """
+    モデルごとに共有する LengthController を取得
+    
+    1文字あたりのトークン数はモデル（トークナイザ）によって異なるため、
+    モデルごとに学習する。
+    
+    Args:
+        model: モデル名
+        
+    Returns:
+        文字数制御
+    """
+    with _length_controllers_lock:
+        if model not in _length_controllers:
+            _length_controllers[model] = LengthController()
+        return _length_controllers[model]
+
+
+class _Flight:
+    """
+    実行中の生成1件
+    
+    届いた文字列を記録しておき、途中から加わった呼び出し元にも最初から渡す。
+    """
+    
+    def __init__(self, owner: Tuple[str, str]):
+        """
+        Args:
+            owner: 生成を始めた呼び出し元の (先生の名前, クラス名)
+        """
+        self.owner = owner
+        self.future: Future = Future()
+        self.finished_at: Optional[float] = None
+        # 生成で実際に使ったトークン数（加わった別の先生・クラスの予算にも計上する）
+        self.used_tokens = 0
+        # 共有イベントループで生成する場合のタスク（実行中に消えないよう参照を持っておく）
+        self.task: Optional[asyncio.Future] = None
+        self._deltas: List[str] = []
+        self._listeners: List[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+    
+    def add_delta(self, delta: str):
+        """届いた文字列を記録し、加わっている呼び出し元に渡す"""
+        with self._lock:
+            self._deltas.append(delta)
+            for listener in self._listeners:
+                listener(delta)
+    
+    def listen(self, listener: Callable[[str], None]):
+        """これまでに届いた文字列を渡し、以降に届く文字列も渡すようにする"""
+        with self._lock:
+            for delta in self._deltas:
+                listener(delta)
+            self._listeners.append(listener)
+    
+    def unlisten(self, listener: Callable[[str], None]):
+        """文字列を渡すのをやめる"""
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+    
+    def add_usage(self, used_tokens: int):
+        """生成で使ったトークン数を加える"""
+        with self._lock:
+            self.used_tokens += used_tokens
+
+
+# 実行中の生成（生成を始めた呼び出し元のコンテキストで、使ったトークン数の記録に使う）
+_current_flight: contextvars.ContextVar[Optional[_Flight]] = contextvars.ContextVar(
+    "current_flight", default=None
+)
+
+
+def record_flight_usage(used_tokens: int):
+    """
+    実行中の生成で使ったトークン数を記録（SingleFlight の生成の中でなければ何もしない）
+    
+    Args:
+        used_tokens: 精算したトークン数
+    """
+    flight = _current_flight.get()
+    if flight is not None:
+        flight.add_usage(used_tokens)
+
+
+class SingleFlight:
+    """
+    同じリクエストの生成を1回にまとめる（プロセス全体で共有）
+    
+    同じキーの生成が実行中なら新しく生成せず、その生成に加わって結果を共有する
+    （別の先生が同じキーワードで同時に生成した場合も1回にまとめる）。生成を
+    始めた先生・クラスの予算で予約・精算し、別の先生・クラスから加わった
+    呼び出し元には on_shared で使ったトークン数を知らせる（呼び出し元が
+    自分の予算に計上する）。ストリーミングの生成は呼び出し元から切り離して最後まで実行するため、
+    最初の呼び出し元が途中で読むのをやめても（ボタンの二度押しでStreamlitの
+    スクリプトが再実行されても）止まらず、再実行後の同じリクエストはその生成に
+    加わる。生成が終わった後も linger_seconds 秒は、同じ先生・クラスの呼び出し元
+    にだけ結果を共有し、生成が終わった直後に届いた二度押しでもう一度生成しない
+    ようにする（エラーになった生成は終わった時点で加わっていた呼び出し元にだけ
+    共有する）。
+    """
+    
+    def __init__(self, linger_seconds: float = SINGLE_FLIGHT_LINGER_SECONDS):
+        """
+        Args:
+            linger_seconds: 生成が終わった後も結果を共有する秒数
+        """
+        self.linger_seconds = linger_seconds
+        self.flights = 0
+        self.coalesced = 0
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(keywords: List[str], target_length: int, grade_level: str, model: str,
+                 candidates: Optional[int] = None) -> str:
+        """
+        キーを作成（生成結果キャッシュと同じキーに、ストリーミングの候補数を加える）
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年
+            model: モデル名
+            candidates: ストリーミングで生成する候補の数（Noneは通常の生成）
+            
+        Returns:
+            キー
+        """
+        key = ResponseCache.make_key(keywords, target_length, grade_level, model)
+        return key if candidates is None else f"{key}:stream{candidates}"
+    
+    def _join(self, key: str, owner: Tuple[str, str]) -> Tuple[_Flight, bool]:
+        """
+        同じキーの生成に加わる（なければ新しく登録する）
+        
+        実行中の生成には誰でも加わる。終わった生成の結果を使い回すのは、
+        同じ先生・クラスからの二度押しだけにする。
+        
+        Args:
+            key: キー
+            owner: 呼び出し元の (先生の名前, クラス名)
+            
+        Returns:
+            (生成, 自分が生成を始める側か)
+        """
+        now = time.monotonic()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and (flight.finished_at is None or (
+                    flight.owner == owner and now - flight.finished_at <= self.linger_seconds)):
+                self.coalesced += 1
+                return flight, False
+            flight = _Flight(owner)
+            self._flights[key] = flight
+            self.flights += 1
+            return flight, True
+    
+    def _finish(self, key: str, flight: _Flight, result=None, error: Optional[BaseException] = None):
+        """生成の結果を加わっている呼び出し元に渡し、期限の過ぎた生成を片付ける"""
+        now = time.monotonic()
+        with self._lock:
+            flight.finished_at = now
+            if error is not None and self._flights.get(key) is flight:
+                del self._flights[key]
+            expired = [
+                other_key for other_key, other in self._flights.items()
+                if other.finished_at is not None and now - other.finished_at > self.linger_seconds
+            ]
+            for other_key in expired:
+                del self._flights[other_key]
+        if error is None:
+            flight.future.set_result(result)
+        else:
+            flight.future.set_exception(error)
+    
+    @staticmethod
+    def _notify_shared(flight: _Flight, owner: Tuple[str, str],
+                       on_shared: Optional[Callable[[Tuple[str, str], int], None]]):
+        """別の先生・クラスの生成に加わった場合に、使ったトークン数を知らせる"""
+        if on_shared and flight.owner != owner and flight.used_tokens:
+            on_shared(flight.owner, flight.used_tokens)
+    
+    def _run_detached(self, key: str, flight: _Flight, generate: Callable[[Callable[[str], None]], object]):
+        """生成を実行して結果を記録（別スレッドで呼ばれる）"""
+        _current_flight.set(flight)
+        try:
+            result = generate(flight.add_delta)
+        except BaseException as e:
+            self._finish(key, flight, error=e)
+        else:
+            self._finish(key, flight, result)
+    
+    def _finish_task(self, key: str, flight: _Flight, task: asyncio.Future):
+        """共有イベントループのタスクが終わったら結果を記録"""
+        if task.cancelled():
+            self._finish(key, flight, error=RuntimeError("生成が中断されました"))
+        elif task.exception() is not None:
+            self._finish(key, flight, error=task.exception())
+        else:
+            self._finish(key, flight, task.result())
+    
+    def run(self, key: str, generate: Callable[[], object], owner: Tuple[str, str] = ("", ""),
+            on_shared: Optional[Callable[[Tuple[str, str], int], None]] = None):
+        """
+        同じキーの生成が実行中ならその結果を待ち、なければ呼び出し元のスレッドで生成する
+        
+        Args:
+            key: キー
+            generate: 生成して結果を返す関数
+            owner: 呼び出し元の (先生の名前, クラス名)
+            on_shared: 別の先生・クラスの生成に加わった場合に、(生成を始めた (先生の名前, クラス名),
+                使ったトークン数) で呼ばれる関数
+                
+        Returns:
+            生成の結果
+        """
+        flight, leader = self._join(key, owner)
+        if not leader:
+            result = flight.future.result()
+            self._notify_shared(flight, owner, on_shared)
+            return result
+        token = _current_flight.set(flight)
+        try:
+            result = generate()
+        except BaseException as e:
+            self._finish(key, flight, error=e)
+            raise
+        finally:
+            _current_flight.reset(token)
+        self._finish(key, flight, result)
+        return result
+    
+    def stream(self, key: str, generate: Callable[[Callable[[str], None]], object],
+               owner: Tuple[str, str] = ("", ""),
+               on_shared: Optional[Callable[[Tuple[str, str], int], None]] = None) -> Generator[str, None, object]:
+        """
+        同じキーの生成に加わり、届いた文字列を順に返す（実行中でなければ別スレッドで生成を始める）
+        
+        Args:
+            key: キー
+            generate: 届いた文字列を渡す関数を受け取って生成し、結果を返す関数
+            owner: 呼び出し元の (先生の名前, クラス名)
+            on_shared: 別の先生・クラスの生成に加わった場合に、(生成を始めた (先生の名前, クラス名),
+                使ったトークン数) で呼ばれる関数
+                
+        Yields:
+            生成された文字列（途中から加わった場合は、それまでに届いた分から順に）
+            
+        Returns:
+            生成の結果
+        """
+        flight, leader = self._join(key, owner)
+        if leader:
+            threading.Thread(
+                target=self._run_detached, args=(key, flight, generate), name="single-flight", daemon=True
+            ).start()
+        
+        deltas = queue.Queue()
+        listener = deltas.put
+        flight.listen(listener)
+        # Noneは終了の合図（届いた文字列をすべて渡した後に入る）
+        flight.future.add_done_callback(lambda _: deltas.put(None))
+        try:
+            while True:
+                delta = deltas.get()
+                if delta is None:
+                    break
+                yield delta
+            result = flight.future.result()
+            if not leader:
+                self._notify_shared(flight, owner, on_shared)
+            return result
+        finally:
+            flight.unlisten(listener)
+    
+    async def run_async(self, key: str, generate: Callable[[Callable[[str], None]], Coroutine],
+                        on_delta: Optional[Callable[[str], None]] = None,
+                        owner: Tuple[str, str] = ("", ""),
+                        on_shared: Optional[Callable[[Tuple[str, str], int], None]] = None):
+        """
+        同じキーの生成に加わり、結果を待つ（実行中でなければ共有イベントループのタスクとして生成を始める）
+        
+        呼び出し元がキャンセルされても、生成は止めずに最後まで実行する。
+        
+        Args:
+            key: キー
+            generate: 届いた文字列を渡す関数を受け取り、生成して結果を返すコルーチン関数
+            on_delta: 届いた文字列を渡す関数（途中から加わった場合は、それまでに届いた分から順に呼ばれる）
+            owner: 呼び出し元の (先生の名前, クラス名)
+            on_shared: 別の先生・クラスの生成に加わった場合に、(生成を始めた (先生の名前, クラス名),
+                使ったトークン数) で呼ばれる関数（別スレッドで呼ばれる）
+                
+        Returns:
+            生成の結果
+        """
+        flight, leader = self._join(key, owner)
+        if leader:
+            # タスクは作成時のコンテキストを引き継ぐため、その間だけ実行中の生成を設定する
+            token = _current_flight.set(flight)
+            try:
+                flight.task = asyncio.ensure_future(generate(flight.add_delta))
+            finally:
+                _current_flight.reset(token)
+            flight.task.add_done_callback(functools.partial(self._finish_task, key, flight))
+        
+        if on_delta:
+            flight.listen(on_delta)
+        try:
+            result = await asyncio.shield(asyncio.wrap_future(flight.future))
+        finally:
+            if on_delta:
+                flight.unlisten(on_delta)
+        if not leader:
+            await asyncio.to_thread(self._notify_shared, flight, owner, on_shared)
+        return result
+    
+    def stats(self) -> Dict:
+        """
+        まとめた状況を取得
+        
+        Returns:
+            {'flights': 実行した生成の数, 'coalesced': 実行中の生成に加わった数, 'in_flight': 実行中の数}
+        """
+        with self._lock:
+            in_flight = sum(1 for flight in self._flights.values() if flight.finished_at is None)
+            return {'flights': self.flights, 'coalesced': self.coalesced, 'in_flight': in_flight}
+
+
+_single_flight = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    """
+    プロセス全体で共有する SingleFlight を取得
+    
+    Returns:
+        同じリクエストの生成をまとめる SingleFlight
+    """
+    return _single_flight
+
+
+def _drain(deltas: Generator[str, None, List[str]], on_delta: Callable[[str], None]) -> List[str]:
+    """ジェネレータが返す文字列を順に on_delta に渡し、ジェネレータの戻り値を返す"""
+    while True:
+        try:
+            delta = next(deltas)
+        except StopIteration as stop:
+            return stop.value
+        on_delta(delta)
+
+
+def _run_inline(coro: Coroutine):
+    """
+    OpenAIClient の生成の手順（コルーチン）を呼び出し元のスレッドで最後まで実行
+    
+    呼び出しごとに専用のイベントループで実行するため、途中で待つ処理があってもそのまま動く
+    （共有のイベントループには載せない）。呼び出し元のスレッドでイベントループが
+    動いている場合は、別のスレッドで実行する。コンテキスト変数は引き継ぐ。
+    
+    Args:
+        coro: 実行するコルーチン
+        
+    Returns:
+        コルーチンの戻り値
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(context.run, asyncio.run, coro).result()
+
+
+class OpenAIClient(_ShokenClientBase):
+    """
+    OpenAI APIクライアント
     
-    def __init__(self):
-        """クライアントを初期化"""
-        api_key = config.get_openai_api_key()
-        if not api_key:
-            raise ValueError("OpenAI APIキーが設定されていません")
+    それ自体が OpenAI API を呼び出す GenerationBackend でもある。backend を
+    指定すると、APIの代わりにそのバックエンドで生成する（APIキーは不要）。
+    生成の手順は _ShokenClientBase と共通で、I/O は呼び出し元のスレッドで行う。
+    """
+    
+    def __init__(self, cache: Optional[ResponseCache] = None, http_client=None,
+                 backend: Optional[GenerationBackend] = None,
+                 metrics_writer: Optional[metrics.MetricsWriter] = None,
+                 budget: Optional[token_budget.TokenBudget] = None, model: Optional[str] = None):
+        """
+        クライアントを初期化
+        
+        Args:
+            cache: 生成結果キャッシュ（省略時は設定で有効な場合のみ共有のものを使う）
+            http_client: 使用する httpx.Client（省略時は接続プールを新規作成）
+            backend: 生成に使うバックエンド（省略時は OpenAI API）
+            metrics_writer: 生成の記録の書き込み先（省略時は共有のもの）
+            budget: トークン予算（省略時は共有のもの）
+            model: モデル名（省略時は設定から取得。backend を指定した場合は使わない）
+        """
+        if backend is None:
+            api_key = config.get_openai_api_key()
+            if not api_key:
+                raise ValueError("OpenAI APIキーが設定されていません")
+            
+            if http_client is None:
+                http_client = openai.DefaultHttpxClient(limits=_http_limits())
+            
+            # 再試行はスケジューラが行うため、ライブラリの自動再試行は無効にする
+            self.client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+            model = model or config.get_openai_model()
+        else:
+            model = backend.model
         
-        self.client = OpenAI(api_key=api_key)
-        self.model = config.get_openai_model()
+        self.http_client = http_client
+        super().__init__(model, backend, cache, metrics_writer, budget)
     
-    def generate_shoken(self, keywords: List[str], target_length: int = 200, grade_level: str = "低学年") -> str:
+    def generate_shoken(self, keywords: List[str], target_length: int = 200, grade_level: str = "低学年",
+                        class_name: str = "", teacher: str = "") -> str:
         """
         所見文を生成
         
@@ -30,219 +1157,841 @@ class OpenAIClient:
             keywords: キーワードリスト
             target_length: 目標文字数
             grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            生成された所見文（APIが使えない場合・トークン予算を超えた場合は
+            テンプレートで組み立てた所見文）
+        """
+        try:
+            return self._generate(keywords, target_length, grade_level, class_name, teacher)
+        except Exception as e:
+            text = _fallback_text(e, keywords, target_length, grade_level)
+            if text is not None:
+                return text
+            error_handler.handle_error(e)
+            raise
+    
+    def generate_shoken_stream(self, keywords: List[str], target_length: int = 200,
+                               grade_level: str = "低学年", candidates: int = 1,
+                               class_name: str = "", teacher: str = "") -> ShokenStream:
+        """
+        所見文をストリーミングで生成
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            candidates: 1回の呼び出しで生成する候補の数（2以上なら残りの候補を
+                ShokenStream.reserves に入れる）
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            生成された文字列を順に返すストリーム（文字数調整は最後に行う）
+        """
+        return ShokenStream(
+            self._generate_stream(keywords, target_length, grade_level, candidates, class_name, teacher),
+            fallback=lambda e: _fallback_text(e, keywords, target_length, grade_level)
+        )
+    
+    def generate_shoken_batch(self, requests: List[Dict], target_length: int = 200,
+                              grade_level: str = "低学年", max_workers: int = DEFAULT_BATCH_WORKERS,
+                              progress_callback: Optional[Callable[[int, int, BatchResult], None]] = None,
+                              class_name: str = "", teacher: str = "") -> List[BatchResult]:
+        """
+        複数の児童の所見文をまとめて生成
+        
+        最大 max_workers 件を並行してAPIに送る。1人分の生成に失敗しても
+        残りの生成は続け、エラーは結果に記録する（APIが使えない場合・
+        トークン予算を超えた場合はテンプレートで組み立てる）。
+        同じリクエストはまとめない（同じキーワードの児童にも別々に生成する）。
+        
+        Args:
+            requests: 児童ごとのデータのリスト（'keywords' は必須。
+                'student_name' などその他の値は結果にそのまま残す）
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            max_workers: 同時に実行するリクエスト数
+            progress_callback: 1人分終わるごとに (完了数, 全体数, 結果) で呼ばれる関数
+                （呼び出し元のスレッドで呼ばれる）
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            結果のリスト（requestsと同じ順）
+        """
+        results = [BatchResult(index=i, request=request) for i, request in enumerate(requests)]
+        if not requests:
+            return results
+        
+        def run(request: Dict) -> str:
+            return _run_inline(self._generate_once(
+                request['keywords'], target_length, grade_level, class_name, teacher
+            ))
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(requests)))) as executor:
+            futures = {executor.submit(run, request): i for i, request in enumerate(requests)}
+            for completed, future in enumerate(as_completed(futures), start=1):
+                result = results[futures[future]]
+                try:
+                    result.text = future.result()
+                except Exception as e:
+                    _fill_fallback(result, e, target_length, grade_level)
+                if progress_callback:
+                    progress_callback(completed, len(requests), result)
+        
+        return results
+    
+    def _generate(self, keywords: List[str], target_length: int, grade_level: str,
+                  class_name: str = "", teacher: str = "") -> str:
+        """
+        所見文を生成（エラーは画面に表示せずそのまま送出する）
+        
+        同じリクエストの生成が実行中の場合は、新しく生成せずにその結果を使う。
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
             
         Returns:
             生成された所見文
         """
-        # プロンプトを構築
-        keywords_text = "、".join(keywords) if keywords else "一般的な特徴"
+        key = SingleFlight.make_key(keywords, target_length, grade_level, self.model)
+        return get_single_flight().run(
+            key,
+            lambda: _run_inline(self._generate_once(keywords, target_length, grade_level, class_name, teacher)),
+            (teacher, class_name),
+            functools.partial(self._charge_shared, teacher, class_name)
+        )
+    
+    def _generate_stream(self, keywords: List[str], target_length: int, grade_level: str,
+                         candidates: int = 1, class_name: str = "",
+                         teacher: str = "") -> Generator[str, None, List[str]]:
+        """
+        所見文をストリーミングで生成（キャッシュにある場合はその所見文をまとめて返す）
         
-        # 学年に応じた表現のガイド
-        grade_guidance = self._get_grade_guidance(grade_level)
+        同じリクエストの生成が実行中の場合は、新しく生成せずにその生成に加わる。
+        生成は別スレッドで行い、途中で読むのをやめても最後まで続ける。
         
-        prompt = f"""小学校の通知表の所見文を作成してください。
-
-学年: {grade_level}
-児童の特徴・キーワード: {keywords_text}
-
-【所見の構成】
-以下の4つのセクションで構成してください：
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年
+            candidates: 1回の呼び出しで生成する候補の数
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            生成された文字列（1つ目の候補）を順に返し、最後に候補の所見文のリスト
+            （よい順）を戻り値とするジェネレータ
+        """
+        key = SingleFlight.make_key(keywords, target_length, grade_level, self.model, candidates)
+        return get_single_flight().stream(
+            key,
+            lambda on_delta: _run_inline(self._generate_stream_once(
+                keywords, target_length, grade_level, on_delta, candidates, class_name, teacher
+            )),
+            (teacher, class_name),
+            functools.partial(self._charge_shared, teacher, class_name)
+        )
+    
+    # I/O（呼び出し元のスレッドでそのまま実行する）
+    
+    async def _run_blocking(self, func: Callable[..., T], *args) -> T:
+        return func(*args)
+    
+    async def _reserve_tokens(self, teacher: str, class_name: str, tokens: int) -> token_budget.Reservation:
+        return self.budget.reserve(teacher, class_name, tokens)
+    
+    async def _backend_complete(self, messages: List[Dict], max_tokens: int, n: int) -> Completion:
+        return self.backend.complete(messages, max_tokens, TEMPERATURE, n)
+    
+    async def _backend_stream(self, messages: List[Dict], max_tokens: int, n: int,
+                              on_delta: Callable[[str], None]) -> Completion:
+        return _drain(self.backend.stream(messages, max_tokens, TEMPERATURE, n), on_delta)
+    
+    def _with_model(self, model: str) -> "OpenAIClient":
+        return OpenAIClient(
+            cache=self.cache, http_client=self.http_client, metrics_writer=self.metrics,
+            budget=self.budget, model=model
+        )
+    
+    # GenerationBackend の実装（OpenAI API）
+    
+    def complete(self, messages: List[Dict], max_tokens: int,
+                 temperature: float = TEMPERATURE, n: int = 1) -> Completion:
+        """
+        APIを1回呼び出して応答を取得
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度
+            n: 生成する候補の数（プロンプトのトークンは1回分で済む）
+            
+        Returns:
+            応答
+        """
+        reserved_tokens = self._estimate_tokens(messages, max_tokens * n)
+        response = self.scheduler.call(
+            lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                n=n
+            ),
+            reserved_tokens,
+            on_retry=_retry_counter()
+        )
+        used_tokens = None
+        try:
+            completion = _completion_from_response(response)
+            used_tokens = completion.total_tokens
+            return completion
+        finally:
+            # 応答を読み取れなかった場合は、予約した分を使ったものとする
+            self.scheduler.settle(reserved_tokens, used_tokens)
+    
+    def stream(self, messages: List[Dict], max_tokens: int,
+               temperature: float = TEMPERATURE, n: int = 1) -> Generator[str, None, Completion]:
+        """
+        APIをストリーミングで呼び出す
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度
+            n: 生成する候補の数
+            
+        Yields:
+            1つ目の候補に届いた文字列
+            
+        Returns:
+            応答全体
+        """
+        reserved_tokens = self._estimate_tokens(messages, max_tokens * n)
+        stream = self.scheduler.call(
+            lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                n=n,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            reserved_tokens,
+            on_retry=_retry_counter()
+        )
+        
+        # 途中でエラーになった場合や読むのをやめた場合も精算する（使用量が届いて
+        # いなければ、予約した分を使ったものとする）
+        collector = _StreamCollector(n)
+        try:
+            for chunk in stream:
+                delta = collector.add(chunk)
+                if delta:
+                    yield delta
+            return collector.completion()
+        finally:
+            stream.close()
+            self.scheduler.settle(reserved_tokens, collector.completion().total_tokens)
 
-①書き出し（全体の様子）
-子どもの学校生活全般での雰囲気を描写してください。
 
-②学習面の様子
-各教科の取り組みの様子を具体的に描写してください。具体的な授業場面や学習内容を含めると良いでしょう。
+# 非同期クライアントが共有するイベントループ（専用のデーモンスレッドで動かす）
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+_event_loop_lock = threading.Lock()
 
-③生活面の様子
-あいさつや掃除・係活動・人間関係など、生活面での様子を具体的に描写してください。
 
-④今後の期待
-今後に向けた目標や期待を温かく伝えてください。
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    共有イベントループを取得（初回呼び出し時に起動）
+    
+    Returns:
+        バックグラウンドスレッドで動いているイベントループ
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None or _event_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="shoken-event-loop", daemon=True)
+            thread.start()
+            _event_loop = loop
+        return _event_loop
 
-【要件】
-- 文字数は約{target_length}文字程度（{target_length - 20}文字から{target_length + 20}文字の範囲）
-- 具体的で温かみのある表現を使用
-- 否定的な表現は避け、前向きな表現を心がける
-- 4つのセクションを自然につなげて、一つの文章として完成させる
 
-【表現のポイント】
-以下のような多様な表現を積極的に使用してください。同じ表現の繰り返しを避け、バリエーションを持たせてください：
+def run_sync(coro: Coroutine, timeout: Optional[float] = None):
+    """
+    コルーチンを共有イベントループで実行し、結果を待つ
+    
+    Args:
+        coro: 実行するコルーチン
+        timeout: 待つ秒数（Noneなら完了まで待つ）
+        
+    Returns:
+        コルーチンの戻り値
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result(timeout)
 
-書き出しの表現例：
-- 「〜な姿が見られます」「〜な姿が見られ、感心します」
-- 「〜な様子がうかがえます」「〜な一面が印象的です」
-- 「〜に取り組む姿が目立ちます」「〜を大切にしている様子が伝わってきます」
-- 「日々の〜を通して、〜な成長が見られます」
 
-学習面の表現例：
-- 「〜に積極的に取り組んでいます」「〜を楽しみながら学んでいます」
-- 「〜を意識して取り組む姿が印象的です」「〜を大切にしながら学習しています」
-- 「〜ができるようになりました」「〜を身につけています」
-- 「〜に興味を持ち、〜を調べる姿が見られます」「〜を深く考えています」
+class AsyncOpenAIClient(_ShokenClientBase):
+    """
+    OpenAI APIの非同期クライアント
+    
+    共有イベントループ上で使う。それ自体が OpenAI API を呼び出す
+    AsyncGenerationBackend でもあり、backend を指定するとAPIの代わりに
+    そのバックエンドで生成する。生成の手順は OpenAIClient と共通
+    （_ShokenClientBase）で、I/O はイベントループを止めないように行う。
+    """
+    
+    def __init__(self, api_key: Optional[str] = None, model: Optional[str] = None, http_client=None,
+                 cache: Optional[ResponseCache] = None,
+                 metrics_writer: Optional[metrics.MetricsWriter] = None,
+                 budget: Optional[token_budget.TokenBudget] = None,
+                 backend: Optional[AsyncGenerationBackend] = None):
+        """
+        クライアントを初期化
+        
+        Args:
+            api_key: APIキー（省略時は設定から取得）
+            model: モデル名（省略時は設定から取得。backend を指定した場合は使わない）
+            http_client: 使用する httpx.AsyncClient（省略時は接続プールを新規作成）
+            cache: 生成結果キャッシュ（省略時は設定で有効な場合のみ共有のものを使う）
+            metrics_writer: 生成の記録の書き込み先（省略時は共有のもの）
+            budget: トークン予算（省略時は共有のもの）
+            backend: 生成に使うバックエンド（省略時は OpenAI API。指定した場合はAPIキーは不要）
+        """
+        if backend is None:
+            api_key = api_key or config.get_openai_api_key()
+            if not api_key:
+                raise ValueError("OpenAI APIキーが設定されていません")
+            
+            if http_client is None:
+                http_client = openai.DefaultAsyncHttpxClient(http2=HTTP2_AVAILABLE, limits=_http_limits())
+            
+            # 再試行はスケジューラが行うため、ライブラリの自動再試行は無効にする
+            self.client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+            model = model or config.get_openai_model()
+        else:
+            model = backend.model
+        
+        self.api_key = api_key
+        self.http_client = http_client
+        super().__init__(model, backend, cache, metrics_writer, budget)
+    
+    async def generate_shoken(self, keywords: List[str], target_length: int = 200,
+                              grade_level: str = "低学年", class_name: str = "", teacher: str = "") -> str:
+        """
+        所見文を生成（エラーはそのまま送出する）
+        
+        同じリクエストの生成が実行中の場合は、新しく生成せずにその結果を使う。
+        生成はこの呼び出しから切り離して行い、キャンセルされても最後まで続ける。
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            生成された所見文
+        """
+        key = SingleFlight.make_key(keywords, target_length, grade_level, self.model)
+        return await get_single_flight().run_async(
+            key,
+            lambda _: self._generate_once(keywords, target_length, grade_level, class_name, teacher),
+            owner=(teacher, class_name),
+            on_shared=functools.partial(self._charge_shared, teacher, class_name)
+        )
+    
+    async def generate_shoken_stream(self, keywords: List[str], target_length: int,
+                                     grade_level: str, on_delta: Callable[[str], None],
+                                     candidates: int = 1, class_name: str = "",
+                                     teacher: str = "") -> List[str]:
+        """
+        所見文をストリーミングで生成（エラーはそのまま送出する）
+        
+        同じリクエストの生成が実行中の場合は、新しく生成せずにその生成に加わる
+        （それまでに届いた文字列から順に on_delta に渡す）。生成はこの呼び出しから
+        切り離して行い、キャンセルされても最後まで続ける。
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            on_delta: 1つ目の候補に文字列が届くたびに呼ばれる関数（イベントループのスレッドで
+                呼ばれる。キャッシュにある場合はその所見文で1回だけ呼ばれる）
+            candidates: 1回の呼び出しで生成する候補の数
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            候補の所見文のリスト（表示した1つ目の候補と、残りの候補をよい順に並べたもの。
+            文字数調整は1つ目の候補にだけ行う）
+        """
+        key = SingleFlight.make_key(keywords, target_length, grade_level, self.model, candidates)
+        return await get_single_flight().run_async(
+            key,
+            lambda add_delta: self._generate_stream_once(
+                keywords, target_length, grade_level, add_delta, candidates, class_name, teacher
+            ),
+            on_delta,
+            (teacher, class_name),
+            functools.partial(self._charge_shared, teacher, class_name)
+        )
+    
+    async def generate_shoken_batch(self, requests: List[Dict], target_length: int = 200,
+                                    grade_level: str = "低学年", max_workers: int = DEFAULT_BATCH_WORKERS,
+                                    progress_callback: Optional[Callable[[int, int, BatchResult], None]] = None,
+                                    class_name: str = "", teacher: str = "") -> List[BatchResult]:
+        """
+        複数の児童の所見文をまとめて生成
+        
+        最大 max_workers 件を並行してAPIに送る。1人分の生成に失敗しても
+        残りの生成は続け、エラーは結果に記録する（APIが使えない場合・
+        トークン予算を超えた場合はテンプレートで組み立てる）。
+        同じリクエストはまとめない（同じキーワードの児童にも別々に生成する）。
+        
+        Args:
+            requests: 児童ごとのデータのリスト（'keywords' は必須）
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            max_workers: 同時に実行するリクエスト数
+            progress_callback: 1人分終わるごとに (完了数, 全体数, 結果) で呼ばれる関数
+                （イベントループのスレッドで呼ばれる）
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
+            
+        Returns:
+            結果のリスト（requestsと同じ順）
+        """
+        results = [BatchResult(index=i, request=request) for i, request in enumerate(requests)]
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+        
+        async def run(result: BatchResult) -> BatchResult:
+            async with semaphore:
+                try:
+                    result.text = await self._generate_once(
+                        result.request['keywords'], target_length, grade_level, class_name, teacher
+                    )
+                except Exception as e:
+                    _fill_fallback(result, e, target_length, grade_level)
+            return result
+        
+        tasks = [run(result) for result in results]
+        for completed, task in enumerate(asyncio.as_completed(tasks), start=1):
+            result = await task
+            if progress_callback:
+                progress_callback(completed, len(requests), result)
+        
+        return results
+    
+    async def close(self):
+        """API の接続プールを閉じる（バックエンドを指定した場合は何もしない）"""
+        if self.backend is self:
+            await self.client.close()
+    
+    # I/O（データベースは別スレッドで読み書きし、イベントループを止めない）
+    
+    async def _run_blocking(self, func: Callable[..., T], *args) -> T:
+        return await asyncio.to_thread(func, *args)
+    
+    async def _reserve_tokens(self, teacher: str, class_name: str, tokens: int) -> token_budget.Reservation:
+        return await self.budget.reserve_async(teacher, class_name, tokens)
+    
+    async def _backend_complete(self, messages: List[Dict], max_tokens: int, n: int) -> Completion:
+        return await self.backend.complete_async(messages, max_tokens, TEMPERATURE, n)
+    
+    async def _backend_stream(self, messages: List[Dict], max_tokens: int, n: int,
+                              on_delta: Callable[[str], None]) -> Completion:
+        return await self.backend.stream_async(messages, max_tokens, TEMPERATURE, n, on_delta)
+    
+    def _with_model(self, model: str) -> "AsyncOpenAIClient":
+        return AsyncOpenAIClient(self.api_key, model, self.http_client, self.cache, self.metrics, self.budget)
+    
+    # AsyncGenerationBackend の実装（OpenAI API）
+    
+    async def complete_async(self, messages: List[Dict], max_tokens: int,
+                             temperature: float = TEMPERATURE, n: int = 1) -> Completion:
+        """
+        APIを1回呼び出して応答を取得
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度
+            n: 生成する候補の数
+            
+        Returns:
+            応答
+        """
+        reserved_tokens = self._estimate_tokens(messages, max_tokens * n)
+        response = await self.scheduler.call_async(
+            lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                n=n
+            ),
+            reserved_tokens,
+            on_retry=_retry_counter()
+        )
+        used_tokens = None
+        try:
+            completion = _completion_from_response(response)
+            used_tokens = completion.total_tokens
+            return completion
+        finally:
+            # 応答を読み取れなかった場合は、予約した分を使ったものとする
+            self.scheduler.settle(reserved_tokens, used_tokens)
+    
+    async def stream_async(self, messages: List[Dict], max_tokens: int,
+                           temperature: float = TEMPERATURE, n: int = 1,
+                           on_delta: Optional[Callable[[str], None]] = None) -> Completion:
+        """
+        APIをストリーミングで呼び出す
+        
+        Args:
+            messages: メッセージのリスト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度
+            n: 生成する候補の数
+            on_delta: 1つ目の候補に文字列が届くたびに呼ばれる関数
+            
+        Returns:
+            応答全体
+        """
+        reserved_tokens = self._estimate_tokens(messages, max_tokens * n)
+        stream = await self.scheduler.call_async(
+            lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                n=n,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            reserved_tokens,
+            on_retry=_retry_counter()
+        )
+        
+        # 途中でエラーになった場合やキャンセルされた場合も精算する（使用量が届いて
+        # いなければ、予約した分を使ったものとする）
+        collector = _StreamCollector(n)
+        try:
+            async for chunk in stream:
+                delta = collector.add(chunk)
+                if delta and on_delta:
+                    on_delta(delta)
+            return collector.completion()
+        finally:
+            await stream.close()
+            self.scheduler.settle(reserved_tokens, collector.completion().total_tokens)
 
-生活面の表現例：
-- 「〜ところが素敵です」「〜ことが素晴らしいです」
-- 「〜を大切にしています」「〜を心がけています」
-- 「〜に責任感を持って取り組んでいます」「〜を丁寧に行っています」
-- 「〜を通して、〜な姿勢が見られます」「〜を意識して行動しています」
 
-今後の期待の表現例：
-- 「これからも〜を大切にしながら、〜を期待しています」
-- 「今後も〜を続けながら、〜な成長を願っています」
-- 「〜を活かしながら、〜を目指してほしいと思います」
-- 「〜を意識しながら、〜を伸ばしていってほしいと願っています」
+_async_client: Optional[AsyncOpenAIClient] = None
+_async_client_key: Optional[Tuple[str, str]] = None
+_async_client_checked_at = 0.0
+_async_client_lock = threading.Lock()
 
-避けるべき表現：
-- 「称賛します」「賞賛します」などの硬い表現
-- 過度に形式的な表現
-- 同じ表現の繰り返し
 
-児童の成長や努力を具体的に描写し、教師が温かく見守っている印象を与える表現にしてください。
+def get_async_client() -> AsyncOpenAIClient:
+    """
+    プロセス全体で共有する AsyncOpenAIClient を取得
+    
+    APIキーとモデルの設定は ASYNC_CLIENT_SETTINGS_TTL_SECONDS ごとに読み直し、
+    変わった場合は作り直す。古いクライアントの接続プールは共有イベントループで閉じる。
+    
+    Returns:
+        共有の非同期クライアント
+    """
+    global _async_client, _async_client_key, _async_client_checked_at
+    with _async_client_lock:
+        now = time.monotonic()
+        if _async_client is not None and now - _async_client_checked_at < ASYNC_CLIENT_SETTINGS_TTL_SECONDS:
+            return _async_client
+        
+        key = (config.get_openai_api_key(), config.get_openai_model())
+        if _async_client is None or _async_client_key != key:
+            old_client = _async_client
+            _async_client = AsyncOpenAIClient(*key)
+            _async_client_key = key
+            if old_client is not None:
+                asyncio.run_coroutine_threadsafe(old_client.close(), get_event_loop())
+        _async_client_checked_at = now
+        return _async_client
 
-{grade_guidance}
 
-所見文:"""
+class AsyncClientAdapter:
+    """
+    AsyncOpenAIClient を同期的に呼び出すためのアダプター
+    
+    OpenAIClient と同じメソッドを持ち、処理は共有イベントループで行う。
+    多数のセッションが1つのループと接続プールを共有する。
+    """
+    
+    def __init__(self, async_client: Optional[AsyncOpenAIClient] = None):
+        """
+        アダプターを初期化
         
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """あなたは経験豊富な小学校教師です。児童の成長を温かく見守り、適切な所見文を作成します。
-
-所見文は必ず以下の4つのセクションで構成してください：
-①書き出し（全体の様子）
-②学習面の様子
-③生活面の様子
-④今後の期待
-
-各セクションを自然につなげて、一つの文章として完成させてください。
-
-表現において、以下のような多様な表現を積極的に使用してください。同じ表現の繰り返しを避け、バリエーションを持たせてください：
-
-書き出しの表現例：
-- 「〜な姿が見られます」「〜な姿が見られ、感心します」
-- 「〜な様子がうかがえます」「〜な一面が印象的です」
-- 「〜に取り組む姿が目立ちます」「〜を大切にしている様子が伝わってきます」
-
-学習面の表現例：
-- 「〜に積極的に取り組んでいます」「〜を楽しみながら学んでいます」
-- 「〜を意識して取り組む姿が印象的です」「〜を大切にしながら学習しています」
-- 「〜ができるようになりました」「〜を身につけています」
-
-生活面の表現例：
-- 「〜ところが素敵です」「〜ことが素晴らしいです」
-- 「〜を大切にしています」「〜を心がけています」
-- 「〜に責任感を持って取り組んでいます」「〜を丁寧に行っています」
-
-今後の期待の表現例：
-- 「これからも〜を大切にしながら、〜を期待しています」
-- 「今後も〜を続けながら、〜な成長を願っています」
-- 「〜を活かしながら、〜を目指してほしいと思います」
-
-避けるべき表現：
-- 「称賛します」「賞賛します」などの硬い表現
-- 過度に形式的な表現
-- 同じ表現の繰り返し
-
-温かく、自然で、児童の成長を具体的に描写する所見文を作成してください。表現にバリエーションを持たせ、毎回異なる表現で所見文を生成してください。"""
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.8,
-                max_tokens=600
-            )
-            
-            generated_text = response.choices[0].message.content.strip()
-            
-            # 文字数調整
-            adjusted_text = self._adjust_length(generated_text, target_length)
-            
-            return adjusted_text
+        Args:
+            async_client: 使用する非同期クライアント（省略時は共有のもの）
+        """
+        self.async_client = async_client or get_async_client()
+    
+    def generate_shoken(self, keywords: List[str], target_length: int = 200, grade_level: str = "低学年",
+                        class_name: str = "", teacher: str = "") -> str:
+        """
+        所見文を生成
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
             
+        Returns:
+            生成された所見文（APIが使えない場合・トークン予算を超えた場合は
+            テンプレートで組み立てた所見文）
+        """
+        try:
+            return run_sync(self.async_client.generate_shoken(
+                keywords, target_length, grade_level, class_name, teacher
+            ))
         except Exception as e:
+            text = _fallback_text(e, keywords, target_length, grade_level)
+            if text is not None:
+                return text
             error_handler.handle_error(e)
             raise
     
-    def _adjust_length(self, text: str, target_length: int) -> str:
+    def generate_shoken_stream(self, keywords: List[str], target_length: int = 200,
+                               grade_level: str = "低学年", candidates: int = 1,
+                               class_name: str = "", teacher: str = "") -> ShokenStream:
         """
-        文字数を調整
+        所見文をストリーミングで生成
         
         Args:
-            text: 元のテキスト
+            keywords: キーワードリスト
             target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            candidates: 1回の呼び出しで生成する候補の数（2以上なら残りの候補を
+                ShokenStream.reserves に入れる）
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
             
         Returns:
-            調整されたテキスト
+            生成された文字列を順に返すストリーム（文字数調整は最後に行う）
         """
-        current_length = len(text)
-        
-        # 目標文字数の範囲内ならそのまま返す
-        if target_length - 20 <= current_length <= target_length + 20:
-            return text
+        return ShokenStream(
+            self._stream_from_loop(keywords, target_length, grade_level, candidates, class_name, teacher),
+            fallback=lambda e: _fallback_text(e, keywords, target_length, grade_level)
+        )
+    
+    def _stream_from_loop(self, keywords: List[str], target_length: int, grade_level: str,
+                          candidates: int, class_name: str = "",
+                          teacher: str = "") -> Generator[str, None, List[str]]:
+        """共有イベントループで生成し、届いた文字列をキューで呼び出し元のスレッドに渡す"""
+        deltas = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self.async_client.generate_shoken_stream(
+                keywords, target_length, grade_level, deltas.put, candidates, class_name, teacher
+            ),
+            get_event_loop()
+        )
+        # Noneは終了の合図
+        future.add_done_callback(lambda _: deltas.put(None))
         
-        # 短すぎる場合は補足を追加
-        if current_length < target_length - 20:
-            # もう一度生成を試みる（簡易版：末尾に補足）
-            # 実際の実装では、プロンプトを調整して再生成する方が良い
-            return text
+        try:
+            while True:
+                delta = deltas.get()
+                if delta is None:
+                    break
+                yield delta
+            return future.result()
+        finally:
+            # 途中で読むのをやめた場合は待つのをやめる（生成は最後まで続け、
+            # 再実行された同じリクエストが加われるようにする）
+            future.cancel()
+    
+    def generate_shoken_batch(self, requests: List[Dict], target_length: int = 200,
+                              grade_level: str = "低学年", max_workers: int = DEFAULT_BATCH_WORKERS,
+                              progress_callback: Optional[Callable[[int, int, BatchResult], None]] = None,
+                              class_name: str = "", teacher: str = "") -> List[BatchResult]:
+        """
+        複数の児童の所見文をまとめて生成
         
-        # 長すぎる場合は要約
-        if current_length > target_length + 20:
-            # 文の区切りで切り詰める
-            sentences = text.split('。')
-            result = ""
-            for sentence in sentences:
-                if sentence:
-                    if len(result + sentence + '。') <= target_length + 20:
-                        result += sentence + '。'
-                    else:
-                        break
+        Args:
+            requests: 児童ごとのデータのリスト（'keywords' は必須）
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            max_workers: 同時に実行するリクエスト数
+            progress_callback: 1人分終わるごとに (完了数, 全体数, 結果) で呼ばれる関数
+                （呼び出し元のスレッドで呼ばれる）
+            class_name: クラス名（生成の記録とトークン予算の管理に使う）
+            teacher: 先生の名前（トークン予算の管理に使う）
             
-            if result:
-                return result
-            else:
-                # フォールバック：文字数で切り詰め
-                return text[:target_length + 20] + '...'
+        Returns:
+            結果のリスト（requestsと同じ順）
+        """
+        # 進捗はキューで呼び出し元のスレッドに渡す（Noneは終了の合図）
+        progress = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self.async_client.generate_shoken_batch(
+                requests, target_length, grade_level, max_workers,
+                lambda *args: progress.put(args), class_name, teacher
+            ),
+            get_event_loop()
+        )
+        future.add_done_callback(lambda _: progress.put(None))
         
-        return text
+        while True:
+            args = progress.get()
+            if args is None:
+                break
+            if progress_callback:
+                progress_callback(*args)
+        
+        return future.result()
+
+
+class TemplateClient:
+    """
+    テンプレートで所見文を組み立てるクライアント（APIを使わない）
+    
+    OpenAIClient と同じメソッドを持つ。下書きをまとめて作る場合に使う。
+    """
     
-    def _get_grade_guidance(self, grade_level: str) -> str:
+    model = ENGINE_TEMPLATE
+    
+    def generate_shoken(self, keywords: List[str], target_length: int = 200, grade_level: str = "低学年",
+                        class_name: str = "", teacher: str = "") -> str:
         """
-        学年に応じた表現のガイドを取得
+        所見文を組み立てる
         
         Args:
-            grade_level: 学年
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            class_name: 使わない（OpenAIClient と同じ呼び出し方にするため）
+            teacher: 使わない（OpenAIClient と同じ呼び出し方にするため）
             
         Returns:
-            ガイドテキスト
+            組み立てた所見文
+        """
+        return template_generator.generate_shoken(keywords, target_length, grade_level)
+    
+    def generate_shoken_stream(self, keywords: List[str], target_length: int = 200,
+                               grade_level: str = "低学年", candidates: int = 1,
+                               class_name: str = "", teacher: str = "") -> ShokenStream:
         """
-        if grade_level == "低学年":
-            return """【低学年向けの表現】
-- 「入学して間もない頃は〜でしたが、今では〜」などの成長の過程を描写
-- 「〜しようとする姿」「〜できるようになってきました」など、成長を感じられる表現
-- 「自分でできた！」という前向きな体験を大切にする表現
-- 具体的な場面（ひらがなの練習、ランドセルの片付けなど）を含める"""
+        所見文を組み立て、ストリームとして返す（所見文全体を1回で返す）
         
-        elif grade_level == "中学年":
-            return """【中学年向けの表現】
-- 「新しい教科や学習内容にも積極的に取り組み」など、学習への意欲を表現
-- 「自分から学ぼうとする姿」「探求心を活かし」など、主体的な学びを描写
-- 「自分で時間を見ながら行動」「目標を立てて努力」など、自律性を表現
-- 具体的な学習内容（理科の観察、算数のグラフなど）や活動（給食当番、グループ活動など）を含める"""
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            candidates: 組み立てる候補の数（言い回しを変えたもの）
+            class_name: 使わない（OpenAIClient と同じ呼び出し方にするため）
+            teacher: 使わない（OpenAIClient と同じ呼び出し方にするため）
+            
+        Returns:
+            所見文を返すストリーム
+        """
+        def deltas() -> Generator[str, None, List[str]]:
+            texts = [
+                template_generator.generate_shoken(keywords, target_length, grade_level, variant)
+                for variant in range(max(1, candidates))
+            ]
+            yield texts[0]
+            return list(dict.fromkeys(texts))
         
-        elif grade_level == "高学年":
-            return """【高学年向けの表現】
-- 「意欲を持って取り組み」「チャレンジ精神がしっかりと育っています」など、高学年らしい意欲を表現
-- 「リーダーの自覚を持って」「責任を持って取り組んでいます」など、リーダーシップを描写
-- 「自分で考えて工夫・努力ができる才能」など、高学年としての成長を表現
-- 具体的な活動（委員会活動、作品づくり、掃除活動など）を含める
-- 卒業後への期待も含める（高学年の場合）"""
+        return ShokenStream(deltas(), engine=ENGINE_TEMPLATE)
+    
+    def generate_shoken_batch(self, requests: List[Dict], target_length: int = 200,
+                              grade_level: str = "低学年", max_workers: int = DEFAULT_BATCH_WORKERS,
+                              progress_callback: Optional[Callable[[int, int, BatchResult], None]] = None,
+                              class_name: str = "", teacher: str = "") -> List[BatchResult]:
+        """
+        複数の児童の所見文をまとめて組み立てる
         
-        else:
-            return ""
+        Args:
+            requests: 児童ごとのデータのリスト（'keywords' は必須）
+            target_length: 目標文字数
+            grade_level: 学年（"低学年"、"中学年"、"高学年"）
+            max_workers: 使わない（OpenAIClient と同じ呼び出し方にするため）
+            progress_callback: 1人分終わるごとに (完了数, 全体数, 結果) で呼ばれる関数
+            class_name: 使わない（OpenAIClient と同じ呼び出し方にするため）
+            teacher: 使わない（OpenAIClient と同じ呼び出し方にするため）
+            
+        Returns:
+            結果のリスト（requestsと同じ順）
+        """
+        results = []
+        for i, request in enumerate(requests):
+            result = BatchResult(
+                index=i,
+                request=request,
+                text=self.generate_shoken(request['keywords'], target_length, grade_level),
+                engine=ENGINE_TEMPLATE
+            )
+            results.append(result)
+            if progress_callback:
+                progress_callback(i + 1, len(requests), result)
+        return results
+
+
+_client: Optional[AsyncClientAdapter] = None
+_client_lock = threading.Lock()
+_template_client = TemplateClient()
+_stub_client: Optional[AsyncClientAdapter] = None
+
+# GENERATION_BACKEND=stub のときの疑似バックエンドの応答時間
+STUB_LATENCY_SECONDS = 0.5
+STUB_STREAM_INTERVAL_SECONDS = 0.02
+
+
+def get_client(engine: str = ENGINE_AI) -> Union[AsyncClientAdapter, TemplateClient]:
+    """
+    プロセス全体で共有する所見生成クライアントを取得
+    
+    すべてのセッションが同じクライアント（と接続プール）を使う。
+    APIキーかモデルの設定が変わった場合のみ作り直す。
+    設定で疑似バックエンド（GENERATION_BACKEND=stub）を選んだ場合は、
+    APIの代わりに疑似バックエンドを呼ぶ同じ種類のクライアントを返す
+    （APIの呼び出し以外は本番と同じ処理を通る）。
+    
+    Args:
+        engine: 生成方法（ENGINE_AI または ENGINE_TEMPLATE）
+    
+    Returns:
+        同期的に呼び出せる所見生成クライアント
+    """
+    global _client, _stub_client
+    if engine == ENGINE_TEMPLATE:
+        return _template_client
+    
+    if config.get_generation_backend() == "stub":
+        with _client_lock:
+            if _stub_client is None:
+                _stub_client = AsyncClientAdapter(AsyncOpenAIClient(backend=StubBackend(
+                    latency=STUB_LATENCY_SECONDS,
+                    stream_interval=STUB_STREAM_INTERVAL_SECONDS
+                )))
+            return _stub_client
+    
+    async_client = get_async_client()
+    with _client_lock:
+        if _client is None or _client.async_client is not async_client:
+            _client = AsyncClientAdapter(async_client)
+        return _client
@@ -0,0 +1,461 @@
+"""
+プロンプトテンプレートモジュール
+所見文の生成に使うプロンプトをバージョンごとに管理し、学年ごとに組み立てておく
+"""
+
+import functools
+import hashlib
+import importlib.util
+import json
+import math
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from length_controller import LENGTH_TOLERANCE
+
+
+# tiktoken がインストールされている場合のみ正確なトークン数を数える
+TIKTOKEN_AVAILABLE = importlib.util.find_spec("tiktoken") is not None
+# モデル名を省略した場合に使うエンコーディングのモデル
+DEFAULT_ENCODING_MODEL = "gpt-3.5-turbo"
+
+# 読み込み済みのエンコーディング（モデル名 -> エンコーディング。読み込めない場合はNone）
+_encodings: Dict[str, object] = {}
+_encodings_lock = threading.Lock()
+
+# 1メッセージあたりの書式分のトークン数（Chat Completions APIの目安）
+TOKENS_PER_MESSAGE = 4
+
+# 学年ごとの表現のガイド
+GRADE_GUIDANCE = {
+    "低学年": """【低学年向けの表現】
+- 「入学して間もない頃は〜でしたが、今では〜」などの成長の過程を描写
+- 「〜しようとする姿」「〜できるようになってきました」など、成長を感じられる表現
+- 「自分でできた！」という前向きな体験を大切にする表現
+- 具体的な場面（ひらがなの練習、ランドセルの片付けなど）を含める""",
+    "中学年": """【中学年向けの表現】
+- 「新しい教科や学習内容にも積極的に取り組み」など、学習への意欲を表現
+- 「自分から学ぼうとする姿」「探求心を活かし」など、主体的な学びを描写
+- 「自分で時間を見ながら行動」「目標を立てて努力」など、自律性を表現
+- 具体的な学習内容（理科の観察、算数のグラフなど）や活動（給食当番、グループ活動など）を含める""",
+    "高学年": """【高学年向けの表現】
+- 「意欲を持って取り組み」「チャレンジ精神がしっかりと育っています」など、高学年らしい意欲を表現
+- 「リーダーの自覚を持って」「責任を持って取り組んでいます」など、リーダーシップを描写
+- 「自分で考えて工夫・努力ができる才能」など、高学年としての成長を表現
+- 具体的な活動（委員会活動、作品づくり、掃除活動など）を含める
+- 卒業後への期待も含める（高学年の場合）""",
+}
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """
+    所見文のプロンプトテンプレート
+    
+    system と user の {...} を置き換えてメッセージを作る。{grade_level} と
+    {grade_guidance} は学年ごとに1回だけ置き換え（compile_prompt）、
+    {keywords}・{target_length}・{min_length}・{max_length} は呼び出しごとに置き換える。
+    """
+    
+    version: int
+    system: str
+    user: str
+    
+    @property
+    def hash(self) -> str:
+        """テンプレートの内容のハッシュ（16進数16文字）"""
+        payload = json.dumps([self.version, self.system, self.user, GRADE_GUIDANCE], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """学年ごとに組み立て済みのプロンプト"""
+    
+    version: int
+    grade_level: str
+    system: str
+    user: str
+    
+    def render(self, keywords: List[str], target_length: int) -> List[Dict]:
+        """
+        APIに送るメッセージを作成
+        
+        Args:
+            keywords: キーワードリスト
+            target_length: 目標文字数
+            
+        Returns:
+            メッセージのリスト
+        """
+        user = _fill(self.user, {
+            "keywords": "、".join(keywords) if keywords else "一般的な特徴",
+            "target_length": str(target_length),
+            "min_length": str(target_length - LENGTH_TOLERANCE),
+            "max_length": str(target_length + LENGTH_TOLERANCE),
+        })
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": user},
+        ]
+    
+    def static_prefix(self) -> str:
+        """呼び出しごとに変わる部分より前の、毎回同じになる部分"""
+        return self.system + self.user[:min(
+            self.user.index("{" + name + "}") for name in
+            ("keywords", "target_length", "min_length", "max_length")
+            if "{" + name + "}" in self.user
+        )]
+
+
+# バージョン1: 従来のプロンプト（キーワードが user の先頭近くにあり、共通部分が短い）
+_TEMPLATE_V1 = PromptTemplate(
+    version=1,
+    system="""あなたは経験豊富な小学校教師です。児童の成長を温かく見守り、適切な所見文を作成します。
+
+所見文は必ず以下の4つのセクションで構成してください：
+①書き出し（全体の様子）
+②学習面の様子
+③生活面の様子
+④今後の期待
+
+各セクションを自然につなげて、一つの文章として完成させてください。
+
+表現において、以下のような多様な表現を積極的に使用してください。同じ表現の繰り返しを避け、バリエーションを持たせてください：
+
+書き出しの表現例：
+- 「〜な姿が見られます」「〜な姿が見られ、感心します」
+- 「〜な様子がうかがえます」「〜な一面が印象的です」
+- 「〜に取り組む姿が目立ちます」「〜を大切にしている様子が伝わってきます」
+
+学習面の表現例：
+- 「〜に積極的に取り組んでいます」「〜を楽しみながら学んでいます」
+- 「〜を意識して取り組む姿が印象的です」「〜を大切にしながら学習しています」
+- 「〜ができるようになりました」「〜を身につけています」
+
+生活面の表現例：
+- 「〜ところが素敵です」「〜ことが素晴らしいです」
+- 「〜を大切にしています」「〜を心がけています」
+- 「〜に責任感を持って取り組んでいます」「〜を丁寧に行っています」
+
+今後の期待の表現例：
+- 「これからも〜を大切にしながら、〜を期待しています」
+- 「今後も〜を続けながら、〜な成長を願っています」
+- 「〜を活かしながら、〜を目指してほしいと思います」
+
+避けるべき表現：
+- 「称賛します」「賞賛します」などの硬い表現
+- 過度に形式的な表現
+- 同じ表現の繰り返し
+
+温かく、自然で、児童の成長を具体的に描写する所見文を作成してください。表現にバリエーションを持たせ、毎回異なる表現で所見文を生成してください。""",
+    user="""小学校の通知表の所見文を作成してください。
+
+学年: {grade_level}
+児童の特徴・キーワード: {keywords}
+
+【所見の構成】
+以下の4つのセクションで構成してください：
+
+①書き出し（全体の様子）
+子どもの学校生活全般での雰囲気を描写してください。
+
+②学習面の様子
+各教科の取り組みの様子を具体的に描写してください。具体的な授業場面や学習内容を含めると良いでしょう。
+
+③生活面の様子
+あいさつや掃除・係活動・人間関係など、生活面での様子を具体的に描写してください。
+
+④今後の期待
+今後に向けた目標や期待を温かく伝えてください。
+
+【要件】
+- 文字数は約{target_length}文字程度（{min_length}文字から{max_length}文字の範囲）
+- 具体的で温かみのある表現を使用
+- 否定的な表現は避け、前向きな表現を心がける
+- 4つのセクションを自然につなげて、一つの文章として完成させる
+
+【表現のポイント】
+以下のような多様な表現を積極的に使用してください。同じ表現の繰り返しを避け、バリエーションを持たせてください：
+
+書き出しの表現例：
+- 「〜な姿が見られます」「〜な姿が見られ、感心します」
+- 「〜な様子がうかがえます」「〜な一面が印象的です」
+- 「〜に取り組む姿が目立ちます」「〜を大切にしている様子が伝わってきます」
+- 「日々の〜を通して、〜な成長が見られます」
+
+学習面の表現例：
+- 「〜に積極的に取り組んでいます」「〜を楽しみながら学んでいます」
+- 「〜を意識して取り組む姿が印象的です」「〜を大切にしながら学習しています」
+- 「〜ができるようになりました」「〜を身につけています」
+- 「〜に興味を持ち、〜を調べる姿が見られます」「〜を深く考えています」
+
+生活面の表現例：
+- 「〜ところが素敵です」「〜ことが素晴らしいです」
+- 「〜を大切にしています」「〜を心がけています」
+- 「〜に責任感を持って取り組んでいます」「〜を丁寧に行っています」
+- 「〜を通して、〜な姿勢が見られます」「〜を意識して行動しています」
+
+今後の期待の表現例：
+- 「これからも〜を大切にしながら、〜を期待しています」
+- 「今後も〜を続けながら、〜な成長を願っています」
+- 「〜を活かしながら、〜を目指してほしいと思います」
+- 「〜を意識しながら、〜を伸ばしていってほしいと願っています」
+
+避けるべき表現：
+- 「称賛します」「賞賛します」などの硬い表現
+- 過度に形式的な表現
+- 同じ表現の繰り返し
+
+児童の成長や努力を具体的に描写し、教師が温かく見守っている印象を与える表現にしてください。
+
+{grade_guidance}
+
+所見文:"""
+)
+
+# バージョン2: 固定の指示をすべて system にまとめ、学年・文字数・キーワードを末尾に置く
+# （どの呼び出しでも同じ長い先頭部分になり、プロバイダのプロンプトキャッシュが効く）
+_TEMPLATE_V2 = PromptTemplate(
+    version=2,
+    system="""あなたは経験豊富な小学校教師です。児童の成長を温かく見守り、小学校の通知表の所見文を作成します。
+
+【所見の構成】
+所見文は必ず以下の4つのセクションで構成し、自然につなげて一つの文章として完成させてください：
+
+①書き出し（全体の様子）
+子どもの学校生活全般での雰囲気を描写してください。
+
+②学習面の様子
+各教科の取り組みの様子を具体的に描写してください。具体的な授業場面や学習内容を含めると良いでしょう。
+
+③生活面の様子
+あいさつや掃除・係活動・人間関係など、生活面での様子を具体的に描写してください。
+
+④今後の期待
+今後に向けた目標や期待を温かく伝えてください。
+
+【要件】
+- 指定された文字数の範囲に収める
+- 具体的で温かみのある表現を使用
+- 否定的な表現は避け、前向きな表現を心がける
+- 所見文のみを出力する
+
+【表現のポイント】
+以下のような多様な表現を積極的に使用してください。同じ表現の繰り返しを避け、バリエーションを持たせてください：
+
+書き出しの表現例：
+- 「〜な姿が見られます」「〜な姿が見られ、感心します」
+- 「〜な様子がうかがえます」「〜な一面が印象的です」
+- 「〜に取り組む姿が目立ちます」「〜を大切にしている様子が伝わってきます」
+- 「日々の〜を通して、〜な成長が見られます」
+
+学習面の表現例：
+- 「〜に積極的に取り組んでいます」「〜を楽しみながら学んでいます」
+- 「〜を意識して取り組む姿が印象的です」「〜を大切にしながら学習しています」
+- 「〜ができるようになりました」「〜を身につけています」
+- 「〜に興味を持ち、〜を調べる姿が見られます」「〜を深く考えています」
+
+生活面の表現例：
+- 「〜ところが素敵です」「〜ことが素晴らしいです」
+- 「〜を大切にしています」「〜を心がけています」
+- 「〜に責任感を持って取り組んでいます」「〜を丁寧に行っています」
+- 「〜を通して、〜な姿勢が見られます」「〜を意識して行動しています」
+
+今後の期待の表現例：
+- 「これからも〜を大切にしながら、〜を期待しています」
+- 「今後も〜を続けながら、〜な成長を願っています」
+- 「〜を活かしながら、〜を目指してほしいと思います」
+- 「〜を意識しながら、〜を伸ばしていってほしいと願っています」
+
+避けるべき表現：
+- 「称賛します」「賞賛します」などの硬い表現
+- 過度に形式的な表現
+- 同じ表現の繰り返し
+
+児童の成長や努力を具体的に描写し、教師が温かく見守っている印象を与える表現にしてください。表現にバリエーションを持たせ、毎回異なる表現で所見文を生成してください。""",
+    user="""{grade_guidance}
+
+学年: {grade_level}
+文字数: 約{target_length}文字（{min_length}文字から{max_length}文字の範囲）
+児童の特徴・キーワード: {keywords}
+
+所見文:"""
+)
+
+TEMPLATES: Dict[int, PromptTemplate] = {
+    template.version: template for template in (_TEMPLATE_V1, _TEMPLATE_V2)
+}
+CURRENT_VERSION = 2
+
+
+def _fill(text: str, values: Dict[str, str]) -> str:
+    """{名前} を値に置き換える（値に含まれる { } はそのまま残す）"""
+    for name, value in values.items():
+        text = text.replace("{" + name + "}", value)
+    return text
+
+
+def get_template(version: int = CURRENT_VERSION) -> PromptTemplate:
+    """
+    プロンプトテンプレートを取得
+    
+    Args:
+        version: テンプレートのバージョン
+        
+    Returns:
+        プロンプトテンプレート
+    """
+    return TEMPLATES[version]
+
+
+@functools.lru_cache(maxsize=None)
+def compile_prompt(grade_level: str, version: int = CURRENT_VERSION) -> CompiledPrompt:
+    """
+    学年ごとのプロンプトを組み立てる（結果はキャッシュされる）
+    
+    Args:
+        grade_level: 学年（"低学年"、"中学年"、"高学年"）
+        version: テンプレートのバージョン
+        
+    Returns:
+        組み立て済みのプロンプト
+    """
+    template = get_template(version)
+    values = {
+        "grade_level": grade_level,
+        "grade_guidance": GRADE_GUIDANCE.get(grade_level, ""),
+    }
+    return CompiledPrompt(
+        version=template.version,
+        grade_level=grade_level,
+        system=_fill(template.system, values),
+        user=_fill(template.user, values),
+    )
+
+
+def load_encoding(model: str):
+    """
+    モデルに対応する tiktoken のエンコーディングを読み込む
+    
+    エンコーディングのファイルは初回にダウンロードされるため時間がかかる。
+    生成の途中では呼ばず、起動時に preload_encodings で読み込んでおく。
+    オフラインなどで読み込めない場合は None を返す（失敗も覚えておき、
+    何度も取りに行かない）。
+    
+    Args:
+        model: モデル名
+        
+    Returns:
+        エンコーディング（tiktoken がない場合・読み込めない場合はNone）
+    """
+    with _encodings_lock:
+        if model in _encodings:
+            return _encodings[model]
+    
+    encoding = None
+    if TIKTOKEN_AVAILABLE:
+        import tiktoken
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            encoding = None
+    
+    with _encodings_lock:
+        _encodings[model] = encoding
+    return encoding
+
+
+def preload_encodings(models: Iterable[str]) -> threading.Thread:
+    """
+    エンコーディングを別スレッドで読み込み始める（起動時に呼ぶ）
+    
+    読み込みが終わるまでは、count_tokens はトークン数を見積もる。
+    
+    Args:
+        models: モデル名のリスト
+        
+    Returns:
+        読み込みを行うスレッド
+    """
+    models = [model for model in dict.fromkeys(models) if model]
+    
+    def load_all():
+        for model in models:
+            load_encoding(model)
+    
+    thread = threading.Thread(target=load_all, name="tiktoken-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def _estimate_tokens(text: str) -> int:
+    """非ASCII文字を1文字1トークン、ASCII文字を4文字1トークンとして見積もる"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + math.ceil(ascii_chars / 4)
+
+
+def count_tokens(text: str, model: Optional[str] = None, estimate: bool = False) -> int:
+    """
+    テキストのトークン数を数える
+    
+    エンコーディングが読み込み済みでない場合（tiktoken がない・読み込み中・
+    読み込めない）は、日本語などの非ASCII文字を1文字1トークン、ASCII文字を
+    4文字1トークンとして見積もる。生成の途中でエンコーディングのファイルを
+    取りに行くことはない。
+    
+    Args:
+        text: テキスト
+        model: モデル名（tiktoken のエンコーディングの選択に使う）
+        estimate: True の場合は tiktoken を使わずに見積もる（ネットワークに
+            つながない StubBackend などで使う）
+        
+    Returns:
+        トークン数
+    """
+    encoding = None if estimate else _encodings.get(model or DEFAULT_ENCODING_MODEL)
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages: List[Dict], model: Optional[str] = None,
+                         estimate: bool = False) -> int:
+    """
+    メッセージ全体のプロンプトトークン数を数える
+    
+    Args:
+        messages: メッセージのリスト
+        model: モデル名
+        estimate: True の場合は tiktoken を使わずに見積もる
+        
+    Returns:
+        トークン数
+    """
+    return sum(TOKENS_PER_MESSAGE + count_tokens(message["content"], model, estimate) for message in messages)
+
+
+def token_report(grade_level: str, version: int = CURRENT_VERSION,
+                 model: Optional[str] = None) -> Dict[str, int]:
+    """
+    テンプレートの部分ごとのトークン数を取得
+    
+    Args:
+        grade_level: 学年
+        version: テンプレートのバージョン
+        model: モデル名
+        
+    Returns:
+        {部分: トークン数}（"static_prefix" は呼び出しごとに同じになる先頭部分）
+    """
+    compiled = compile_prompt(grade_level, version)
+    return {
+        "system": count_tokens(compiled.system, model),
+        "user_template": count_tokens(compiled.user, model),
+        "grade_guidance": count_tokens(GRADE_GUIDANCE.get(grade_level, ""), model),
+        "static_prefix": count_tokens(compiled.static_prefix(), model),
+    }
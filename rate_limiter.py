@@ -0,0 +1,324 @@
+"""
+レート制限モジュール
+OpenAI APIへのリクエストをアカウントの上限（RPM・TPM）に合わせて送り出し、
+レート制限や一時的なエラーの場合は待ってから再試行する
+"""
+
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+import openai
+import config
+
+
+T = TypeVar("T")
+
+# バケットに貯められる量（何秒分の上限か）
+# APIの上限は1分単位でも、実際には秒単位に区切って適用されることがあるため、
+# 一度に送り出すのは1秒分までにする
+BURST_SECONDS = 1.0
+
+# 再試行の設定
+MAX_RETRIES = 6
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
+# 再試行するHTTPステータス
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    1分あたりの上限を持つトークンバケット
+    
+    予約制で、足りない分は残量をマイナスにして、補充されるまでの待ち時間を返す。
+    先に予約した呼び出しから順に送り出される。バケットより大きい予約は、バケットが
+    満杯になれば送り出し（空いていれば待たない）、超えた分は後の呼び出しが待つ。
+    上限が0以下の場合は上限なしとして扱い、待たせない。
+    """
+    
+    def __init__(self, per_minute: float, now: float):
+        """
+        Args:
+            per_minute: 1分あたりの上限（0以下は上限なし）
+            now: 現在時刻（単調増加の秒）
+        """
+        self.unlimited = per_minute <= 0
+        self.rate = max(0.0, per_minute / 60.0)
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = now
+    
+    def _refill(self, now: float):
+        """経過時間分を補充"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        使用量を予約
+        
+        Args:
+            amount: 使用量
+            now: 現在時刻
+            
+        Returns:
+            送り出せるまでの待ち時間（秒）
+        """
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        # バケットより大きい予約は満杯になるまで待てば送り出す（1秒分より大きい
+        # リクエストを、他に何も送っていないときまで待たせない）
+        wait = max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+        self.tokens -= amount
+        return wait
+    
+    def refund(self, amount: float, now: float):
+        """
+        予約した量のうち使わなかった分を戻す（マイナスなら追加で使った分を引く）
+        
+        Args:
+            amount: 戻す量
+            now: 現在時刻
+        """
+        if self.unlimited:
+            return
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    再試行すればよいエラーか
+    
+    Args:
+        error: 発生したエラー
+    
+    Returns:
+        レート制限・タイムアウト・接続エラー・サーバーエラーならTrue
+        （利用上限（insufficient_quota）は待っても解消しないためFalse）
+    """
+    if "insufficient_quota" in str(error).lower():
+        return False
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """レート制限のエラーか"""
+    return getattr(error, "status_code", None) == 429
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    エラーの応答ヘッダーから再試行までの秒数を取得
+    
+    Args:
+        error: 発生したエラー
+    
+    Returns:
+        秒数（retry-after-ms・retry-after がない場合はNone）
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            # HTTP日付形式
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitScheduler:
+    """
+    プロセス全体で共有するリクエストのスケジューラ
+    
+    リクエスト数（RPM）とトークン数（TPM）のバケットで送り出す間隔を調整し、
+    上限を超えそうなリクエストは失敗させずに待たせる。レート制限などの一時的な
+    エラーは、Retry-After に従うか、ジッター付きの指数バックオフで再試行する。
+    レート制限を受けた場合は、他のリクエストも含めて待機時間が過ぎるまで送らない。
+    """
+    
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int,
+                 max_retries: int = MAX_RETRIES,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            requests_per_minute: 1分あたりのリクエスト数の上限（0は上限なし）
+            tokens_per_minute: 1分あたりのトークン数の上限（0は上限なし）
+            max_retries: 再試行の最大回数
+            clock: 現在時刻（単調増加の秒）を返す関数
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self._clock = clock
+        now = clock()
+        self._request_bucket = TokenBucket(requests_per_minute, now)
+        self._token_bucket = TokenBucket(tokens_per_minute, now)
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.waited_seconds = 0.0
+    
+    def _acquire(self, tokens: int) -> float:
+        """
+        送り出し枠を予約し、待つべき秒数を返す
+        
+        Args:
+            tokens: 予約するトークン数（再試行では0にし、リクエスト数の枠だけを予約する）
+        """
+        with self._lock:
+            now = self._clock()
+            delay = max(
+                self._request_bucket.reserve(1, now),
+                self._token_bucket.reserve(tokens, now),
+                self._blocked_until - now
+            )
+            self.requests += 1
+            self.waited_seconds += delay
+            return delay
+    
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        """再試行までの秒数を計算（レート制限の場合は全体を止める）"""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)
+        else:
+            delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        
+        with self._lock:
+            self.retries += 1
+            if is_rate_limited(error):
+                self.rate_limited += 1
+                self._blocked_until = max(self._blocked_until, self._clock() + delay)
+        return delay
+    
+    def settle(self, reserved_tokens: int, used_tokens: Optional[int]):
+        """
+        予約したトークン数と実際の使用量の差を精算
+        
+        Args:
+            reserved_tokens: 予約したトークン数
+            used_tokens: 実際に使ったトークン数（不明な場合はNone。予約した分を
+                使ったものとして何も戻さない）
+        """
+        if used_tokens is None:
+            return
+        with self._lock:
+            self._token_bucket.refund(reserved_tokens - used_tokens, self._clock())
+    
+    def call(self, func: Callable[[], T], tokens: int,
+             on_retry: Optional[Callable[[], None]] = None) -> T:
+        """
+        上限に合わせて待ってから func を呼び出す（一時的なエラーは再試行）
+        
+        Args:
+            func: APIを呼び出す関数
+            tokens: 見積もりのトークン数（プロンプト＋最大生成トークン数。再試行しても
+                予約は1回分で、呼び出し元が settle で1回だけ精算する）
+            on_retry: 再試行するたびに呼ばれる関数
+            
+        Returns:
+            func の戻り値
+        """
+        attempt = 0
+        while True:
+            # トークン数は最初の1回だけ予約する（精算は呼び出し元が1回だけ行うため、
+            # 再試行のたびに予約すると失敗した分がバケットから引かれたままになる）
+            delay = self._acquire(tokens if attempt == 0 else 0)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                return func()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                time.sleep(self._backoff(e, attempt))
+                attempt += 1
+                if on_retry:
+                    on_retry()
+    
+    async def call_async(self, func: Callable[[], Awaitable[T]], tokens: int,
+                         on_retry: Optional[Callable[[], None]] = None) -> T:
+        """
+        call の非同期版（待っている間もイベントループは止めない）
+        
+        Args:
+            func: APIを呼び出すコルーチンを返す関数
+            tokens: 見積もりのトークン数（プロンプト＋最大生成トークン数）
+            on_retry: 再試行するたびに呼ばれる関数
+            
+        Returns:
+            func の戻り値
+        """
+        attempt = 0
+        while True:
+            delay = self._acquire(tokens if attempt == 0 else 0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await func()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                await asyncio.sleep(self._backoff(e, attempt))
+                attempt += 1
+                if on_retry:
+                    on_retry()
+    
+    def stats(self) -> Dict:
+        """
+        スケジューラの状況を取得
+            
+        Returns:
+            {'requests': 送り出したリクエスト数（再試行を含む）, 'retries': 再試行の回数,
+             'rate_limited': レート制限を受けた回数, 'waited_seconds': 待たせた合計秒数}
+        """
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'rate_limited': self.rate_limited,
+                'waited_seconds': self.waited_seconds,
+            }
+
+
+_scheduler: Optional[RateLimitScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RateLimitScheduler:
+    """
+    プロセス全体で共有するスケジューラを取得
+    
+    上限の設定が変わった場合は作り直す。
+    
+    Returns:
+        スケジューラ
+    """
+    global _scheduler
+    rpm, tpm = config.get_openai_rpm_limit(), config.get_openai_tpm_limit()
+    with _scheduler_lock:
+        if (_scheduler is None or _scheduler.requests_per_minute != rpm
+                or _scheduler.tokens_per_minute != tpm):
+            _scheduler = RateLimitScheduler(rpm, tpm)
+        return _scheduler
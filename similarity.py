@@ -0,0 +1,345 @@
+"""
+類似度チェックモジュール
+同じクラス・同じ学期の所見から、ほとんど同じ文章になっているものを見つける
+
+所見文を文字 n-gram の MinHash シグネチャにしてデータベースに保存しておき、
+NumPyでまとめて比較する。シグネチャは保存した所見の分だけ計算する
+（所見文が変わった場合はトリガーで削除され、次のチェック時に計算し直す）。
+"""
+
+import math
+import re
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import cached_property
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from database import Database, ShokenRecord
+
+
+# 文字 n-gram の長さ（日本語は分かち書きしないため文字単位で区切る）
+SHINGLE_SIZE = 3
+# シグネチャの長さ（ハッシュ関数の数）。類似度の誤差はおよそ 1/√NUM_PERM
+NUM_PERM = 128
+# ハッシュ関数を決める乱数の種（変えると保存済みのシグネチャは計算し直しになる）
+HASH_SEED = 20240401
+# シグネチャの作り方。データベースに一緒に保存し、変わったものは計算し直す
+SIGNATURE_SCHEME = f"char{SHINGLE_SIZE}-minhash{NUM_PERM}-{HASH_SEED}"
+
+# 所見どうしを「似ている」とみなす類似度（推定Jaccard係数）
+DEFAULT_THRESHOLD = 0.5
+# 文どうしを「同じ文」とみなす類似度
+SENTENCE_THRESHOLD = 0.7
+# 繰り返しとして指摘する文の最小文字数（「がんばりました。」のような短い文は除く）
+MIN_SENTENCE_LENGTH = 12
+# 比較に使う一時配列（比較する所見の数 × 件数 × NUM_PERM バイト）の上限。
+# 件数が少ない場合は一度に、多い場合はこの大きさに収まる数ずつ比較する
+COMPARE_BLOCK_BYTES = 16 * 1024 * 1024
+
+# 乗算シフト法のハッシュ関数 ((a * x + b) mod 2^64) >> 32 の係数（a は奇数）
+_rng = np.random.default_rng(HASH_SEED)
+_MULTIPLIERS = (_rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+_OFFSETS = _rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+
+# 比較の前に取り除く文字（空白・句読点・括弧）
+_IGNORED_CHARS = re.compile(r"[\s、。，．,.・「」『』（）()！？!?]")
+# 文の区切り
+_SENTENCE_END = re.compile(r"(?<=[。！？!?])")
+# 学期（term_of の形式）
+_TERM_PATTERN = re.compile(r"(\d+)年度([123])学期")
+# 年度の1月から数えた学期の始まりの月（1学期: 4月、2学期: 9月、3学期: 翌年1月、次の年度: 翌年4月）
+_TERM_START_MONTHS = [np.timedelta64(months, "M") for months in (3, 8, 12, 15)]
+
+
+def _normalize(text: str) -> str:
+    """比較に使わない文字を取り除く"""
+    return _IGNORED_CHARS.sub("", text)
+
+
+def _shingles(text: str) -> Set[str]:
+    """文字 n-gram の集合"""
+    text = _normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def compute_signature(text: str) -> np.ndarray:
+    """
+    所見文の MinHash シグネチャを計算
+    
+    Args:
+        text: 所見文
+        
+    Returns:
+        長さ NUM_PERM の uint32 配列（空の所見文はすべて最大値）
+    """
+    shingles = _shingles(text)
+    if not shingles:
+        return np.full(NUM_PERM, np.iinfo(np.uint32).max, dtype=np.uint32)
+    
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+        dtype=np.uint64, count=len(shingles)
+    )
+    # (NUM_PERM, n-gramの数) の行列を一度に計算し、ハッシュ関数ごとの最小値を取る
+    values = (_MULTIPLIERS[:, None] * hashes[None, :] + _OFFSETS[:, None]) >> np.uint64(32)
+    return values.min(axis=1).astype(np.uint32)
+
+
+def estimate_similarity(first: np.ndarray, second: np.ndarray) -> float:
+    """
+    2つのシグネチャから類似度（Jaccard係数）を推定
+    
+    Args:
+        first: シグネチャ
+        second: シグネチャ
+        
+    Returns:
+        0〜1の類似度
+    """
+    return float(np.count_nonzero(first == second)) / NUM_PERM
+
+
+def find_similar_indices(signatures: np.ndarray, threshold: float = DEFAULT_THRESHOLD
+                         ) -> List[Tuple[int, int, float]]:
+    """
+    類似度が閾値以上の組を探す（すべての組をNumPyでまとめて比較）
+    
+    Args:
+        signatures: (件数, NUM_PERM) のシグネチャの行列
+        threshold: 類似度の閾値
+        
+    Returns:
+        (行番号, 行番号, 類似度) のリスト（行番号は小さい方が先）
+    """
+    count = len(signatures)
+    min_equal = math.ceil(threshold * NUM_PERM)
+    block_size = max(1, min(count, COMPARE_BLOCK_BYTES // max(1, count * NUM_PERM)))
+    pairs = []
+    for start in range(0, count, block_size):
+        block = signatures[start:start + block_size]
+        # 自分より後ろの行とだけ比較する
+        equal = (block[:, None, :] == signatures[None, start:, :]).sum(axis=2, dtype=np.uint16)
+        rows, cols = np.nonzero(equal >= min_equal)
+        keep = cols > rows
+        for row, col in zip(rows[keep].tolist(), cols[keep].tolist()):
+            pairs.append((start + row, start + col, int(equal[row, col]) / NUM_PERM))
+    return pairs
+
+
+def split_sentences(text: str) -> List[str]:
+    """所見文を文に分ける"""
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+
+def shared_sentences(first: str, second: str,
+                     threshold: float = SENTENCE_THRESHOLD) -> List[str]:
+    """
+    2つの所見文に共通する（ほとんど同じ）文を取得
+    
+    Args:
+        first: 所見文
+        second: 所見文
+        threshold: 文どうしを同じとみなす類似度
+        
+    Returns:
+        first の文のうち、second にほとんど同じ文があるもの
+    """
+    second_shingles = [
+        _shingles(sentence) for sentence in split_sentences(second)
+        if len(sentence) >= MIN_SENTENCE_LENGTH
+    ]
+    shared = []
+    for sentence in split_sentences(first):
+        if len(sentence) < MIN_SENTENCE_LENGTH:
+            continue
+        shingles = _shingles(sentence)
+        for other in second_shingles:
+            if len(shingles & other) >= threshold * len(shingles | other):
+                shared.append(sentence)
+                break
+    return shared
+
+
+def term_of(created_at: str) -> str:
+    """
+    作成日時から学期を求める（年度は4月始まり）
+    
+    Args:
+        created_at: 作成日時（ISO形式）
+        
+    Returns:
+        "2024年度1学期" の形式（4〜8月: 1学期、9〜12月: 2学期、1〜3月: 3学期）
+    """
+    date = datetime.fromisoformat(created_at)
+    year = date.year if date.month >= 4 else date.year - 1
+    term = 1 if 4 <= date.month <= 8 else 2 if date.month >= 9 else 3
+    return f"{year}年度{term}学期"
+
+
+def term_months(term: str) -> Optional[Tuple[np.datetime64, np.datetime64]]:
+    """
+    学期の期間を月単位で求める（term_of の逆）
+    
+    Args:
+        term: 学期（"2024年度1学期" の形式）
+        
+    Returns:
+        (最初の月, 期間の次の月)（形式が違う場合はNone）
+    """
+    match = _TERM_PATTERN.fullmatch(term)
+    if not match:
+        return None
+    year, number = int(match.group(1)), int(match.group(2))
+    start, end = _TERM_START_MONTHS[number - 1], _TERM_START_MONTHS[number]
+    return np.datetime64(f"{year}-01") + start, np.datetime64(f"{year}-01") + end
+
+
+@dataclass
+class SimilarPair:
+    """
+    似ている所見の組
+    
+    ほとんど同じ文（shared_sentences）は、似ている組が多い場合に備えて
+    参照されたときに初めて探す。
+    """
+    
+    first: ShokenRecord
+    second: ShokenRecord
+    similarity: float
+    
+    @cached_property
+    def shared_sentences(self) -> List[str]:
+        """first の文のうち、second にほとんど同じ文があるもの"""
+        return shared_sentences(self.first.content, self.second.content)
+
+
+@dataclass
+class SimilarityReport:
+    """類似度チェックの結果"""
+    
+    checked: int
+    pairs: List[SimilarPair] = field(default_factory=list)
+    # (文, その文を含む所見のリスト)。含む所見の多い順
+    repeated_sentences: List[Tuple[str, List[ShokenRecord]]] = field(default_factory=list)
+
+
+def repeated_sentences(records: Iterable[ShokenRecord]) -> List[Tuple[str, List[ShokenRecord]]]:
+    """
+    複数の所見で使われている文を取得
+    
+    Args:
+        records: 所見のリスト
+        
+    Returns:
+        (文, その文を含む所見のリスト) のリスト（含む所見の多い順）
+    """
+    found: Dict[str, Tuple[str, List[ShokenRecord]]] = {}
+    for record in records:
+        for sentence in dict.fromkeys(split_sentences(record.content)):
+            if len(sentence) < MIN_SENTENCE_LENGTH:
+                continue
+            key = _normalize(sentence)
+            found.setdefault(key, (sentence, []))[1].append(record)
+    repeated = [(sentence, found_in) for sentence, found_in in found.values() if len(found_in) > 1]
+    return sorted(repeated, key=lambda item: -len(item[1]))
+
+
+class SimilarityIndex:
+    """
+    所見の類似度チェック
+    
+    シグネチャは Database の shoken_signatures テーブルにキャッシュする。
+    所見を保存したら update() でその所見の分だけ計算しておくと、
+    チェック時にはシグネチャを読み込んで比較するだけで済む。
+    """
+    
+    def __init__(self, db: Database):
+        """
+        Args:
+            db: データベース
+        """
+        self.db = db
+    
+    def update(self, shoken_ids: Optional[Iterable[int]] = None) -> int:
+        """
+        シグネチャが未作成の所見の分を計算して保存
+        
+        Args:
+            shoken_ids: 対象の所見ID（Noneの場合は未作成のものすべて）
+            
+        Returns:
+            計算した件数
+        """
+        records = self.db.get_unsigned_shoken(SIGNATURE_SCHEME, shoken_ids)
+        self.db.save_signatures(SIGNATURE_SCHEME, [
+            (record.id, record.updated_at, compute_signature(record.content).astype("<u4").tobytes())
+            for record in records
+        ])
+        return len(records)
+    
+    def terms(self, class_name: Optional[str] = None) -> List[str]:
+        """
+        所見がある学期の一覧（新しい順）
+        
+        Args:
+            class_name: クラス名（Noneの場合はすべてのクラス）
+            
+        Returns:
+            学期のリスト
+        """
+        months = self.db.get_created_months(class_name)
+        return sorted({term_of(f"{month}-01") for month in months}, reverse=True)
+    
+    def check(self, class_name: Optional[str] = None, term: Optional[str] = None,
+              threshold: float = DEFAULT_THRESHOLD) -> SimilarityReport:
+        """
+        似ている所見の組と、繰り返し使われている文を探す
+        
+        同じ児童（同じクラスの同じ児童名）の所見どうしは比較しない。
+        
+        Args:
+            class_name: クラス名（Noneの場合はすべてのクラスをまとめて比較）
+            term: 学期（term_of の形式。Noneの場合はすべての期間）
+            threshold: 所見どうしを似ているとみなす類似度
+            
+        Returns:
+            チェックの結果（組は類似度の高い順）
+        """
+        self.update()
+        rows = self.db.get_shoken_signatures(SIGNATURE_SCHEME, class_name)
+        if not rows:
+            return SimilarityReport(checked=0)
+        
+        records = [record for record, _ in rows]
+        signatures = np.frombuffer(b"".join(signature for _, signature in rows), dtype="<u4")
+        signatures = signatures.reshape(len(rows), NUM_PERM)
+        if term is not None:
+            # 作成月を配列にして、学期の期間に入る所見だけをまとめて選ぶ
+            months = term_months(term)
+            if months is None:
+                return SimilarityReport(checked=0)
+            created = np.array([record.created_at for record in records], dtype="datetime64[M]")
+            keep = np.flatnonzero((created >= months[0]) & (created < months[1]))
+            records = [records[i] for i in keep.tolist()]
+            signatures = signatures[keep]
+            if not records:
+                return SimilarityReport(checked=0)
+        
+        pairs = []
+        for i, j, similarity in find_similar_indices(signatures, threshold):
+            first, second = records[i], records[j]
+            if (first.student_name, first.class_name) == (second.student_name, second.class_name):
+                continue
+            pairs.append(SimilarPair(first=first, second=second, similarity=similarity))
+        pairs.sort(key=lambda pair: -pair.similarity)
+        
+        return SimilarityReport(
+            checked=len(records),
+            pairs=pairs,
+            repeated_sentences=repeated_sentences(records)
+        )
@@ -0,0 +1,304 @@
+"""
+テンプレート生成モジュール
+APIを使わずに、フレーズ集から所見文を組み立てる（案3のテンプレート方式）
+
+APIに接続できない場合や利用上限に達した場合の代わりと、下書きをまとめて
+作る場合に使う。ネットワークを使わず、1件1ミリ秒未満で組み立てる。
+"""
+
+import random
+import zlib
+from typing import Dict, List, Tuple
+
+from length_controller import LENGTH_TOLERANCE, LengthController
+
+
+# キーワードごとのフレーズ
+# (書き出しの「〜姿」の前に置く句, 学習面の文, 生活面の文)。{scene} は場面に置き換える
+KEYWORD_PHRASES: Dict[str, Tuple[str, str, str]] = {
+    "積極的": (
+        "何事にも積極的に取り組む",
+        "{scene}では、自分から進んで手を挙げ、考えを発表しています。",
+        "{scene}にも進んで取り組み、学級のために働く姿が頼もしいです。",
+    ),
+    "協調性": (
+        "友達と協力して物事を進める",
+        "{scene}では、友達と意見を出し合いながら協力して学習を進めています。",
+        "{scene}では、友達と声をかけ合いながら協力して活動しています。",
+    ),
+    "集中力": (
+        "一つのことにじっくりと集中して取り組む",
+        "{scene}では、最後まで集中を切らさずに取り組むことができました。",
+        "{scene}でも、やるべきことに集中して取り組んでいます。",
+    ),
+    "創造性": (
+        "自由な発想で工夫を凝らす",
+        "{scene}では、自分なりのアイデアを生かして工夫する姿が印象的です。",
+        "{scene}では、楽しくなるような工夫を提案し、学級を盛り上げています。",
+    ),
+    "責任感": (
+        "任された仕事を最後までやり遂げる",
+        "{scene}では、自分の役割を意識して最後まで丁寧に取り組んでいます。",
+        "{scene}では、任された仕事を責任感を持って最後までやり遂げています。",
+    ),
+    "思いやり": (
+        "周りの友達を思いやり、優しく接する",
+        "{scene}では、困っている友達に優しく声をかけ、一緒に考える姿が見られます。",
+        "{scene}では、困っている友達に進んで手を差し伸べるところが素敵です。",
+    ),
+    "好奇心": (
+        "身の回りのことに興味を持ち、目を輝かせて学ぶ",
+        "{scene}では、新しいことに興味を持ち、楽しみながら学んでいます。",
+        "{scene}でも、いろいろなことに興味を持って関わっています。",
+    ),
+    "探究心": (
+        "疑問をそのままにせず、とことん調べようとする",
+        "{scene}では、疑問に思ったことを進んで調べ、理解を深めています。",
+        "{scene}でも、よりよい方法を考えながら取り組んでいます。",
+    ),
+    "表現力": (
+        "自分の思いを言葉や作品で豊かに表現する",
+        "{scene}では、自分の考えを分かりやすい言葉で伝えることができました。",
+        "{scene}では、自分の思いを友達に分かりやすく伝えています。",
+    ),
+    "判断力": (
+        "状況をよく見て、適切に判断して行動する",
+        "{scene}では、課題に合った方法を自分で選んで取り組んでいます。",
+        "{scene}では、周りの様子を見て、今何をすべきかを考えて行動しています。",
+    ),
+    "思考力": (
+        "筋道を立ててじっくりと考える",
+        "{scene}では、理由を考えながら筋道を立てて解決しようとしています。",
+        "{scene}でも、どうすればうまくいくかを考えて行動しています。",
+    ),
+    "コミュニケーション": (
+        "誰とでも気さくに言葉を交わし、関わりを広げる",
+        "{scene}では、友達の考えにも耳を傾けながら話し合いを深めています。",
+        "{scene}では、誰とでも明るく関わり、友達の輪を広げています。",
+    ),
+    "リーダーシップ": (
+        "友達をまとめ、先頭に立って行動する",
+        "{scene}では、グループの話し合いをまとめる役割を果たしています。",
+        "{scene}では、先頭に立って友達をまとめ、頼りにされています。",
+    ),
+    "自主性": (
+        "言われる前に自分から行動する",
+        "{scene}では、自分で目標を決めてこつこつと取り組んでいます。",
+        "{scene}では、言われる前に自分から動くことができています。",
+    ),
+    "主体性": (
+        "自分で考え、目的を持って行動する",
+        "{scene}では、自分から課題を見つけて意欲的に学んでいます。",
+        "{scene}では、自分にできることを考えて進んで行動しています。",
+    ),
+    "丁寧": (
+        "一つ一つのことを丁寧に行う",
+        "{scene}では、一つ一つの作業を丁寧に進め、見やすくまとめています。",
+        "{scene}でも、細かいところまで丁寧に取り組んでいます。",
+    ),
+}
+
+# フレーズ集にないキーワードに使うフレーズ（{keyword} はキーワードに置き換える）
+GENERIC_PHRASES = (
+    "{keyword}というよさを発揮する",
+    "{scene}では、{keyword}というよさを生かして意欲的に取り組んでいます。",
+    "{scene}でも{keyword}という持ち味が感じられ、友達からも頼りにされています。",
+)
+
+# 書き出しの「〜」の後に続ける表現
+OPENING_ENDINGS = [
+    "姿が見られます。",
+    "姿が目立ちます。",
+    "様子がうかがえます。",
+    "一面が印象的です。",
+]
+
+# 学年ごとのフレーズ（学年のガイドの具体的な場面を使う）
+GRADE_PHRASES: Dict[str, Dict[str, List[str]]] = {
+    "低学年": {
+        "opening": [
+            "入学して間もない頃に比べて学校生活にもすっかり慣れ、",
+            "毎日元気に登校し、",
+        ],
+        "study_scenes": ["ひらがなの練習", "音読", "たし算やひき算の学習", "生活科の観察"],
+        "life_scenes": ["給食の準備", "休み時間の遊び", "係の仕事", "教室の掃除"],
+        "study": [
+            "ひらがなの練習では、一字一字丁寧に書こうとする姿が見られます。",
+            "音読では、大きな声ではきはきと読むことができるようになってきました。",
+        ],
+        "life": [
+            "ランドセルの片付けなど、身の回りのことを自分でしようとする姿が見られます。",
+            "朝のあいさつも元気にできるようになってきました。",
+        ],
+        "closing": [
+            "これからも「自分でできた！」という気持ちを大切にしながら、いろいろなことに挑戦してほしいと願っています。",
+            "今後も持ち前のよさを生かして、さらに成長していくことを楽しみにしています。",
+        ],
+    },
+    "中学年": {
+        "opening": [
+            "学校生活のさまざまな場面で、",
+            "日々の学習や活動を通して、",
+        ],
+        "study_scenes": ["理科の観察", "算数のグラフの学習", "社会科の地域調べ", "国語の作文"],
+        "life_scenes": ["給食当番", "グループ活動", "係活動", "清掃活動"],
+        "study": [
+            "新しい教科や学習内容にも意欲的に取り組んでいます。",
+            "理科の観察では、気づいたことを詳しく記録しています。",
+        ],
+        "life": [
+            "自分で時間を見ながら行動できるようになってきました。",
+            "給食当番の仕事にも責任を持って取り組んでいます。",
+        ],
+        "closing": [
+            "今後も探究心を大切にしながら、自分で目標を立てて努力を続けてほしいと思います。",
+            "これからも自分から学ぼうとする姿勢を大切に、さらに力を伸ばしていってほしいと願っています。",
+        ],
+    },
+    "高学年": {
+        "opening": [
+            "高学年としての自覚を持ち、",
+            "学校生活のあらゆる場面で、",
+        ],
+        "study_scenes": ["算数の図形の学習", "理科の実験", "社会科の歴史の学習", "総合的な学習の時間"],
+        "life_scenes": ["委員会活動", "掃除活動", "縦割り班の活動", "学校行事"],
+        "study": [
+            "自分で目標を立てて努力し、着実に力を身につけています。",
+            "作品づくりでは、自分で考えて工夫を重ねる姿が見られます。",
+        ],
+        "life": [
+            "下級生にも優しく接し、よき手本となっています。",
+            "掃除活動にも責任を持って取り組み、学校のために働いています。",
+        ],
+        "closing": [
+            "これからもチャレンジ精神を大切にしながら、中学校でも大いに活躍することを期待しています。",
+            "今後も持ち前のよさを生かし、卒業に向けてさらに大きく成長してほしいと願っています。",
+        ],
+    },
+}
+
+# 文字数の調整に使う、どの学年でも使える文
+COMMON_PHRASES: Dict[str, List[str]] = {
+    "study": [
+        "どの教科にも真剣に取り組み、学習のきまりもしっかりと身についています。",
+        "分からないことはそのままにせず、進んで質問することができます。",
+        "授業では友達の発表をよく聞き、自分の考えと比べながら学んでいます。",
+        "ノートを丁寧にまとめ、学んだことを振り返る習慣が身についています。",
+        "難しい問題にも粘り強く取り組み、できた喜びを味わっています。",
+    ],
+    "life": [
+        "あいさつや返事が気持ちよく、周りの人を明るい気持ちにしています。",
+        "友達の話にしっかりと耳を傾け、誰とでも仲よく過ごしています。",
+        "学級のきまりを守り、落ち着いて生活することができています。",
+        "友達のよいところを見つけて伝えるなど、温かい関わりが見られます。",
+        "身の回りの整理整頓にも気を配り、気持ちよく過ごす工夫をしています。",
+    ],
+}
+
+# 目標文字数が少ない場合に使う短い今後の期待
+SHORT_CLOSINGS = [
+    "今後の成長が楽しみです。",
+    "これからの活躍を期待しています。",
+]
+
+# 1つの所見に使うキーワードの最大数（多すぎると1文ずつが短くなり不自然になる）
+MAX_KEYWORDS = 4
+
+_length_controller = LengthController()
+
+
+def _phrases_for(keyword: str) -> Tuple[str, str, str]:
+    """キーワードのフレーズを取得（キーワードを含む場合も同じフレーズを使う）"""
+    if keyword in KEYWORD_PHRASES:
+        return KEYWORD_PHRASES[keyword]
+    for name, phrases in KEYWORD_PHRASES.items():
+        if name in keyword:
+            return phrases
+    return tuple(phrase.replace("{keyword}", keyword) for phrase in GENERIC_PHRASES)
+
+
+def _seed(keywords: List[str], grade_level: str, variant: int) -> int:
+    """同じ入力なら同じ文章になるように乱数の種を決める"""
+    return zlib.crc32("\n".join([grade_level, str(variant)] + keywords).encode("utf-8"))
+
+
+def generate_shoken(keywords: List[str], target_length: int = 200, grade_level: str = "低学年",
+                    variant: int = 0) -> str:
+    """
+    フレーズ集から所見文を組み立てる
+    
+    書き出し・学習面・生活面・今後の期待の4つのセクションで構成し、
+    目標文字数に近づくように文の数を決める（目標文字数が少ない場合は短い
+    言い回しにする）。同じ入力と variant なら同じ文章になる。
+    
+    Args:
+        keywords: キーワードリスト
+        target_length: 目標文字数
+        grade_level: 学年（"低学年"、"中学年"、"高学年"）
+        variant: 別の言い回しにする場合に変える番号
+        
+    Returns:
+        組み立てた所見文
+    """
+    rng = random.Random(_seed(keywords, grade_level, variant))
+    grade = GRADE_PHRASES.get(grade_level, GRADE_PHRASES["中学年"])
+    phrases = [_phrases_for(keyword) for keyword in keywords[:MAX_KEYWORDS]] or [
+        _phrases_for("積極的")
+    ]
+    study_scenes = rng.sample(grade["study_scenes"], len(grade["study_scenes"]))
+    life_scenes = rng.sample(grade["life_scenes"], len(grade["life_scenes"]))
+    
+    keyword_opening = phrases[0][0] + rng.choice(OPENING_ENDINGS)
+    openings = [rng.choice(grade["opening"]) + keyword_opening, keyword_opening]
+    closings = [rng.choice(grade["closing"]), rng.choice(SHORT_CLOSINGS)]
+    
+    # キーワードの文を優先し（まず全キーワードを1文ずつ、学習面と生活面を交互に）、
+    # 足りない分は学年の文・共通の文で補う
+    first, second = [], []
+    for i, (_, study, life) in enumerate(phrases):
+        study = ("study", study.replace("{scene}", study_scenes[i % len(study_scenes)]))
+        life = ("life", life.replace("{scene}", life_scenes[i % len(life_scenes)]))
+        first.append(study if i % 2 == 0 else life)
+        second.append(life if i % 2 == 0 else study)
+    candidates = first + second
+    for section in ("study", "life"):
+        extras = grade[section] + COMMON_PHRASES[section]
+        candidates.extend((section, sentence) for sentence in rng.sample(extras, len(extras)))
+    
+    # 書き出しと今後の期待は長い言い回しを優先し、学習面・生活面の文が1つも入らない
+    # 場合や許容範囲に収まらない場合は短い言い回しにする
+    best = None
+    for opening, closing in ((o, c) for c in closings for o in openings):
+        chosen = _choose_sentences(candidates, len(opening) + len(closing), target_length)
+        text = opening + "".join(chosen["study"]) + "".join(chosen["life"]) + closing
+        fits = (chosen["study"] or chosen["life"]) and _length_controller.is_within(text, target_length)
+        if fits:
+            return text
+        if best is None or abs(len(text) - target_length) < abs(len(best) - target_length):
+            best = text
+    return _length_controller.trim(best, target_length)
+
+
+def _choose_sentences(candidates: List[Tuple[str, str]], length: int,
+                      target_length: int) -> Dict[str, List[str]]:
+    """
+    目標文字数に近づく文を優先順に選ぶ
+    
+    Args:
+        candidates: (セクション, 文) のリスト（優先順）
+        length: 書き出しと今後の期待の文字数
+        target_length: 目標文字数
+        
+    Returns:
+        セクションごとの選んだ文
+    """
+    # 目標文字数に近づく文だけを順に足す（短い文なら後からでも入る）
+    limit = target_length + LENGTH_TOLERANCE
+    chosen = {"study": [], "life": []}
+    for section, sentence in candidates:
+        new_length = length + len(sentence)
+        if (new_length <= limit and abs(new_length - target_length) < abs(length - target_length)
+                and sentence not in chosen[section]):
+            chosen[section].append(sentence)
+            length = new_length
+    return chosen
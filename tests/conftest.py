@@ -0,0 +1,18 @@
+"""テストの共通設定（リポジトリ直下のモジュールを読み込めるようにする）"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """一時ファイルのデータベース（接続はスレッドごとのため、:memory: ではなくファイルを使う）"""
+    db = database.Database(str(tmp_path / "test.db"))
+    yield db
+    db.close()
@@ -0,0 +1,42 @@
+"""
+所見の全文検索のテスト
+FTS5 の索引の作り直しと、検索結果の抜粋の Markdown を確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import database
+
+
+def test_missing_fts_table_is_created_at_startup(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    db = database.Database(path)
+    db.save_shoken("山田太郎", ["積極的"], "毎日の音読練習に熱心に取り組んでいます。", 20, "1年1組")
+    # FTS5 に対応していない SQLite で v5 を適用したデータベースを再現する
+    with db.transaction() as cursor:
+        for name in ("insert", "update", "delete"):
+            cursor.execute(f"DROP TRIGGER shoken_fts_after_{name}")
+        cursor.execute("DROP TABLE shoken_fts")
+    db.close()
+    
+    db = database.Database(path)
+    try:
+        assert db._has_fts()
+        # 既存の所見も索引に登録される
+        results = db.search_shoken("音読練習")
+        assert [result['shoken'].student_name for result in results] == ["山田太郎"]
+        assert "**音読練習**" in results[0]['snippet']
+    finally:
+        db.close()
+
+
+def test_snippet_escapes_markdown_in_content(db):
+    db.save_shoken("佐藤花子", ["発表"], "# [図](a.png) *自由研究*_発表_", 24)
+    
+    for query in ("自由研究", "発表"):
+        # 索引を使う検索（3文字以上）と部分一致の検索（2文字）のどちらも同じく扱う
+        snippet = db.search_shoken(query)[0]['snippet']
+        assert f"**{query}**" in snippet
+        assert snippet.startswith("\\# \\[図\\]\\(a\\.png\\)")
+        assert snippet.count("\\*") == 2 and snippet.count("\\_") == 2
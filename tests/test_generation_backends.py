@@ -0,0 +1,46 @@
+"""
+生成バックエンドのテスト
+記録／再生バックエンドが、同期版だけのバックエンドを非同期に呼び出せることを確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import asyncio
+
+from generation_backends import RecordReplayBackend, StubBackend
+
+
+class SyncOnlyBackend:
+    """complete・stream だけを持つバックエンド"""
+    
+    def __init__(self):
+        self._stub = StubBackend(chunk_size=5)
+        self.model = self._stub.model
+    
+    def complete(self, messages, max_tokens, temperature, n=1):
+        return self._stub.complete(messages, max_tokens, temperature, n)
+    
+    def stream(self, messages, max_tokens, temperature, n=1):
+        return self._stub.stream(messages, max_tokens, temperature, n)
+
+
+def test_async_record_falls_back_to_sync_backend(tmp_path):
+    path = str(tmp_path / "recorded.json")
+    recorder = RecordReplayBackend(path, SyncOnlyBackend())
+    messages = [{"role": "user", "content": "約60文字（"}]
+    deltas = []
+    
+    async def record():
+        completion = await recorder.complete_async(messages, 100, 0.7)
+        streamed = await recorder.stream_async(messages, 100, 0.5, on_delta=deltas.append)
+        return completion, streamed
+    
+    completion, streamed = asyncio.run(record())
+    
+    assert len(deltas) > 1
+    assert "".join(deltas) == streamed.text
+    # 記録した応答はファイルから再生できる
+    replay = RecordReplayBackend(path)
+    assert replay.complete(messages, 100, 0.7).text == completion.text
+    assert replay.complete(messages, 100, 0.5).text == streamed.text
@@ -0,0 +1,46 @@
+"""
+トークン数の数え方のテスト
+エンコーディングが読み込み済みの場合だけ使い、生成の途中では読み込まないことを確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import pytest
+
+import prompt_templates
+
+
+class FakeEncoding:
+    """1文字を1トークンとして数えるエンコーディング"""
+    
+    def encode(self, text):
+        return list(text)
+
+
+@pytest.fixture
+def encodings(monkeypatch):
+    """読み込み済みのエンコーディングを空にする"""
+    loaded = {}
+    monkeypatch.setattr(prompt_templates, "_encodings", loaded)
+    return loaded
+
+
+def test_estimates_until_encoding_is_loaded(encodings, monkeypatch):
+    monkeypatch.setattr(prompt_templates, "load_encoding", lambda model: pytest.fail("読み込まない"))
+    
+    # 非ASCII文字は1文字1トークン、ASCII文字は4文字1トークン
+    assert prompt_templates.count_tokens("所見abcd", "gpt-4o") == 3
+    
+    encodings["gpt-4o"] = FakeEncoding()
+    assert prompt_templates.count_tokens("所見abcd", "gpt-4o") == 6
+    assert prompt_templates.count_tokens("所見abcd", "gpt-4o", estimate=True) == 3
+
+
+def test_preload_remembers_failures(encodings, monkeypatch):
+    monkeypatch.setattr(prompt_templates, "TIKTOKEN_AVAILABLE", False)
+    
+    prompt_templates.preload_encodings(["gpt-4o", "gpt-4o", ""]).join()
+    
+    assert encodings == {"gpt-4o": None}
+    assert prompt_templates.count_tokens("所見", "gpt-4o") == 2
@@ -0,0 +1,84 @@
+"""
+クエリプランのテスト
+各クエリがインデックスを使っていることを EXPLAIN QUERY PLAN で確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+from typing import Callable, List
+
+import pytest
+
+import database
+
+
+# (説明, 実行する処理, 使われるべきインデックス, 結果の並べ替えを許容するか)
+# 並べ替えを許容するのは、インデックスで絞り込んだ少数の結果を並べるクエリのみ
+QUERY_PLAN_EXPECTATIONS = [
+    ("get_shoken_by_class", lambda db: db.get_shoken_by_class("1年1組"), "idx_shoken_class_student", False),
+    ("get_all_shoken", lambda db: db.get_all_shoken(), "idx_shoken_created_at", False),
+    ("get_shoken_page (2ページ目)",
+     lambda db: db.get_shoken_page(after=db.get_shoken_page(limit=10)[1], limit=10),
+     "idx_shoken_created_at", False),
+    ("get_shoken_page (クラス・2ページ目)",
+     lambda db: db.get_shoken_page("1年1組", after=db.get_shoken_page("1年1組", limit=3, order="student")[1],
+                                   limit=3, order="student"),
+     "idx_shoken_class_student", False),
+    ("get_all_classes", lambda db: db.get_all_classes(), "idx_shoken_class_student", False),
+    ("get_popular_keywords", lambda db: db.get_popular_keywords(), "idx_keyword_history_usage", False),
+    ("get_shoken_by_keyword", lambda db: db.get_shoken_by_keyword("積極的"), "idx_shoken_keywords_keyword", True),
+    ("get_keyword_counts", lambda db: db.get_keyword_counts(), "idx_shoken_keywords_keyword", True),
+    ("take_cached_response", lambda db: db.take_cached_response("key", 1, ""), "idx_response_cache_key", False),
+    ("get_roster", lambda db: db.get_roster("1年1組"), "sqlite_autoindex_roster_1", True),
+    ("reserve_tokens (期限切れの予約)", lambda db: db.reserve_tokens("2024-07-01", [("total", "", 0)], 1, ""),
+     "idx_token_reservations_created_at", False),
+]
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    """ダミーの所見を登録したデータベース"""
+    db = database.Database(str(tmp_path_factory.mktemp("plans") / "plans.db"))
+    for i in range(50):
+        db.save_shoken(
+            f"児童{i:04d}",
+            ["積極的", "協調性"],
+            "明るく元気に学校生活を送っています。" * 5,
+            90,
+            f"{i % 6 + 1}年{i % 3 + 1}組"
+        )
+    db.add_keyword_history(["積極的", "協調性"])
+    yield db
+    db.close()
+
+
+def _capture_query_plans(db: database.Database, func: Callable[[database.Database], object]) -> List[str]:
+    """funcが実行したSELECT文のEXPLAIN QUERY PLANを取得"""
+    conn = db.get_connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        func(db)
+    finally:
+        conn.set_trace_callback(None)
+    
+    plans = []
+    for sql in statements:
+        if not sql.lstrip().upper().startswith("SELECT"):
+            continue
+        plans.extend(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql))
+    return plans
+
+
+@pytest.mark.parametrize(
+    "func, index_name, allow_sort",
+    [expectation[1:] for expectation in QUERY_PLAN_EXPECTATIONS],
+    ids=[expectation[0] for expectation in QUERY_PLAN_EXPECTATIONS]
+)
+def test_query_uses_index(db, func, index_name, allow_sort):
+    plans = _capture_query_plans(db, func)
+    assert plans, "SELECT文が実行されていません"
+    assert any(index_name in plan for plan in plans), plans
+    if not allow_sort:
+        assert not any("TEMP B-TREE" in plan for plan in plans), plans
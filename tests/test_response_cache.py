@@ -0,0 +1,89 @@
+"""
+生成結果キャッシュのテスト
+候補がそろうまでの取り出し・候補の使い回し（LRU）・有効期限・件数の上限を確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from openai_client import ResponseCache
+
+
+@pytest.fixture
+def cache(db):
+    """1つのキーで3件の候補を使い回すキャッシュ"""
+    return ResponseCache(db, variants=3, ttl_seconds=3600, max_entries=10)
+
+
+def test_returns_nothing_until_variants_are_filled(cache):
+    key = ResponseCache.make_key(["積極的"], 200, "低学年", "gpt-4o")
+    cache.put(key, "候補1")
+    cache.put(key, "候補2")
+    
+    assert cache.get(key) is None
+    # トークン予算が残り少ない場合は、そろっていなくてもある候補を使う
+    assert cache.get(key, min_variants=1) == "候補1"
+    
+    cache.put(key, "候補3")
+    assert cache.get(key) is not None
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+
+
+def test_rotates_least_recently_used_variant(cache):
+    key = ResponseCache.make_key(["協調性"], 200, "中学年", "gpt-4o")
+    for text in ("候補1", "候補2", "候補3"):
+        cache.put(key, text)
+    
+    assert [cache.get(key) for _ in range(6)] == ["候補1", "候補2", "候補3"] * 2
+
+
+def test_key_normalizes_keywords():
+    assert (ResponseCache.make_key([" 積極的", "協調性", "積極的"], 200, "低学年", "gpt-4o")
+            == ResponseCache.make_key(["協調性", "積極的"], 200, "低学年", "gpt-4o"))
+    assert (ResponseCache.make_key(["積極的"], 200, "低学年", "gpt-4o")
+            != ResponseCache.make_key(["積極的"], 300, "低学年", "gpt-4o"))
+
+
+def test_expired_variants_are_not_used(cache, db):
+    key = ResponseCache.make_key(["集中力"], 200, "高学年", "gpt-4o")
+    for text in ("古い候補1", "古い候補2", "新しい候補"):
+        cache.put(key, text)
+    expired = (datetime.now() - timedelta(seconds=cache.ttl_seconds + 60)).isoformat()
+    with db.transaction() as cursor:
+        cursor.execute("UPDATE response_cache SET created_at = ? WHERE content LIKE '古い%'", (expired,))
+    
+    assert cache.get(key) is None
+    assert cache.get(key, min_variants=1) == "新しい候補"
+    
+    # 次に追加したときに期限切れの候補は削除される
+    cache.put(key, "追加した候補")
+    assert cache.stats()['entries'] == 2
+
+
+def test_evicts_least_recently_used_entries_over_limit(db):
+    cache = ResponseCache(db, variants=1, ttl_seconds=3600, max_entries=3)
+    keys = [ResponseCache.make_key([f"キーワード{i}"], 200, "低学年", "gpt-4o") for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        cache.put(key, f"所見{i}")
+    # 最初のキーを使うと、最も長く使われていないのは2つ目のキーになる
+    assert cache.get(keys[0]) == "所見0"
+    
+    cache.put(keys[3], "所見3")
+    
+    assert cache.stats()['entries'] == 3
+    assert cache.get(keys[1]) is None
+    assert [cache.get(key) for key in (keys[0], keys[2], keys[3])] == ["所見0", "所見2", "所見3"]
+
+
+def test_variants_over_limit_drop_the_oldest(cache):
+    key = ResponseCache.make_key(["責任感"], 200, "中学年", "gpt-4o")
+    for i in range(5):
+        cache.put(key, f"候補{i}")
+    
+    assert cache.stats()['entries'] == 3
+    assert sorted(cache.get(key) for _ in range(3)) == ["候補2", "候補3", "候補4"]
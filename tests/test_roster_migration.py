@@ -0,0 +1,47 @@
+"""
+名簿のマイグレーション（v12・v13）のテスト
+取り込み済みの空の所見を名簿に移すときにキーワードが失われないこと、
+名簿の変更でデータバージョンが増えることを確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import database
+
+
+def test_duplicate_empty_shoken_keywords_are_merged(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    db = database.Database(path)
+    # v12 より前のデータベースを再現する
+    with db.transaction() as cursor:
+        cursor.execute("DROP TABLE roster")
+        cursor.execute("DELETE FROM schema_version WHERE version >= 12")
+    db.save_shoken("山田太郎", ["積極的", "協調性"], "", 0, "1年1組")
+    db.save_shoken("山田太郎", ["協調性", "責任感"], "", 0, "1年1組")
+    db.save_shoken("佐藤花子", ["思いやり"], "", 0, "1年1組")
+    db.save_shoken("山田太郎", ["集中力"], "よく頑張っています。", 10, "1年1組")
+    db.close()
+    
+    db = database.Database(path)
+    try:
+        assert db.get_schema_version() >= 12
+        assert db.get_roster("1年1組") == [
+            {'student_name': "山田太郎", 'keywords': ["積極的", "協調性", "責任感"]},
+            {'student_name': "佐藤花子", 'keywords': ["思いやり"]},
+        ]
+        # 所見文のある所見はそのまま残る
+        assert [record.content for record in db.get_shoken_by_class("1年1組")] == ["よく頑張っています。"]
+    finally:
+        db.close()
+
+
+def test_roster_changes_bump_data_version(db):
+    version = db.data_version()
+    db.save_roster_many([{'student_name': "山田太郎", 'class_name': "1年1組", 'keywords': ["積極的"]}])
+    assert db.data_version() > version
+    
+    # 同じ児童のキーワードの上書きでも増える（名簿の読み取りのキャッシュを無効にする）
+    version = db.data_version()
+    db.save_roster_many([{'student_name': "山田太郎", 'class_name': "1年1組", 'keywords': ["協調性"]}])
+    assert db.data_version() > version
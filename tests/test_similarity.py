@@ -0,0 +1,87 @@
+"""
+類似度チェックのテスト
+MinHash の類似度の閾値・比較のブロック分け・学期での絞り込みを確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+import similarity
+
+BASE = "授業では自分から進んで手を挙げ、考えを発表しています。係の仕事にも責任を持って取り組んでいます。"
+# BASE の一部だけを変えた所見（Jaccard係数はおよそ0.67）
+NEAR = "授業では自分から進んで手を挙げ、考えを発表しています。係の仕事にも最後まで丁寧に取り組んでいます。"
+OTHER = "音読では大きな声ではきはきと読み、ひらがなも丁寧に書けるようになってきました。"
+
+
+def _signatures(texts):
+    return np.stack([similarity.compute_signature(text) for text in texts])
+
+
+def test_threshold_separates_near_and_different_texts():
+    signatures = _signatures([BASE, NEAR, OTHER, BASE])
+    
+    pairs = {(i, j): value for i, j, value in similarity.find_similar_indices(signatures, 0.4)}
+    assert pairs[(0, 3)] == 1.0
+    assert 0.4 <= pairs[(0, 1)] < 0.9
+    assert (0, 2) not in pairs and (1, 2) not in pairs
+    
+    strict = similarity.find_similar_indices(signatures, 0.9)
+    assert [(i, j) for i, j, _ in strict] == [(0, 3)]
+
+
+def test_estimate_matches_exact_jaccard():
+    first, second = similarity._shingles(BASE), similarity._shingles(NEAR)
+    exact = len(first & second) / len(first | second)
+    
+    estimate = similarity.estimate_similarity(*_signatures([BASE, NEAR]))
+    # 誤差はおよそ 1/√NUM_PERM
+    assert abs(estimate - exact) < 3 / similarity.NUM_PERM ** 0.5
+
+
+def test_block_size_does_not_change_pairs(monkeypatch):
+    texts = [BASE, NEAR, OTHER] * 7
+    signatures = _signatures(texts)
+    expected = similarity.find_similar_indices(signatures, 0.5)
+    
+    # 1行ずつ比較するほど小さいブロックでも同じ結果になる
+    monkeypatch.setattr(similarity, "COMPARE_BLOCK_BYTES", 1)
+    assert similarity.find_similar_indices(signatures, 0.5) == expected
+    # 同じ所見どうし（7件から2件の組 × 3種類）と BASE・NEAR の組（7 × 7）
+    assert len(expected) == 21 * 3 + 7 * 7
+
+
+@pytest.mark.parametrize("term, months", [
+    ("2024年度1学期", ("2024-04", "2024-09")),
+    ("2024年度2学期", ("2024-09", "2025-01")),
+    ("2024年度3学期", ("2025-01", "2025-04")),
+])
+def test_term_months_is_inverse_of_term_of(term, months):
+    start, end = similarity.term_months(term)
+    
+    assert (str(start), str(end)) == months
+    assert similarity.term_of(f"{months[0]}-01T00:00:00") == term
+    assert similarity.term_of(str(end - np.timedelta64(1, "M")) + "-28") == term
+    assert similarity.term_months("1学期") is None
+
+
+def test_check_filters_by_term(db):
+    ids = db.save_shoken_many([
+        {'student_name': "児童A", 'class_name': "1年1組", 'keywords': [], 'content': BASE},
+        {'student_name': "児童B", 'class_name': "1年1組", 'keywords': [], 'content': BASE},
+        {'student_name': "児童C", 'class_name': "1年1組", 'keywords': [], 'content': BASE},
+    ])
+    with db.transaction() as cursor:
+        for shoken_id, created_at in zip(ids, ["2024-05-10", "2024-07-20", "2024-10-01"]):
+            cursor.execute("UPDATE shoken SET created_at = ? WHERE id = ?", (created_at + "T09:00:00", shoken_id))
+    index = similarity.SimilarityIndex(db)
+    
+    first_term = index.check("1年1組", term="2024年度1学期")
+    assert first_term.checked == 2
+    assert [(pair.first.student_name, pair.second.student_name) for pair in first_term.pairs] == [("児童A", "児童B")]
+    assert index.check("1年1組", term="2024年度2学期").pairs == []
+    assert index.check("1年1組", term="2024年度3学期").checked == 0
+    assert len(index.check("1年1組").pairs) == 3
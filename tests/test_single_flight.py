@@ -0,0 +1,184 @@
+"""
+同じリクエストの生成をまとめる SingleFlight のテスト
+同時に届いた同じリクエストの共有・終わった後の共有（linger）・エラーの扱いを確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import metrics
+import openai_client
+import token_budget
+from generation_backends import StubBackend
+from openai_client import SingleFlight
+
+
+class CountingBackend(StubBackend):
+    """呼び出し回数を数える疑似バックエンド"""
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = 0
+    
+    def _respond(self, messages, max_tokens, n):
+        with self._lock:
+            self.calls += 1
+        return super()._respond(messages, max_tokens, n)
+
+
+def _wait_until(condition, timeout: float = 5.0):
+    """condition が真になるまで待つ"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "時間内に条件を満たさなかった"
+        time.sleep(0.005)
+
+
+def test_concurrent_requests_share_one_generation():
+    flight = SingleFlight(linger_seconds=0)
+    release = threading.Event()
+    calls = []
+    
+    def generate():
+        calls.append(1)
+        release.wait(5)
+        return "所見"
+    
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(flight.run, "key", generate) for _ in range(5)]
+        _wait_until(lambda: flight.stats()['coalesced'] == 4)
+        release.set()
+        results = [future.result() for future in futures]
+    
+    assert results == ["所見"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {'flights': 1, 'coalesced': 4, 'in_flight': 0}
+
+
+def test_finished_result_is_shared_while_lingering():
+    flight = SingleFlight(linger_seconds=0.1)
+    calls = []
+    
+    def generate():
+        calls.append(1)
+        return f"所見{len(calls)}"
+    
+    assert flight.run("key", generate) == "所見1"
+    # 生成が終わった直後の二度押しは、同じ結果を使う
+    assert flight.run("key", generate) == "所見1"
+    
+    time.sleep(0.15)
+    assert flight.run("key", generate) == "所見2"
+    assert len(calls) == 2
+
+
+def test_lingering_result_is_shared_only_with_the_same_owner():
+    flight = SingleFlight(linger_seconds=60)
+    calls = []
+    
+    def generate():
+        calls.append(1)
+        return f"所見{len(calls)}"
+    
+    assert flight.run("key", generate, ("先生A", "1年1組")) == "所見1"
+    # 終わった生成を使い回すのは二度押しだけ（別の先生の新しいリクエストは生成し直す）
+    assert flight.run("key", generate, ("先生A", "1年1組")) == "所見1"
+    assert flight.run("key", generate, ("先生B", "1年2組")) == "所見2"
+
+
+def test_errors_are_not_shared_after_finish():
+    flight = SingleFlight(linger_seconds=60)
+    
+    def fail():
+        raise RuntimeError("生成に失敗")
+    
+    with pytest.raises(RuntimeError):
+        flight.run("key", fail)
+    assert flight.run("key", lambda: "所見") == "所見"
+
+
+def test_stream_joiner_receives_earlier_deltas():
+    flight = SingleFlight(linger_seconds=0)
+    first_delta = threading.Event()
+    release = threading.Event()
+    
+    def generate(on_delta):
+        on_delta("明るく")
+        first_delta.set()
+        release.wait(5)
+        on_delta("元気です。")
+        return "明るく元気です。"
+    
+    leader = flight.stream("key", generate)
+    assert next(leader) == "明るく"
+    first_delta.wait(5)
+    joiner = flight.stream("key", generate)
+    assert next(joiner) == "明るく"
+    release.set()
+    
+    assert list(leader) == ["元気です。"]
+    assert list(joiner) == ["元気です。"]
+    assert flight.stats()['flights'] == 1
+
+
+@pytest.fixture
+def writer(db):
+    """生成の記録の書き込み先"""
+    writer = metrics.MetricsWriter(db)
+    yield writer
+    writer.flush()
+
+
+def test_client_coalesces_double_submit(db, writer):
+    backend = CountingBackend(latency=0.2)
+    client = openai_client.OpenAIClient(
+        backend=backend, metrics_writer=writer, budget=token_budget.TokenBudget(db)
+    )
+    keywords = ["二度押し", "積極的"]
+    
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        texts = list(executor.map(lambda _: client.generate_shoken(keywords, 200, "低学年", "1年1組", "先生A"),
+                                  range(4)))
+    
+    assert len(set(texts)) == 1
+    assert backend.calls == 1
+    
+    # 終わった後に届いた別の先生のリクエストは、二度押しではないので生成し直す
+    client.generate_shoken(keywords, 200, "低学年", "1年1組", "先生B")
+    assert backend.calls == 2
+
+
+def test_teachers_share_one_call_and_each_budget_is_charged(db, writer):
+    backend = CountingBackend(latency=0.3)
+    budget = token_budget.TokenBudget(db)
+    client = openai_client.OpenAIClient(backend=backend, metrics_writer=writer, budget=budget)
+    keywords = ["人気のキーワード", "協調性"]
+    requests = [("1年1組", "先生A"), ("1年2組", "先生B")]
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = []
+        for class_name, teacher in requests:
+            futures.append(executor.submit(client.generate_shoken, keywords, 200, "低学年", class_name, teacher))
+            # 1人目が生成を始めてから2人目を送る
+            _wait_until(lambda: openai_client.get_single_flight().stats()['in_flight'] >= 1)
+        texts = [future.result() for future in futures]
+    
+    assert texts[0] == texts[1]
+    assert backend.calls == 1
+    
+    def used(class_name, teacher):
+        return {item['scope']: item['used_tokens'] for item in budget.usage(teacher, class_name)}
+    
+    leader = used("1年1組", "先生A")
+    follower = used("1年2組", "先生B")
+    assert leader[token_budget.SCOPE_TEACHER] > 0
+    # 呼び出しは1回なので、アプリ全体には1回分だけ、それぞれの先生・クラスには同じ量を数える
+    assert follower[token_budget.SCOPE_TOTAL] == leader[token_budget.SCOPE_TEACHER]
+    assert follower[token_budget.SCOPE_TEACHER] == leader[token_budget.SCOPE_TEACHER]
+    assert follower[token_budget.SCOPE_CLASS] == leader[token_budget.SCOPE_CLASS]
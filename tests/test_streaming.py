@@ -0,0 +1,53 @@
+"""
+ストリーミング生成のテスト
+表示する文字列と、文字数調整後に差し替える所見文を疑似バックエンドで確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import pytest
+
+import candidate_ranker
+import config
+import metrics
+import openai_client
+import token_budget
+from generation_backends import StubBackend
+
+
+@pytest.fixture
+def client(db):
+    """文字数がばらつく疑似バックエンドのクライアント"""
+    writer = metrics.MetricsWriter(db)
+    yield openai_client.OpenAIClient(
+        backend=StubBackend(length_jitter=0.5, seed=3, chunk_size=5),
+        metrics_writer=writer, budget=token_budget.TokenBudget(db)
+    )
+    writer.flush()
+
+
+def test_single_candidate_streams_then_fits_length(client):
+    stream = client.generate_shoken_stream(["ストリーミング", "積極的"], 200, "中学年", candidates=1)
+    
+    deltas = list(stream)
+    assert len(deltas) > 1
+    assert client.length_controller.is_within(stream.text, 200)
+    assert stream.reserves == []
+
+
+def test_default_candidates_still_stream(client, monkeypatch):
+    monkeypatch.delenv("SHOKEN_CANDIDATES", raising=False)
+    candidates = config.get_candidate_count()
+    assert candidates > 1
+    
+    # アプリの「所見を生成」と同じ呼び出し方
+    stream = client.generate_shoken_stream(["候補", "協調性"], 200, "中学年", candidates=candidates)
+    deltas = list(stream)
+    
+    # 1つ目の候補を届いた順に表示し、表示した候補は入れ替えない
+    assert len(deltas) > 1
+    assert client.length_controller.is_within(stream.text, 200)
+    assert len(stream.reserves) == candidates - 1
+    assert "".join(deltas) not in stream.reserves
+    assert stream.reserves == candidate_ranker.rank_candidates(stream.reserves, 200)
@@ -0,0 +1,75 @@
+"""
+テンプレート方式のテスト
+目標文字数（50〜500文字）と学年ごとに、所見文が許容範囲に収まり、
+文の途中や括弧の中で切れないことを確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import pytest
+
+import openai_client
+import template_generator
+from length_controller import LENGTH_TOLERANCE, LengthController, split_sentences
+
+GRADES = ["低学年", "中学年", "高学年"]
+KEYWORD_SETS = [
+    ["積極的"],
+    ["協調性", "責任感", "思いやり", "好奇心"],
+    ["ねばり強さ"],
+    [],
+]
+
+
+def _assert_complete(text: str):
+    """文末で終わり、括弧が閉じていることを確認"""
+    assert text.endswith("。")
+    assert text.count("「") == text.count("」")
+
+
+@pytest.mark.parametrize("grade_level", GRADES)
+@pytest.mark.parametrize("keywords", KEYWORD_SETS)
+def test_length_within_tolerance(grade_level, keywords):
+    for target_length in range(50, 501, 10):
+        text = template_generator.generate_shoken(keywords, target_length, grade_level)
+        
+        assert abs(len(text) - target_length) <= LENGTH_TOLERANCE, (target_length, text)
+        _assert_complete(text)
+
+
+@pytest.mark.parametrize("grade_level", GRADES)
+def test_short_comment_keeps_keyword_and_body(grade_level):
+    text = template_generator.generate_shoken(["積極的"], 50, grade_level)
+    
+    assert "積極的" in text
+    # 書き出しと今後の期待のほかに、学習面か生活面の文が入る
+    assert len(split_sentences(text)) >= 3
+    _assert_complete(text)
+
+
+def test_same_input_gives_same_text():
+    first = template_generator.generate_shoken(["集中力"], 200, "中学年")
+    
+    assert template_generator.generate_shoken(["集中力"], 200, "中学年") == first
+    assert template_generator.generate_shoken(["集中力"], 200, "中学年", variant=1) != first
+
+
+def test_trim_does_not_split_inside_brackets():
+    text = "元気に過ごしています。これからも「自分でできた！」という気持ちを大切にしてほしいと思います。"
+    
+    assert LengthController(tolerance=0).trim(text, 30) == "元気に過ごしています。"
+
+
+@pytest.mark.parametrize("target_length", [50, 200, 500])
+def test_template_client_length(target_length):
+    client = openai_client.TemplateClient()
+    
+    stream = client.generate_shoken_stream(["表現力"], target_length, "高学年", candidates=3)
+    deltas = list(stream)
+    
+    assert deltas == [stream.text]
+    assert len(stream.reserves) == 2
+    for text in [stream.text] + stream.reserves:
+        assert abs(len(text) - target_length) <= LENGTH_TOLERANCE
+    assert abs(len(client.generate_shoken(["表現力"], target_length, "高学年")) - target_length) <= LENGTH_TOLERANCE
@@ -0,0 +1,95 @@
+"""
+トークン予算のテスト
+予約・精算・上限に近づいた場合の切り替えと、生成に失敗した場合の精算を確認する
+
+使い方:
+    python -m pytest tests
+"""
+
+import pytest
+
+import metrics
+import openai_client
+import token_budget
+from generation_backends import StubBackend
+
+
+def _teacher_usage(budget: token_budget.TokenBudget, teacher: str) -> dict:
+    """先生ごとの今日の利用量"""
+    return next(item for item in budget.usage(teacher) if item['scope'] == token_budget.SCOPE_TEACHER)
+
+
+def test_settle_records_actual_usage(db):
+    budget = token_budget.TokenBudget(db, teacher_limit=1000)
+    
+    reservation = budget.reserve("山田", "3年1組", 400)
+    assert _teacher_usage(budget, "山田")['reserved_tokens'] == 400
+    
+    budget.settle(reservation, 150)
+    budget.settle(reservation, 999)  # 2回目は何もしない
+    usage = _teacher_usage(budget, "山田")
+    assert usage['reserved_tokens'] == 0
+    assert usage['used_tokens'] == 150
+
+
+def test_settle_without_usage_keeps_reserved_amount(db):
+    budget = token_budget.TokenBudget(db, teacher_limit=1000)
+    
+    budget.settle(budget.reserve("山田", "", 400), None)
+    assert _teacher_usage(budget, "山田")['used_tokens'] == 400
+
+
+def test_reserve_over_limit_raises(db):
+    budget = token_budget.TokenBudget(db, teacher_limit=1000, wait_seconds=0)
+    budget.settle(budget.reserve("山田", "", 900), 900)
+    
+    with pytest.raises(token_budget.BudgetExceededError) as excinfo:
+        budget.reserve("山田", "", 200)
+    assert excinfo.value.scope == token_budget.SCOPE_TEACHER
+    # 別の先生の予算には影響しない
+    budget.reserve("佐藤", "", 200)
+
+
+def test_near_limit_degrades(db):
+    budget = token_budget.TokenBudget(db, teacher_limit=1000, degrade_ratio=0.8)
+    
+    assert not budget.reserve("山田", "", 500).degraded
+    assert budget.reserve("山田", "", 300).degraded
+    assert budget.is_near_limit("山田")
+    assert not budget.is_near_limit("佐藤")
+
+
+@pytest.fixture
+def writer(db):
+    """一時ファイルのデータベースに書き込む生成の記録"""
+    writer = metrics.MetricsWriter(db)
+    yield writer
+    writer.flush()
+
+
+def test_failed_generation_is_charged_the_reservation(db, writer):
+    budget = token_budget.TokenBudget(db, teacher_limit=100000)
+    client = openai_client.OpenAIClient(backend=StubBackend(error_rate=1.0), metrics_writer=writer, budget=budget)
+    
+    # APIの障害として扱われ、テンプレートで組み立てた所見文が返る
+    text = client.generate_shoken(["積極的"], 200, "中学年", teacher="山田")
+    assert text
+    
+    usage = _teacher_usage(budget, "山田")
+    assert usage['reserved_tokens'] == 0
+    assert usage['used_tokens'] > 200
+
+
+def test_successful_generation_is_charged_actual_usage(db, writer):
+    budget = token_budget.TokenBudget(db, teacher_limit=100000)
+    backend = StubBackend()
+    client = openai_client.OpenAIClient(backend=backend, metrics_writer=writer, budget=budget)
+    messages = client._build_messages(["積極的"], 200, "中学年")
+    max_tokens = client.length_controller.max_tokens_for(200)
+    
+    client.generate_shoken(["積極的"], 200, "中学年", teacher="山田")
+    
+    completion = backend.complete(messages, max_tokens, openai_client.TEMPERATURE)
+    usage = _teacher_usage(budget, "山田")
+    assert usage['used_tokens'] == completion.total_tokens
+    assert usage['used_tokens'] < client._estimate_tokens(messages, max_tokens)
@@ -0,0 +1,300 @@
+"""
+トークン予算モジュール
+OpenAI APIで使うトークン数を、アプリ全体・先生ごと・クラスごとに1日単位で数え、
+上限を超えるリクエストは送る前に止める
+
+生成1回ごとに、送る前に見積もりのトークン数を予約し、終わったら実際に使った
+トークン数で精算する。予約はSQLiteの1トランザクションで行うため、複数の
+セッション・プロセスから同時に生成しても上限を超えて予約されることはない。
+精算されないまま RESERVATION_TTL_SECONDS 秒が過ぎた予約（予約後にプロセスが
+終了した場合など）は、次の予約のときに予約した分を使ったものとして精算する。
+"""
+
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import config
+import database
+
+
+# 予算の範囲
+SCOPE_TOTAL = "total"
+SCOPE_TEACHER = "teacher"
+SCOPE_CLASS = "class"
+SCOPE_LABELS = {
+    SCOPE_TOTAL: "アプリ全体",
+    SCOPE_TEACHER: "先生ごと",
+    SCOPE_CLASS: "クラスごと",
+}
+
+# 上限に対してこの割合を使ったら、キャッシュや安いモデルに切り替える
+DEGRADE_RATIO = 0.8
+
+# 実行中の生成の予約が精算されれば収まる場合に待つ最大秒数と、確認の間隔
+WAIT_SECONDS = 30.0
+POLL_SECONDS = 0.5
+
+# 精算されない予約を期限切れとして精算するまでの秒数（生成1回にかかる時間より十分長くする）
+RESERVATION_TTL_SECONDS = 10 * 60
+
+
+class BudgetExceededError(Exception):
+    """トークン予算を超えるため、リクエストを送らなかったことを表すエラー"""
+    
+    def __init__(self, scope: str, name: str, limit: int, used: int):
+        """
+        Args:
+            scope: 上限を超えた範囲
+            name: 先生の名前・クラス名（アプリ全体の場合は空文字列）
+            limit: 1日の上限
+            used: 今日使ったトークン数（予約中の分を含む）
+        """
+        self.scope = scope
+        self.name = name
+        self.limit = limit
+        self.used = used
+        target = f"（{name}）" if name else ""
+        super().__init__(
+            f"{SCOPE_LABELS[scope]}{target}の今日のトークン予算（{limit:,}）を超えるため送信しませんでした"
+            f"（使用済み {used:,}）"
+        )
+
+
+@dataclass
+class Reservation:
+    """予約したトークン数（精算に使う）"""
+    
+    id: int
+    day: str
+    keys: List[Tuple[str, str]]
+    tokens: int
+    # 上限に近づいている（安いモデルに切り替える）か
+    degraded: bool = False
+    settled: bool = field(default=False, repr=False)
+
+
+class TokenBudget:
+    """
+    1日ごとのトークン予算
+    
+    上限が0の範囲も利用量は数える。名前が空の先生・クラスは、
+    名前のない利用者どうしで1つの予算を共有する。
+    """
+    
+    def __init__(self, db: Optional[database.Database] = None, daily_limit: int = 0,
+                 teacher_limit: int = 0, class_limit: int = 0,
+                 degrade_ratio: float = DEGRADE_RATIO, wait_seconds: float = WAIT_SECONDS,
+                 reservation_ttl_seconds: float = RESERVATION_TTL_SECONDS):
+        """
+        Args:
+            db: 保存先のデータベース（省略時は共有のもの）
+            daily_limit: アプリ全体の1日の上限（0は上限なし）
+            teacher_limit: 先生1人の1日の上限（0は上限なし）
+            class_limit: 1クラスの1日の上限（0は上限なし）
+            degrade_ratio: 上限に近づいているとみなす割合
+            wait_seconds: 実行中の生成の精算を待つ最大秒数
+            reservation_ttl_seconds: 精算されない予約を期限切れとして精算するまでの秒数
+        """
+        self.db = db or database.get_database()
+        self.daily_limit = daily_limit
+        self.teacher_limit = teacher_limit
+        self.class_limit = class_limit
+        self.degrade_ratio = degrade_ratio
+        self.wait_seconds = wait_seconds
+        self.reservation_ttl_seconds = reservation_ttl_seconds
+    
+    @property
+    def limits(self) -> Tuple[int, int, int]:
+        """(アプリ全体, 先生ごと, クラスごと) の上限"""
+        return self.daily_limit, self.teacher_limit, self.class_limit
+    
+    def _limits_for(self, teacher: str, class_name: str) -> List[Tuple[str, str, int]]:
+        """(範囲, 名前, 上限) のリスト"""
+        return [
+            (SCOPE_TOTAL, "", self.daily_limit),
+            (SCOPE_TEACHER, teacher or "", self.teacher_limit),
+            (SCOPE_CLASS, class_name or "", self.class_limit),
+        ]
+    
+    def is_near(self, item: Dict) -> bool:
+        """利用量（usage の1件）が上限に近づいているか"""
+        return bool(item['limit']) and (
+            item['used_tokens'] + item['reserved_tokens'] >= item['limit'] * self.degrade_ratio
+        )
+    
+    def usage(self, teacher: str = "", class_name: str = "") -> List[Dict]:
+        """
+        今日の利用量を取得
+        
+        Args:
+            teacher: 先生の名前
+            class_name: クラス名
+            
+        Returns:
+            範囲ごとの利用量のリスト
+            （{'scope', 'name', 'limit', 'used_tokens', 'reserved_tokens', 'requests'}）
+        """
+        limits = self._limits_for(teacher, class_name)
+        usage = self.db.get_token_usage(date.today().isoformat(), [(scope, name) for scope, name, _ in limits])
+        return [dict(item, limit=limit) for item, (_, _, limit) in zip(usage, limits)]
+    
+    def is_near_limit(self, teacher: str = "", class_name: str = "") -> bool:
+        """
+        いずれかの予算が上限に近づいているか（上限がなければデータベースは読まない）
+        
+        Args:
+            teacher: 先生の名前
+            class_name: クラス名
+            
+        Returns:
+            上限の degrade_ratio 以上を使っていればTrue
+        """
+        if not any(self.limits):
+            return False
+        return any(self.is_near(item) for item in self.usage(teacher, class_name))
+    
+    def _try_reserve(self, teacher: str, class_name: str, tokens: int,
+                     can_wait: bool) -> Optional[Reservation]:
+        """
+        予約を1回試す
+        
+        Returns:
+            予約（実行中の生成の精算を待てば収まりそうな場合はNone）
+            
+        Raises:
+            BudgetExceededError: 待っても上限に収まらない場合
+        """
+        day = date.today().isoformat()
+        limits = self._limits_for(teacher, class_name)
+        expires_before = (datetime.now() - timedelta(seconds=self.reservation_ttl_seconds)).isoformat()
+        reservation_id, usage = self.db.reserve_tokens(day, limits, tokens, expires_before)
+        if reservation_id is not None:
+            return Reservation(
+                id=reservation_id,
+                day=day,
+                keys=[(scope, name) for scope, name, _ in limits],
+                tokens=tokens,
+                degraded=any(self.is_near(item) for item in usage)
+            )
+        
+        exceeded = [
+            item for item in usage
+            if item['limit'] and item['used_tokens'] + item['reserved_tokens'] + tokens > item['limit']
+        ]
+        if can_wait and all(item['used_tokens'] + tokens <= item['limit'] for item in exceeded):
+            return None
+        item = exceeded[0]
+        raise BudgetExceededError(
+            item['scope'], item['name'], item['limit'], item['used_tokens'] + item['reserved_tokens']
+        )
+    
+    def reserve(self, teacher: str, class_name: str, tokens: int) -> Reservation:
+        """
+        トークン数を予約（上限を超える場合は送る前にエラーにする）
+        
+        実行中の生成の予約のために上限を超える場合は、精算されるまで
+        wait_seconds 秒まで待つ（見積もりより実際の使用量は少ないことが多い）。
+        
+        Args:
+            teacher: 先生の名前
+            class_name: クラス名
+            tokens: 見積もりのトークン数
+            
+        Returns:
+            予約（生成が終わったら settle で精算する）
+            
+        Raises:
+            BudgetExceededError: 上限を超える場合
+        """
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            reservation = self._try_reserve(teacher, class_name, tokens, time.monotonic() < deadline)
+            if reservation:
+                return reservation
+            time.sleep(POLL_SECONDS)
+    
+    async def reserve_async(self, teacher: str, class_name: str, tokens: int) -> Reservation:
+        """
+        reserve の非同期版（データベースは別スレッドで読み書きし、待っている間もイベントループは止めない）
+        
+        Args:
+            teacher: 先生の名前
+            class_name: クラス名
+            tokens: 見積もりのトークン数
+            
+        Returns:
+            予約
+            
+        Raises:
+            BudgetExceededError: 上限を超える場合
+        """
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            reservation = await asyncio.to_thread(
+                self._try_reserve, teacher, class_name, tokens, time.monotonic() < deadline
+            )
+            if reservation:
+                return reservation
+            await asyncio.sleep(POLL_SECONDS)
+    
+    def settle(self, reservation: Reservation, used_tokens: Optional[int]):
+        """
+        予約を精算（2回目以降は何もしない）
+        
+        Args:
+            reservation: 予約
+            used_tokens: 実際に使ったトークン数（不明な場合は予約した分を使ったものとする）
+        """
+        if reservation.settled:
+            return
+        reservation.settled = True
+        self.db.settle_tokens(reservation.id, used_tokens)
+    
+    def charge_shared(self, teacher: str, class_name: str, owner_teacher: str, owner_class_name: str,
+                      used_tokens: int):
+        """
+        別の先生・クラスが始めた生成の結果を共有した分を、先生ごと・クラスごとの利用量に加える
+        
+        APIの呼び出しは1回のため、アプリ全体の利用量と、生成を始めた先生・クラスと
+        同じ範囲には加えない（生成を始めた側の精算で数えてある）。上限は確認しない。
+        
+        Args:
+            teacher: 結果を共有した先生の名前
+            class_name: 結果を共有したクラス名
+            owner_teacher: 生成を始めた先生の名前
+            owner_class_name: 生成を始めたクラス名
+            used_tokens: 生成で使ったトークン数
+        """
+        keys = []
+        if (teacher or "") != (owner_teacher or ""):
+            keys.append((SCOPE_TEACHER, teacher or ""))
+        if (class_name or "") != (owner_class_name or ""):
+            keys.append((SCOPE_CLASS, class_name or ""))
+        if keys and used_tokens > 0:
+            self.db.add_token_usage(date.today().isoformat(), keys, used_tokens)
+
+
+_budget: Optional[TokenBudget] = None
+_budget_lock = threading.Lock()
+
+
+def get_budget() -> TokenBudget:
+    """
+    プロセス全体で共有するトークン予算を取得
+    
+    上限の設定が変わった場合は作り直す。
+    
+    Returns:
+        トークン予算
+    """
+    global _budget
+    limits = (config.get_daily_token_budget(), config.get_teacher_token_budget(),
+              config.get_class_token_budget())
+    with _budget_lock:
+        if _budget is None or _budget.limits != limits:
+            _budget = TokenBudget(None, *limits)
+        return _budget